@@ -1,14 +1,38 @@
 """Flask webapp allowlistapp."""
 
-from pprint import pformat
+import time
 
-from flask import Flask, render_template
+_import_started = time.perf_counter()
 
-from . import ala_auth, config, logger
+from pprint import pformat  # noqa: E402 Imports are timed for the startup report
+
+from flask import Flask  # noqa: E402
+
+from . import (  # noqa: E402
+    ala_auth,
+    assets,
+    audit,
+    config,
+    events,
+    health,
+    logger,
+    metrics,
+    profiling,
+    reload,
+    replication,
+    startup,
+    tracing,
+)
+
+_import_seconds = time.perf_counter() - _import_started
 
 
 def create_app(test_config: dict | None = None, instance_path: str | None = None) -> Flask:
     """Create and configure an instance of the Flask application."""
+    global _import_seconds  # noqa: PLW0603 The import only happens once per process, so only report it once.
+    startup_report = startup.StartupReport(_import_seconds)
+    _import_seconds = 0
+
     app = Flask(__name__, instance_relative_config=True, instance_path=instance_path)  # Create Flask app object
 
     logger.setup_logger(app, config.DEFAULT_CONFIG["logging"])  # Setup logger with defaults defined in config module
@@ -21,6 +45,8 @@ def create_app(test_config: dict | None = None, instance_path: str | None = None
     else:
         ala_conf = config.AllowListAppConfig(instance_path=app.instance_path)  # Loads app config from disk
 
+    startup_report.mark("config")
+
     app.logger.debug("Instance path is: %s", app.instance_path)
 
     logger.setup_logger(app, ala_conf["logging"])  # Setup logger with config
@@ -40,22 +66,36 @@ def create_app(test_config: dict | None = None, instance_path: str | None = None
 
     app.logger.debug(app_config_str)
 
+    startup_report.mark("logging")
+
     with app.app_context():
         ala_auth.start_allowlist_auth()
 
+    startup_report.mark("allowlist")
+
     # Register the authentication endpoint
     app.register_blueprint(ala_auth.bp)
+    health.start_health(app)
+
+    if ala_conf["metrics"]["enabled"]:
+        app.register_blueprint(metrics.bp)
+
+    if ala_conf["check_many"]["enabled"]:
+        app.register_blueprint(ala_auth.check_bp)
+
+    replication.start_replication(app)
+    events.start_events(app)
+    audit.start_audit(app)
+
+    tracing.start_tracing(app)
+    profiling.start_profiling(app)
+
+    assets.start_assets(app)
 
-    # Setup vars for template
-    hide_username = False
-    if ala_conf["app"]["auth_type"] == "static":
-        hide_username = True
-    redirect_url = ala_conf["app"]["redirect_url"]
+    reload.start_reload_handler(app)
 
-    @app.route("/")
-    def home() -> str:
-        """Flask Home."""
-        return render_template("home.html.j2", hide_username=hide_username, redirect_url=redirect_url)
+    startup_report.mark("app")
+    startup_report.finish()
 
     app.logger.info("Starting Web Server")
 
@@ -1,19 +1,29 @@
 """Allowlist object and its friends."""
 
+import atexit
+import bisect
 import datetime
+import functools
 import ipaddress
 import logging
+import os
+import socket
 import threading
 import time
+import typing
+from collections.abc import Iterable, Iterator
 
 from flask import current_app
 
-from . import database
+from . import database, journal, lastseen, metrics, tracing
 
 logger = logging.getLogger(__name__)
 
 nginx_allowlist = None
 
+NETWORK_CACHE_SIZE = 1 << 18
+SECONDS_PER_DAY = 24 * 60 * 60
+
 
 class AllowList:
     """This is the allowlist object, init from database, query from memory, write to database."""
@@ -21,7 +31,17 @@ class AllowList:
     def __init__(self, ala_conf: dict) -> None:
         """Initialise the AllowList."""
         self.ala_conf = ala_conf
-        self.allowlist = database.db_get_allowlist()
+        # Changes are made under the lock, lookups don't take it, so removals swap in a new list rather than edit
+        self._lock = threading.RLock()
+
+        # Other processes using the same database tell us about their changes through the journal
+        assert database.database_path is not None  # noqa: S101 Appease mypy
+        self.journal = journal.Journal(database.database_path)
+        self.last_seen: lastseen.LastSeen | None = None  # Only tracked with expiry, see start_expiry
+        with database.db_lock(), self._lock:
+            self._load()
+            if not os.path.exists(database.database_path):  # Create it now rather than on the first login
+                database.db_write_allowlist(self.allowlist)
 
         # See if we need to revert the allowlist daily
         if self.ala_conf["app"]["revert_daily"]:
@@ -41,44 +61,324 @@ class AllowList:
         logger.debug("Checking if IP already in allowlist...")
         auth_in_list = False
 
-        for item in self.allowlist:
-            try:
-                # Check if the IP matches directly or is within the network
-                if ip == item["ip"] or ipaddress.ip_address(ip) in ipaddress.ip_network(item["ip"]):
-                    auth_in_list = True
-                    break
-            except ValueError:
-                continue
+        with metrics.LOOKUP_SECONDS.time():
+            if self.journal.changed():
+                self._sync()
+
+            for item in self.allowlist:
+                try:
+                    # Check if the IP matches directly or is within the network
+                    if ip == item["ip"] or ipaddress.ip_address(ip) in ipaddress.ip_network(item["ip"]):
+                        auth_in_list = True
+                        if self.last_seen is not None:
+                            self.last_seen.touch(item)
+                        break
+                except ValueError:
+                    continue
 
         return auth_in_list
 
+    def check_many(self, ips: Iterable[str]) -> Iterator[tuple[str, bool]]:
+        """Check a batch of IPs, yields each one and if it's in the allowlist, anything not an IP isn't.
+
+        The allowlist is turned into sorted address ranges once, so each IP is a binary search rather than a scan
+        of the whole allowlist. Changes made while the batch is being checked aren't seen.
+        """
+        index = _RangeIndex(self.snapshot())
+        for ip in ips:
+            yield ip, ip in index
+
     def add_to_allowlist(self, username: str, ip: str) -> bool:
         """Insert an IP into the allowlist, returns if an IP has been inserted."""
         logger.debug("Trying to insert ip: %s for user: %s", ip, username)
 
-        added = False
+        commit = None
+        with tracing.span("add_to_allowlist"):
+            with database.db_lock(), self._lock:
+                self._sync()  # Another process might have added it already
+                events = self._insert(username, ip)
+                if events:
+                    commit = self._persist(events)
+
+            if commit:
+                with tracing.span("db commit wait"):
+                    commit.wait()  # Outside the lock, a background write needs it
+        return len(events) != 0
+
+    def update_allowed_subnets(self, old_subnets: list, new_subnets: list) -> bool:
+        """Apply a change to the allowed_subnets config, only the subnets that changed are touched.
+
+        Returns if the allowlist changed.
+        """
+        removed = [subnet for subnet in old_subnets if subnet not in new_subnets]
+        added = [subnet for subnet in new_subnets if subnet not in old_subnets]
+        logger.info("Allowed subnets changed, removing: %s, adding: %s", removed, added)
+
+        commit = None
+        with database.db_lock(), self._lock:
+            self._sync()
+            events = [
+                {"op": "remove", "entry": item}
+                for item in self._remove(lambda item: item["username"] == "default" and item["ip"] in removed)
+            ]
+            for subnet in added:
+                events.extend(self._insert("default", subnet))
+
+            if events:
+                commit = self._persist(events)
+
+        if commit:
+            commit.wait()
+        return len(events) != 0
+
+    def apply_changes(self, changes: list[dict]) -> list[dict]:
+        """Apply changes from another node, in the same form as the journal events, returns the ones applied.
+
+        Adds of entries that are already there and removes or expires of ones that aren't are skipped. A reset
+        only removes the logins dated before it, ones made here since are kept, it's applied as a remove of each.
+        Those removes are this node's own changes, each with its own sequence number, so they're passed on like
+        any other. Anything else in a change, like where it came from, is kept in the journal.
+        """
+        commit = None
+        with database.db_lock(), self._lock:
+            self._sync()
+            keys = {(item["ip"], item["username"]) for item in self.allowlist}
+            applied = []
+            for change in changes:
+                if change["op"] == "reset":
+                    applied += self._apply_remote_reset(change, keys)
+                    continue
+                change = {**change, "entry": {key: change["entry"][key] for key in database.CSV_SCHEMA}}  # noqa: PLW2901 Only the columns we know
+                if change["op"] not in ("add", "remove", "expire") or not self._check_ip(change["entry"]["ip"]):
+                    continue
+                before = len(keys)
+                self._apply(change, keys)
+                if len(keys) != before:
+                    applied.append(change)
+
+            if applied:
+                commit = self._persist(applied)
+
+        if commit:
+            commit.wait()
+        return applied
+
+    def _apply_remote_reset(self, change: dict, keys: set[tuple[str, str]]) -> list[dict]:
+        """Remove the logins dated before another node's reset, returns a remove change for each."""
+        reset_time = parse_date(change["date"])
+        if reset_time is None:
+            return []
+
+        def before_reset(item: dict) -> bool:
+            added = parse_date(item["date"])  # Unknown dates are kept, like expiry does
+            return item["username"] != "default" and added is not None and added <= reset_time
+
+        removed = self._remove(before_reset)
+        keys.difference_update((item["ip"], item["username"]) for item in removed)
+        return [{"op": "remove", "entry": item} for item in removed]
+
+    def _sync(self) -> None:
+        """Apply the changes other processes have made to the database."""
+        with self._lock:
+            events = self.journal.read_new()
+            if events is not None:
+                self._apply_all(events)
+                return
+
+        # The journal was replaced, the database lock always has to be taken before ours
+        with database.db_lock(), self._lock:
+            self._load()
+
+    def _load(self) -> None:
+        """Load the whole database and the journal on top, call with both locks held."""
+        self.allowlist = database.db_get_allowlist()
+        self._apply_all(self.journal.replay())
+
+    def snapshot(self) -> list[dict]:
+        """Get an up to date copy of the allowlist, also used by background database writes."""
+        self._sync()
+        return list(self.allowlist)
+
+    def _apply_all(self, events: list[dict]) -> None:
+        """Apply changes from the journal to the in memory allowlist."""
+        keys = {(item["ip"], item["username"]) for item in self.allowlist} if events else set()
+        for event in events:
+            self._apply(event, keys)
+        metrics.ALLOWLIST_ENTRIES.set(len(self.allowlist))
+
+    def _apply(self, event: dict, keys: set[tuple[str, str]]) -> None:
+        """Apply a change from the journal, applying one that's already in the allowlist does nothing.
+
+        keys holds the (ip, username) of every entry, kept up to date here.
+        """
+        entry = event.get("entry", {})
+        key = (entry.get("ip"), entry.get("username"))
+        if event["op"] == "add" and key not in keys:
+            self.allowlist.append(entry)
+            keys.add(key)
+        elif event["op"] in ("remove", "expire") and key in keys:
+            self._remove(lambda item: item["ip"] == entry["ip"] and item["username"] == entry["username"])
+            keys.discard(key)
+        elif event["op"] == "reset":
+            self.allowlist = []
+            keys.clear()
+        logger.debug("Applied change from the journal: %s", event)
+
+    def _insert(self, username: str, ip: str) -> list[dict]:
+        """Insert an IP into the in memory allowlist, returns the changes made, none if it's already covered.
+
+        The user's own entries that the new one covers are removed, a wider network replaces them. The
+        allowed_subnets ("default" entries) are left alone, they're matched by their exact text on a config reload.
+        """
         self._check_ip(ip)
 
-        if self.is_in_allowlist(ip):
-            logger.info("Duplicate ip/network, not adding.")
-        else:
-            new_item = {"username": username, "ip": ip, "date": str(datetime.datetime.now())}
-            self.allowlist.append(new_item)
-            added = True
-            logger.info("Added ip: %s to allowlist", ip)
-
-            database.db_write_allowlist(self.allowlist)
-            self._write_app_allowlist_files()
-
-        return added
+        network = _network(ip)
+        subsumed = []
+        for item in self.allowlist:
+            item_network = _network(item["ip"])
+            if item["ip"] == ip or (network and item_network and _subnet_of(network, item_network)):
+                logger.info("Duplicate ip/network, not adding.")
+                if self.last_seen is not None:  # Logging in again counts as using it, nginx might not ask us
+                    self.last_seen.touch(item)
+                return []
+            if network is None or item_network is None:
+                continue
+            if username != "default" and item["username"] == username and _subnet_of(item_network, network):
+                subsumed.append(item)
+
+        events = []
+        if subsumed:
+            subsumed_ids = {id(item) for item in subsumed}
+            events = [{"op": "remove", "entry": item} for item in self._remove(lambda item: id(item) in subsumed_ids)]
+            logger.info("%s covers %s entries for the same user, removed them", ip, len(subsumed))
+
+        new_item = {"username": username, "ip": ip, "date": _now_date()}
+        self.allowlist.append(new_item)
+        logger.info("Added ip: %s to allowlist", ip)
+        return [*events, {"op": "add", "entry": new_item}]
+
+    def compact(self) -> dict:
+        """Drop duplicate entries and merge each user's entries into as few networks as they fit in.
+
+        The allowed_subnets ("default" entries) are only deduplicated. Returns the rows and database bytes before
+        and after.
+        """
+        assert database.database_path is not None  # noqa: S101 Appease mypy
+        with database.db_lock(), self._lock:
+            self._sync()
+            stats = {"rows_before": len(self.allowlist), "bytes_before": os.path.getsize(database.database_path)}
+            self.allowlist, events = _compacted(self.allowlist)
+            # Dropped duplicates have no event, the whole database and nginx allowlist are rewritten regardless
+            commit = self._persist(events, rewrite=True)
+
+        commit.wait()
+        database.db_flush()  # The size is only right once it's written, whatever the durability mode
+        stats |= {"rows_after": len(self.allowlist), "bytes_after": os.path.getsize(database.database_path)}
+        logger.info("Compacted the allowlist: %s", stats)
+        return stats
+
+    def start_expiry(self, expiry_conf: dict) -> None:
+        """Track when entries are used, and expire the idle ones in a background thread.
+
+        Args:
+            expiry_conf: The expiry configuration {"idle_days": float, "max_per_user": int, "flush_interval": float,
+                "check_interval": float}, it's read each time so a config reload applies
+        """
+        assert database.database_path is not None  # noqa: S101 Appease mypy
+        self.last_seen = lastseen.LastSeen(database.database_path)
+        self._expiry_conf = expiry_conf
+        thread = threading.Thread(target=self._expire_periodically, name="allowlist-expiry", daemon=True)
+        thread.start()
+        atexit.register(self._flush_last_seen)
+
+    def _flush_last_seen(self) -> None:
+        if self.last_seen is not None:
+            self.last_seen.flush(self.snapshot())
+
+    def _expire_periodically(self) -> None:
+        last_check = time.monotonic()
+        while True:
+            time.sleep(self._expiry_conf["flush_interval"])
+            try:
+                self._flush_last_seen()
+                if time.monotonic() - last_check >= self._expiry_conf["check_interval"]:
+                    last_check = time.monotonic()
+                    self.expire()
+            except Exception:  # Try again next time rather than never again
+                logger.exception("Couldn't expire idle allowlist entries")
+
+    def expire(self, now: float | None = None) -> list[dict]:
+        """Remove the entries idle for longer than idle_days, and each user's least recently used past max_per_user.
+
+        The allowed_subnets ("default" entries) never expire. An entry that's never been used counts from when it was
+        added. Returns the expired entries.
+        """
+        assert self.last_seen is not None  # noqa: S101 Only with start_expiry
+        now = time.time() if now is None else now
+
+        commit = None
+        with database.db_lock(), self._lock:
+            self._sync()
+            self.last_seen.flush(self.allowlist)
+            expired = _expired(self.allowlist, self.last_seen.load(), self._expiry_conf, now)
+            expired_ids = {id(item) for item in expired}
+            removed = self._remove(lambda item: id(item) in expired_ids)
+            events = [{"op": "expire", "entry": item} for item in removed]
+            if events:
+                commit = self._persist(events)
+
+        if commit:
+            commit.wait()
+            metrics.ALLOWLIST_EXPIRED_TOTAL.inc(len(events))
+            logger.info("Expired %s idle allowlist entries", len(events))
+        return removed
+
+    def _remove(self, predicate: typing.Callable[[dict], bool]) -> list[dict]:
+        """Remove the entries matching predicate from the in memory allowlist, returns the removed entries."""
+        kept = []
+        removed = []
+        for item in self.allowlist:
+            if predicate(item):
+                logger.info("Removed ip: %s from allowlist", item["ip"])
+                removed.append(item)
+            else:
+                kept.append(item)
+
+        if removed:
+            self.allowlist = kept
+        return removed
+
+    def _persist(self, events: list[dict], *, rewrite: bool = False) -> database.Commit:
+        """Record the changes, write the in memory allowlist to the database and write the app allowlist files.
+
+        With rewrite the app allowlist files are written in full, rather than just the parts the events touch.
+        Returns the database commit to wait on once the locks are released.
+        """
+        metrics.ALLOWLIST_ENTRIES.set(len(self.allowlist))
+
+        self.journal.append(events)
+        commit = database.db_commit_allowlist(self.snapshot, self.journal.rotate_if_needed)
+        self._write_app_allowlist_files(None if rewrite else events)
+        return commit
+
+    def reset(self) -> None:
+        """Clear the allowlist back to the allowed_subnets."""
+        logger.info("Adding subnets/ips from config file")
+
+        with database.db_lock(), self._lock:
+            self._sync()
+            self.allowlist = []
+            # The date lets other nodes clear only the entries from before it, see apply_changes
+            events: list[dict] = [{"op": "reset", "date": _now_date()}]
+            for subnet in self.ala_conf["app"]["allowed_subnets"]:
+                events.extend(self._insert("default", subnet))
+            commit = self._persist(events)
+
+        commit.wait()
 
     def _revert_list_daily(self) -> None:
         """Reset list at 4am."""
         while True:
-            logger.info("Adding subnets/ips from config file")
-
-            database.db_reset()
-
             # Get the current time
             current_time = datetime.datetime.now().time()
 
@@ -108,11 +408,15 @@ class AllowList:
             time.sleep(seconds_until_next_run)
 
             logger.info("It's 4am, reverting IP list to default")
+            try:
+                self.reset()
+            except Exception:  # Try again tomorrow rather than never again
+                logger.exception("Couldn't revert the allowlist")
 
-    def _write_app_allowlist_files(self) -> None:
-        """Write to the nginx allowlist conf file."""
+    def _write_app_allowlist_files(self, events: list[dict] | None = None) -> None:
+        """Write to the nginx allowlist conf file, the changes in events or the whole thing."""
         if nginx_allowlist:
-            nginx_allowlist.write(self.ala_conf, self.allowlist)
+            nginx_allowlist.write(self.ala_conf, self.allowlist, events)
 
     def _check_ip(self, in_ip_or_network: str) -> bool:
         """Check if string is valid IP or Network."""
@@ -131,6 +435,184 @@ class AllowList:
         return valid_ip
 
 
+Network = ipaddress.IPv4Network | ipaddress.IPv6Network
+
+
+@functools.lru_cache(maxsize=NETWORK_CACHE_SIZE)
+def _network(ip: str) -> Network | None:
+    """The network an entry covers, None if it isn't an IP or network."""
+    try:
+        return ipaddress.ip_network(ip, strict=False)
+    except ValueError:
+        return None
+
+
+def client_network(ip: str, app_conf: dict) -> str:
+    """The network to allow for a client, its IP widened to the configured prefix, anything else is left as it is.
+
+    IPv6 clients rotate through privacy addresses in their /64, so allowing the whole /64 means one entry rather
+    than a new one (and an nginx reload) for every address.
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+
+    prefix = app_conf["ipv6_prefix"] if address.version == 6 else app_conf["ipv4_prefix"]  # noqa: PLR2004 IPv6
+    if prefix >= address.max_prefixlen:
+        return ip
+    return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+
+
+def _subnet_of(narrower: Network, wider: Network) -> bool:
+    """Check if a network is inside another, networks of different IP versions never are."""
+    return (
+        narrower.version == wider.version
+        and narrower.network_address in wider
+        and narrower.prefixlen >= wider.prefixlen
+    )
+
+
+class _RangeIndex:
+    """The allowlist as sorted, non overlapping ranges of addresses (as integers) for each IP version."""
+
+    def __init__(self, allowlist: list[dict]) -> None:
+        ranges: dict[int, list[tuple[int, int]]] = {4: [], 6: []}
+        for item in allowlist:
+            network = _network(item["ip"])
+            if network is not None:
+                ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+
+        self._starts: dict[int, list[int]] = {}
+        self._ends: dict[int, list[int]] = {}
+        for version, version_ranges in ranges.items():
+            starts: list[int] = []
+            ends: list[int] = []
+            for start, end in sorted(version_ranges):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._starts[version] = starts
+            self._ends[version] = ends
+
+    def __contains__(self, ip: str) -> bool:
+        """Check if an IP is in any of the ranges."""
+        # inet_pton is a lot quicker than ipaddress, which matters when there are millions of them
+        try:
+            address, version = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big"), 4
+        except OSError:
+            try:
+                address, version = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big"), 6
+            except OSError:
+                return False
+
+        position = bisect.bisect_right(self._starts[version], address) - 1
+        return position >= 0 and address <= self._ends[version][position]
+
+
+def _compacted(allowlist: list[dict]) -> tuple[list[dict], list[dict]]:
+    """Deduplicate the allowlist and merge each user's entries, returns the new list and the changes made.
+
+    A merged entry takes the place of the lowest of the addresses it replaces, with the latest of their dates.
+    """
+    seen = set()
+    deduplicated = []
+    for item in allowlist:
+        key = (item["ip"], item["username"])
+        if key not in seen:
+            seen.add(key)
+            deduplicated.append(item)
+
+    networks: dict[int, Network] = {}
+    users: dict[tuple[str, int], list[dict]] = {}
+    for item in deduplicated:
+        network = _network(item["ip"])
+        if item["username"] != "default" and network is not None:
+            networks[id(item)] = network
+            users.setdefault((item["username"], network.version), []).append(item)
+
+    # Each entry's group, the entries merging into one network, and that network
+    groups: dict[int, tuple[list[dict], Network]] = {}
+    for items in users.values():
+        groups |= _merge_groups(items, networks)
+
+    compacted = []
+    events = []
+    for item in deduplicated:
+        group, network = groups.get(id(item), ([item], None))
+        if len(group) == 1 or network is None:
+            compacted.append(item)
+        elif item is group[0]:
+            ip = str(network.network_address) if network.num_addresses == 1 else str(network)
+            date = max((member["date"] for member in group), key=lambda value: parse_date(value) or 0.0)
+            new_item = {"username": item["username"], "ip": ip, "date": date}
+            compacted.append(new_item)
+            events += [{"op": "remove", "entry": member} for member in group]
+            events.append({"op": "add", "entry": new_item})
+
+    return compacted, events
+
+
+def _expired(allowlist: list[dict], last_seen: dict[lastseen.Key, float], expiry_conf: dict, now: float) -> list[dict]:
+    """The entries to expire, 0 for idle_days or max_per_user is no limit."""
+    idle_limit = expiry_conf["idle_days"] * SECONDS_PER_DAY
+    by_user: dict[str, list[tuple[float, dict]]] = {}
+    expired = []
+    for item in allowlist:
+        if item["username"] == "default":
+            continue
+        seen_time = last_seen.get((item["ip"], item["username"])) or _added_time(item, now)
+        if idle_limit and now - seen_time > idle_limit:
+            expired.append(item)
+        else:
+            by_user.setdefault(item["username"], []).append((seen_time, item))
+
+    max_per_user = expiry_conf["max_per_user"]
+    if max_per_user:
+        for items in by_user.values():
+            items.sort(key=lambda seen: seen[0], reverse=True)
+            expired += [item for _, item in items[max_per_user:]]
+    return expired
+
+
+def _added_time(item: dict, now: float) -> float:
+    """When an entry was added, now if that's unknown so it isn't expired by mistake."""
+    added = parse_date(item.get("date", ""))
+    return now if added is None else added
+
+
+def _now_date() -> str:
+    """The date for a new entry or reset, in UTC so other nodes can compare them with theirs."""
+    return str(datetime.datetime.now(tz=datetime.timezone.utc))  # noqa: UP017 datetime.UTC is 3.11+
+
+
+def parse_date(date: str) -> float | None:
+    """The timestamp of an entry or reset date, older naive ones are local time, None if it isn't a date."""
+    try:
+        return datetime.datetime.fromisoformat(date).timestamp()
+    except ValueError:
+        return None
+
+
+def _merge_groups(items: list[dict], networks: dict[int, Network]) -> dict[int, tuple[list[dict], Network]]:
+    """Group one user's entries of one IP version by the network they merge into, keyed by the id of each entry."""
+    # Entries are all the same IP version
+    collapsed = iter(sorted(ipaddress.collapse_addresses(networks[id(item)] for item in items)))  # type: ignore[type-var]
+    current = next(collapsed)
+    group: list[dict] = []
+    groups = {}
+    # The merged networks don't overlap, so in order each one's entries come one after the other
+    for item in sorted(items, key=lambda item: networks[id(item)]):
+        if not _subnet_of(networks[id(item)], current):
+            current = next(collapsed)
+            group = []
+        group.append(item)
+        groups[id(item)] = (group, current)
+    return groups
+
+
 def start_allowlist_handler() -> None:
     """Start the allowlist handler to handle the allowlists."""
     global nginx_allowlist  # noqa: PLW0603 Needed for how flask loads modules.
@@ -1,15 +1,24 @@
 """Module to handle writing the nginx allowlist and reloading nginx."""
 
+import contextlib
 import logging
 import os
 import pwd
+import re
 import subprocess
 import time
+import zlib
 
 from jinja2 import Environment, FileSystemLoader
 
+from . import metrics, tracing
+
 logger = logging.getLogger(__name__)
 
+# Shard modes, none: everything in allowlist_path. user: a file per user. hash: shard_count files, by IP hash.
+SHARD_SUFFIX = ".conf"
+SHARD_CACHE_SIZE = 1_000_000
+
 
 class NGINXAllowlist:
     """Object to handle writing NGINX allowlist."""
@@ -27,33 +36,121 @@ class NGINXAllowlist:
         if self.user_account != "root":
             self.reload_nginx_command = ["sudo", "systemctl", "reload", "nginx"]
 
-    def write(self, ala_conf: dict, allowlist: list) -> None:
-        """Write NGINX allowlist."""
-        logger.debug("Writing nginx allowlist: %s", ala_conf["services"]["nginx"]["allowlist_path"])
-        while self._writing:
-            time.sleep(0.2)
+        self._shard_cache: dict[str, str] = {}
+        self._shard_cache_key: tuple[str, int] | None = None
 
-        env = Environment(
+        self._env = Environment(
             loader=FileSystemLoader(os.path.join(os.getcwd(), "allowlistapp", "templates")), autoescape=True
         )
-        template = env.get_template("nginx.conf.j2")
-        rendered_template = template.render(allowlist=allowlist)
 
-        allowlist_path = ala_conf["services"]["nginx"]["allowlist_path"]
-        try:
-            with open(allowlist_path, "w", encoding="utf8") as conf_file:
-                conf_file.write(rendered_template)
-        except FileNotFoundError as exc:
-            msg = f"Could not write NGINX allowlist file to path: {allowlist_path}"
-            if allowlist_path == "":
-                msg = "In the config, please enter a path for the NGINX allowlist file."
-            logger.exception(msg)
-            raise FileNotFoundError(msg) from exc
+    def write(self, ala_conf: dict, allowlist: list, events: list[dict] | None = None) -> None:
+        """Write NGINX allowlist.
+
+        With sharding, only the shards touched by the events (journal style changes) are rewritten, without events
+        everything is.
+        """
+        nginx_conf = ala_conf["services"]["nginx"]
+        logger.debug("Writing nginx allowlist: %s", nginx_conf["allowlist_path"])
+        while self._writing:
+            time.sleep(0.2)
+
+        shard_mode = nginx_conf.get("shard_mode", "none")
+        if shard_mode == "none":
+            with metrics.NGINX_RENDER_SECONDS.time(), tracing.span("nginx render", entries=len(allowlist)):
+                rendered_template = self._env.get_template("nginx.conf.j2").render(allowlist=allowlist)
+            with tracing.span("nginx write"):
+                self._write_file(nginx_conf["allowlist_path"], rendered_template, atomic=False)
+        else:
+            self._write_shards(nginx_conf, shard_mode, allowlist, events)
 
         self._writing = False
         logger.debug("Finished writing nginx allowlist")
         self._reload()
 
+    def _write_shards(self, nginx_conf: dict, shard_mode: str, allowlist: list, events: list[dict] | None) -> None:
+        """Write the shards the events touch, and the top level file that includes them if the set of shards changed."""
+        shard_count = nginx_conf.get("shard_count", 16)
+        field = "username" if shard_mode == "user" else "ip"
+        if self._shard_cache_key != (shard_mode, shard_count) or len(self._shard_cache) > SHARD_CACHE_SIZE:
+            self._shard_cache = {}
+            self._shard_cache_key = (shard_mode, shard_count)
+        # Every entry's shard is needed on every write, a dict lookup is a lot cheaper than working it out
+        shard_cache = self._shard_cache
+
+        def _shard_of(value: str) -> str:
+            shard = shard_cache.get(value)
+            if shard is None:
+                shard = shard_cache[value] = (
+                    _user_shard(value) if shard_mode == "user" else _hash_shard(value, shard_count)
+                )
+            return shard
+
+        # Only the shards with changed entries, unless something changed everything (a reset)
+        touched = None
+        if events is not None and all(event["op"] in ("add", "remove", "expire") for event in events):
+            touched = {_shard_of(event["entry"][field]) for event in events}
+
+        with metrics.NGINX_RENDER_SECONDS.time(), tracing.span("nginx render", entries=len(allowlist)) as render_span:
+            shards: dict[str, list] = {}
+            if touched is not None:
+                shards = {shard: [] for shard in touched}
+            elif shard_mode == "hash":
+                shards = {f"hash-{bucket:03d}": [] for bucket in range(shard_count)}  # Keeps the includes the same
+            for item in allowlist:
+                shard = shard_cache.get(item[field]) or _shard_of(item[field])
+                if touched is None or shard in touched:
+                    shards.setdefault(shard, []).append(item)
+
+            template = self._env.get_template("nginx_shard.conf.j2")
+            # Users with nothing left lose their file, hash shards are kept even when empty
+            rendered = {
+                shard: template.render(allowlist=items) if items or shard_mode == "hash" else None
+                for shard, items in shards.items()
+            }
+            if render_span:
+                render_span.attributes["shards"] = len(rendered)
+
+        with tracing.span("nginx write"):
+            self._replace_shards(nginx_conf["allowlist_path"], rendered, complete=touched is None)
+
+    def _replace_shards(self, allowlist_path: str, rendered: dict[str, str | None], *, complete: bool) -> None:
+        """Write the rendered shards, None removes a shard, complete means any other shard files are stale."""
+        if allowlist_path == "":
+            raise _path_error(allowlist_path)
+        shard_dir = allowlist_path + ".d"
+        try:
+            os.mkdir(shard_dir)
+        except FileExistsError:
+            pass
+        except FileNotFoundError as exc:
+            raise _path_error(allowlist_path) from exc
+
+        before = {name.removesuffix(SHARD_SUFFIX) for name in os.listdir(shard_dir) if name.endswith(SHARD_SUFFIX)}
+        kept = {shard for shard, text in rendered.items() if text is not None}
+        stale = (before - kept) if complete else (rendered.keys() - kept)
+        for shard in stale:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(shard_dir, shard + SHARD_SUFFIX))
+        for shard in kept:
+            self._write_file(os.path.join(shard_dir, shard + SHARD_SUFFIX), rendered[shard] or "")
+
+        after = kept if complete else (before - stale) | kept
+        if complete or after != before:
+            includes = [os.path.join(os.path.abspath(shard_dir), shard + SHARD_SUFFIX) for shard in sorted(after)]
+            self._write_file(allowlist_path, self._env.get_template("nginx_shards.conf.j2").render(includes=includes))
+
+    def _write_file(self, path: str, text: str, *, atomic: bool = True) -> None:
+        """Write a file, atomic writes go to a temp file first so nginx never sees half of it."""
+        try:
+            with metrics.NGINX_WRITE_SECONDS.time():
+                write_path = f"{path}.{os.getpid()}.tmp" if atomic else path
+                with open(write_path, "w", encoding="utf8") as conf_file:
+                    conf_file.write(text)
+                if atomic:
+                    os.replace(write_path, path)
+        except FileNotFoundError as exc:
+            raise _path_error(path) from exc
+
     def _reload(self) -> None:
         """Reload NGINX."""
         while self._nginx_reloading:
@@ -62,7 +159,8 @@ class NGINXAllowlist:
         self._nginx_reloading = True
         logger.info("Reloading nginx")
         try:
-            subprocess.run(self.reload_nginx_command, check=True, capture_output=True, text=True)  # noqa: S603 Input has been validated
+            with metrics.NGINX_RELOAD_SECONDS.time(), tracing.span("nginx reload"):
+                subprocess.run(self.reload_nginx_command, check=True, capture_output=True, text=True)  # noqa: S603 Input has been validated
             logger.info("Nginx reloaded")
         except subprocess.CalledProcessError:
             err = (
@@ -80,4 +178,24 @@ class NGINXAllowlist:
             self._nginx_reloading = False
 
 
+def _path_error(path: str) -> FileNotFoundError:
+    """Log and return the error for an allowlist path that can't be written to."""
+    msg = f"Could not write NGINX allowlist file to path: {path}"
+    if path == "":
+        msg = "In the config, please enter a path for the NGINX allowlist file."
+    logger.exception(msg)
+    return FileNotFoundError(msg)
+
+
+def _user_shard(username: str) -> str:
+    """Shard name for a user, readable but with a hash so different usernames never share a file."""
+    slug = re.sub(r"[^A-Za-z0-9_-]+", "_", username)[:32]
+    return f"user-{slug}-{zlib.crc32(username.encode()):08x}"
+
+
+def _hash_shard(ip: str, shard_count: int) -> str:
+    """Shard name for an IP, spread evenly over shard_count files."""
+    return f"hash-{zlib.crc32(ip.encode()) % shard_count:03d}"
+
+
 logger.debug("Loaded module: %s", __name__)
@@ -1,23 +1,32 @@
 """Flask webapp to control a nginx allowlist."""
 
+import hmac
 import json
 import logging
+import secrets
+import threading
+import time
+import typing
+from collections.abc import Iterable, Iterator
 from http import HTTPStatus
 
-import requests
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError
-from flask import Blueprint, current_app, request
+import click
+from flask import Blueprint, Response, abort, current_app, request, stream_with_context
+from flask.cli import AppGroup
 
-from . import al_handler, ala_auth_types
+from . import al_handler, ala_auth_types, audit, config, metrics, tracing
 
 REMOTE_AUTH_TYPES: dict = ala_auth_types.REMOTE_AUTH_TYPES
 
 logger = logging.getLogger(__name__)
 bp = Blueprint("auth", __name__)
-ph = PasswordHasher()
+check_bp = Blueprint("check", __name__)
+cli = AppGroup("allowlist", help="Look after the stored allowlist.")
 al: al_handler.AllowList | None = None
 
+T = typing.TypeVar("T")
+_FLIGHT_KEY_SECRET = secrets.token_bytes(32)
+
 
 @bp.route("/check_auth/", methods=["GET"])
 def check_auth() -> tuple[str, int]:
@@ -40,16 +49,20 @@ def check_auth() -> tuple[str, int]:
 @bp.route("/authenticate/", methods=["POST"])
 def authenticate() -> tuple[str, int]:
     """Post da password."""
-    assert al is not None  # noqa: S101 Appease mypy
     username = request.form["username"]
     password = request.form["password"]
 
-    # Check the auth depending on if we are using static auth, or checking via an external url
-    result = (
-        check_password_static(password)
-        if current_app.config["app"]["auth_type"] == "static"
-        else check_password_url(username, password)
-    )
+    # Get IP
+    if request.environ.get("HTTP_X_FORWARDED_FOR") is None:
+        ip = request.environ["REMOTE_ADDR"]
+    else:
+        ip = request.environ["HTTP_X_FORWARDED_FOR"]
+
+    # A double click sends the same login twice at once, the second one waits for the first and gets its result
+    key = _flight_key(ip, username, password)
+    (result, auth_seconds), shared = _in_flight.run(key, lambda: _authenticate_once(username, password, ip))
+    if shared:
+        metrics.AUTH_COALESCED_TOTAL.inc()
 
     message = "nope"
     status = HTTPStatus.FORBIDDEN
@@ -57,23 +70,120 @@ def authenticate() -> tuple[str, int]:
     if result:
         status = HTTPStatus.OK
         message = "yep"
-
-    # Get IP
-    if request.environ.get("HTTP_X_FORWARDED_FOR") is None:
-        ip = request.environ["REMOTE_ADDR"]
+        metrics.AUTH_TOTAL.labels("success").inc()
     else:
-        ip = request.environ["HTTP_X_FORWARDED_FOR"]
+        metrics.AUTH_TOTAL.labels("failure").inc()
 
     username_text = ""
     if username != "":
         username_text = f", Username: {username}"
 
     logger.info("Authentication returned: %s for %s%s", message, ip, username_text)
+    if audit.audit_log:
+        audit.audit_log.record(ip, username, result, auth_seconds)
+
+    return message, status
+
+
+def _authenticate_once(username: str, password: str, ip: str) -> tuple[bool, float]:
+    """Check the password and allow the IP if it's right, returns the result and how long the check took."""
+    assert al is not None  # noqa: S101 Appease mypy
+    # Check the auth depending on if we are using static auth, or checking via an external url
+    auth_started = time.perf_counter()
+    with tracing.span("auth check", auth_type=current_app.config["app"]["auth_type"]) as auth_span:
+        result = (
+            check_password_static(password)
+            if current_app.config["app"]["auth_type"] == "static"
+            else check_password_url(username, password)
+        )
+        if auth_span:
+            auth_span.attributes["result"] = result
+    auth_seconds = time.perf_counter() - auth_started
 
     if result:
-        al.add_to_allowlist(username, ip)
+        al.add_to_allowlist(username, al_handler.client_network(ip, current_app.config["app"]))
 
-    return message, status
+    return result, auth_seconds
+
+
+def _flight_key(ip: str, username: str, password: str) -> str:
+    """Key for logins that are the same, the password is in it so a wrong one never gets a right one's result."""
+    login = f"{ip}\0{username}\0{password}".encode()
+    return hmac.new(_FLIGHT_KEY_SECRET, login, "sha256").hexdigest()  # Don't keep the password around as it is
+
+
+class SingleFlight:
+    """Runs a function once for all the callers with the same key at the same time, they all get what it returns.
+
+    Nothing is cached, a call after the first one has finished runs it again.
+    """
+
+    class _Call:
+        def __init__(self) -> None:
+            self.done = threading.Event()
+            self.value: typing.Any = None
+            self.error: BaseException | None = None
+
+    def __init__(self) -> None:
+        """Initialise the single flight, nothing is in flight."""
+        self._lock = threading.Lock()
+        self._calls: dict[str, SingleFlight._Call] = {}
+
+    def run(self, key: str, func: typing.Callable[[], T]) -> tuple[T, bool]:
+        """Run func, or wait for the call with the same key already running, returns its value and if it was shared.
+
+        If it raises, every caller waiting on it gets the exception.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = SingleFlight._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value = func()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False
+
+
+_in_flight = SingleFlight()
+
+
+@check_bp.route("/check_many/", methods=["POST"])
+def check_many() -> Response:
+    """Check a batch of IPs, one per line, streams back a line of <ip> yep or nope for each."""
+    assert al is not None  # noqa: S101 Appease mypy
+    token = current_app.config["check_many"]["token"]
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        abort(401)
+
+    ips = (line.strip().decode(errors="replace") for line in request.stream)
+    results = al.check_many(ip for ip in ips if ip)
+    return Response(stream_with_context(_result_lines(results)), mimetype="text/plain")
+
+
+def _result_lines(results: Iterable[tuple[str, bool]], chunk_size: int = 1000) -> Iterator[str]:
+    """Format check results as lines, a chunk of them at a time."""
+    lines = []
+    for ip, allowed in results:
+        lines.append(f"{ip} {'yep' if allowed else 'nope'}\n")
+        if len(lines) >= chunk_size:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
 
 
 def start_allowlist_auth() -> None:
@@ -84,23 +194,105 @@ def start_allowlist_auth() -> None:
     al_handler.start_allowlist_handler()
 
     al = al_handler.AllowList(current_app.config)
+    if current_app.config["expiry"]["enabled"]:
+        al.start_expiry(current_app.config["expiry"])
+        logger.info("Expiring allowlist entries idle for %s days", current_app.config["expiry"]["idle_days"])
+    current_app.cli.add_command(cli)
+
+    # Import what the configured auth type needs now, rather than in the first login request
+    if current_app.config["app"]["auth_type"] == "static":
+        config.get_password_hasher(current_app.config["argon2"])
+    else:
+        import requests  # noqa: F401
+
+
+@cli.command("compact")
+def compact_command() -> None:
+    """Drop duplicate entries and merge each user's entries into as few networks as they fit in."""
+    assert al is not None  # noqa: S101 Appease mypy
+    stats = al.compact()
+    click.echo(
+        f"Rows: {stats['rows_before']} -> {stats['rows_after']}, saved {stats['rows_before'] - stats['rows_after']}"
+    )
+    click.echo(
+        f"Bytes: {stats['bytes_before']} -> {stats['bytes_after']}, "
+        f"saved {stats['bytes_before'] - stats['bytes_after']}"
+    )
+
+
+@cli.command("expire")
+def expire_command() -> None:
+    """Expire the idle entries now, as set in the expiry config."""
+    assert al is not None  # noqa: S101 Appease mypy
+    if al.last_seen is None:
+        click.echo("Expiry isn't enabled")
+        return
+    for item in al.expire():
+        click.echo(f"{item['username']} {item['ip']}")
+
+
+@cli.command("check")
+@click.argument("input_file", type=click.File("r"), default="-")
+@click.option("--field", default=1, help="Which whitespace separated field of each line is the IP, 1 for nginx logs.")
+@click.option("--denied", is_flag=True, help="Only print the IPs that aren't in the allowlist.")
+@click.option("--count", is_flag=True, help="Print how many are and aren't in the allowlist instead.")
+def check_command(input_file: typing.TextIO, field: int, denied: bool, count: bool) -> None:  # noqa: FBT001 Click flags
+    """Check the IPs in a file (or stdin), e.g. an access log, against the allowlist."""
+    assert al is not None  # noqa: S101 Appease mypy
+    fields = (line.split(None, field) for line in input_file)
+    results = al.check_many(parts[field - 1] for parts in fields if len(parts) >= field)
+    if count:
+        totals = {"yep": 0, "nope": 0}
+        for _, allowed in results:
+            totals["yep" if allowed else "nope"] += 1
+        click.echo(json.dumps(totals))
+        return
+
+    if denied:
+        results = (result for result in results if not result[1])
+    for lines in _result_lines(results):
+        click.echo(lines, nl=False)
 
 
 def check_password_static(password: str) -> bool:
     """Check password (secure) (I hope)."""
+    from argon2.exceptions import VerifyMismatchError
+
     password_correct = False
     hashed = current_app.config["auth"]["static"]["password_hashed"]
+    hasher = config.get_password_hasher(current_app.config["argon2"])
     try:
-        ph.verify(hashed, password)
+        with metrics.ARGON2_VERIFY_SECONDS.time(), tracing.span("argon2 verify"):
+            hasher.verify(hashed, password)
         password_correct = True
     except VerifyMismatchError:
         pass
 
+    if password_correct and hasher.check_needs_rehash(hashed):
+        _rehash_password(password)
+
     return password_correct
 
 
+def _rehash_password(password: str) -> None:
+    """Save the password hashed with the current argon2 costs, it was hashed with different ones."""
+    hashed = config.get_password_hasher(current_app.config["argon2"]).hash(password)
+    try:
+        # Loaded again rather than kept from startup, the file might have been edited since
+        ala_conf = config.AllowListAppConfig(instance_path=current_app.instance_path)
+        ala_conf.set_password_hash(hashed)
+    except Exception:  # The login still worked
+        logger.exception("Couldn't save the rehashed password")
+        return
+
+    current_app.config["auth"]["static"]["password_hashed"] = hashed
+    logger.info("Rehashed the password with the current argon2 costs")
+
+
 def check_password_url(username: str, password: str) -> bool:
     """Check password via Jellyfin (secure) (I hope)."""
+    import requests  # Only needed for remote auth, it's a slow import
+
     password_correct = False
 
     url = (
@@ -118,7 +310,8 @@ def check_password_url(username: str, password: str) -> bool:
 
     response = None
     try:
-        response = requests.post(url, headers=headers, data=json_data, timeout=5)
+        with metrics.REMOTE_AUTH_SECONDS.time(), tracing.span("remote auth", url=url):
+            response = requests.post(url, headers=headers, data=json_data, timeout=5)
     except requests.exceptions.ConnectionError:
         logger.error("Connection error for url: %s", url)  # noqa: TRY400 # We dont need to treat this as an exception
     except requests.exceptions.Timeout:
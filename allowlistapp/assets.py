@@ -0,0 +1,146 @@
+"""The home page and static assets, served so repeat visits cost next to nothing.
+
+The home page is rendered once, and again only if the redirect_url changes on a config reload, and it's served
+with an ETag so browsers just check it's the same.
+
+Everything in static/ is loaded at startup and served at /assets/<name>.<content hash>.<ext>, so it can be cached
+forever (Cache-Control: immutable), a new version gets a new URL. Text files are gzipped once at startup rather
+than per request, fonts are already compressed. The CSS refers to the fonts, so its font URLs are swapped for the
+hashed ones before it's hashed itself. The old /static/ URLs still work, they're just not cached.
+"""
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+
+from flask import Blueprint, Flask, Response, abort, current_app, render_template, request
+
+logger = logging.getLogger(__name__)
+bp = Blueprint("assets", __name__)
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"  # Cache it, but check the ETag every time
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "image/svg+xml")
+CSS_URL_PATTERN = re.compile(r"url\(\"/static/([^\"]+)\"\)")
+
+assets: dict[str, "Asset"] = {}  # By hashed name
+asset_names: dict[str, str] = {}  # Path in static/ to hashed name
+home_page: dict[str, "Asset"] = {}  # By redirect_url, the only thing on it that can change
+
+
+class Asset:
+    """A response body, gzipped once up front if it's worth it."""
+
+    def __init__(self, body: bytes, mimetype: str) -> None:
+        """Initialise the asset, this hashes and compresses it."""
+        self.body = body
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.gzipped = None
+        if mimetype.startswith(COMPRESSIBLE_TYPES):
+            gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gzipped) < len(body):
+                self.gzipped = gzipped
+
+    def response(self, cache_control: str) -> Response:
+        """Respond with the asset, a 304 if the client has it already, gzipped if the client takes that."""
+        gzip_ok = self.gzipped is not None and "gzip" in request.headers.get("Accept-Encoding", "")
+        response = Response(self.gzipped if gzip_ok else self.body, mimetype=self.mimetype)
+        response.headers["Cache-Control"] = cache_control
+        if self.gzipped is not None:
+            response.headers["Vary"] = "Accept-Encoding"
+        if gzip_ok:
+            response.headers["Content-Encoding"] = "gzip"
+            response.set_etag(f"{self.digest}-gz")  # Different bytes need a different ETag
+        else:
+            response.set_etag(self.digest)
+        response.make_conditional(request)  # Turns it into a 304 if the ETag matches
+        return response
+
+
+def asset_url(path: str) -> str:
+    """The hashed URL for a file in static/, relative so it works under a path prefix like the rest of the page."""
+    return f"assets/{asset_names[path]}"
+
+
+def _hashed_name(path: str, asset: Asset) -> str:
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{asset.digest}{ext}"
+
+
+def _hashed_css_urls(css: bytes, css_dir: str) -> bytes:
+    """Swap the /static/ URLs in a CSS file for the hashed ones, relative to where the CSS file is."""
+
+    def _replace(match: re.Match) -> str:
+        return f'url("{os.path.relpath(asset_names.get(match[1], match[1]), css_dir)}")'
+
+    return CSS_URL_PATTERN.sub(_replace, css.decode()).encode()
+
+
+def load_assets(static_folder: str) -> None:
+    """Load, hash and compress everything in the static folder."""
+    paths = []
+    for dir_path, _, file_names in os.walk(static_folder):
+        paths += [os.path.relpath(os.path.join(dir_path, name), static_folder) for name in file_names]
+
+    assets.clear()
+    asset_names.clear()
+    # The CSS refers to the other files, so those are done first
+    for path in sorted(paths, key=lambda path: (path.endswith(".css"), path)):
+        with open(os.path.join(static_folder, path), "rb") as static_file:
+            body = static_file.read()
+        if path.endswith(".css"):
+            body = _hashed_css_urls(body, os.path.dirname(path))
+
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        asset = Asset(body, mimetype)
+        asset_names[path] = _hashed_name(path, asset)
+        assets[asset_names[path]] = asset
+
+    logger.debug("Loaded %s static assets", len(assets))
+
+
+def render_home(redirect_url: str) -> Asset:
+    """Render the home page, or get the one already rendered."""
+    if redirect_url not in home_page:
+        html = render_template(
+            "home.html.j2",
+            hide_username=current_app.config["app"]["auth_type"] == "static",
+            redirect_url=redirect_url,
+        )
+        home_page.clear()
+        home_page[redirect_url] = Asset(html.encode(), "text/html")
+    return home_page[redirect_url]
+
+
+@bp.route("/", methods=["GET"])
+def home() -> Response:
+    """Flask Home."""
+    redirect_url = current_app.config["app"]["redirect_url"]  # Can change on a config reload
+    return render_home(redirect_url).response(REVALIDATE)
+
+
+@bp.route("/assets/<path:name>", methods=["GET"])
+def serve_asset(name: str) -> Response:
+    """Serve a hashed asset, they never change so they're cached for good."""
+    asset = assets.get(name)
+    if asset is None:
+        abort(404)
+    return asset.response(IMMUTABLE)
+
+
+def start_assets(app: Flask) -> None:
+    """Load the static assets, render the home page and serve them."""
+    assert app.static_folder is not None  # noqa: S101 Appease mypy
+    load_assets(app.static_folder)
+    app.jinja_env.globals["asset_url"] = asset_url
+    home_page.clear()
+    with app.app_context():
+        render_home(app.config["app"]["redirect_url"])
+    app.register_blueprint(bp)
+
+
+logger.debug("Loaded module: %s", __name__)
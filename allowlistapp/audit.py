@@ -0,0 +1,241 @@
+"""Audit log of authentication attempts, kept apart from the app log.
+
+Each attempt is a JSON line: {"t": unix time, "ip": "", "user": "", "result": "success" or "failure", "ms": auth
+latency}. Requests only put records on a queue, a background thread appends them in batches to audit.jsonl in
+the audit dir. When that gets too big it's renamed to audit-<time it was rotated>.jsonl, so sorting the file names
+puts them in order, and the oldest ones past backup_count are deleted.
+
+flask audit search scans them, it checks the raw bytes of each line against the filters before parsing it.
+"""
+
+import atexit
+import collections
+import contextlib
+import datetime
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterator
+
+import click
+from flask import Flask, current_app
+from flask.cli import AppGroup
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+cli = AppGroup("audit", help="Search the authentication audit log.")
+
+CURRENT_FILE = "audit.jsonl"
+ROTATED_GLOB = "audit-*.jsonl"
+READ_CHUNK_BYTES = 4 * 1024 * 1024
+
+audit_log: "AuditLog | None" = None
+
+
+class AuditLog:
+    """Queues audit records and appends them to the audit files from a background thread."""
+
+    def __init__(self, audit_conf: dict) -> None:
+        """Initialise the audit log.
+
+        Args:
+            audit_conf: The audit configuration {"path": "", "max_bytes": int, "backup_count": int,
+                "flush_interval": float, "queue_size": int}
+        """
+        self.path = audit_conf["path"]
+        self.max_bytes = audit_conf["max_bytes"]
+        self.backup_count = audit_conf["backup_count"]
+        self.flush_interval = audit_conf["flush_interval"]
+        self.queue_size = audit_conf["queue_size"]
+        os.makedirs(self.path, exist_ok=True)
+
+        self._pending: collections.deque[str] = collections.deque()
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="audit-flusher", daemon=True)
+        self._thread.start()
+
+    def record(self, ip: str, username: str, result: bool, seconds: float) -> None:  # noqa: FBT001 Matches the auth result
+        """Queue a record of an authentication attempt, this never touches the disk."""
+        if len(self._pending) >= self.queue_size:
+            metrics.AUDIT_DROPPED_TOTAL.inc()
+            return
+
+        line = json.dumps(
+            {
+                "t": round(time.time(), 3),
+                "ip": ip,
+                "user": username,
+                "result": "success" if result else "failure",
+                "ms": round(seconds * 1000, 2),
+            },
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        self._pending.append(line + "\n")  # deque.append is thread safe
+
+    def flush(self) -> None:
+        """Append everything queued to the current file in one write."""
+        with self._flush_lock:
+            lines = []
+            while self._pending:
+                lines.append(self._pending.popleft())
+            if not lines:
+                return
+
+            with _locked(os.path.join(self.path, "audit.lock")):  # Other worker processes write here too
+                current_path = os.path.join(self.path, CURRENT_FILE)
+                with open(current_path, "a", encoding="utf8") as audit_file:
+                    audit_file.write("".join(lines))
+                    size = audit_file.tell()
+                if size >= self.max_bytes:
+                    self._rotate(current_path)
+
+    def _rotate(self, current_path: str) -> None:
+        """Rename the current file out of the way, and delete the oldest ones past backup_count."""
+        now = datetime.datetime.now(tz=datetime.timezone.utc)  # noqa: UP017 datetime.UTC is 3.11+
+        stamp = now.strftime("%Y%m%dT%H%M%S.%fZ")
+        os.replace(current_path, os.path.join(self.path, f"audit-{stamp}.jsonl"))
+        for old_path in sorted(glob.glob(os.path.join(self.path, ROTATED_GLOB)))[: -self.backup_count or None]:
+            os.remove(old_path)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Couldn't write the audit log")
+
+
+@contextlib.contextmanager
+def _locked(lock_path: str) -> Iterator[None]:
+    with open(lock_path, "a+b") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def audit_files(path: str) -> list[str]:
+    """The audit files, oldest first."""
+    files = sorted(glob.glob(os.path.join(path, ROTATED_GLOB)))
+    current_path = os.path.join(path, CURRENT_FILE)
+    if os.path.exists(current_path):
+        files.append(current_path)
+    return files
+
+
+def search(  # noqa: PLR0913 They're all filters
+    path: str,
+    since: float | None = None,
+    until: float | None = None,
+    ip: str | None = None,
+    username: str | None = None,
+    result: str | None = None,
+) -> Iterator[dict]:
+    """Find the records matching every filter given, oldest first."""
+    # Lines are written by json.dumps with the keys in a fixed order and no spaces, so a filter can be checked on
+    # the raw line first, and most lines never need parsing
+    needles = []
+    if ip is not None:
+        needles.append(f'"ip":{json.dumps(ip)},'.encode())
+    if username is not None:
+        needles.append(f'"user":{json.dumps(username, ensure_ascii=False)},'.encode())
+    if result is not None:
+        needles.append(f'"result":"{result}"'.encode())
+
+    for file_path in audit_files(path):
+        # Nothing in a file is newer than its last write
+        if since is not None and os.path.getmtime(file_path) < since:
+            continue
+
+        for line in _read_lines(file_path, needles[0] if needles else b""):
+            if not all(needle in line for needle in needles[1:]):
+                continue
+            record = json.loads(line)
+            if (since is not None and record["t"] < since) or (until is not None and record["t"] >= until):
+                continue
+            yield record
+
+
+def _read_lines(file_path: str, needle: bytes) -> Iterator[bytes]:
+    """Read the complete lines with needle in them, a line still being written is left out.
+
+    The file is read in big chunks and searched for the needle, so lines without it aren't even split out.
+    """
+    with open(file_path, "rb") as audit_file:
+        leftover = b""
+        while chunk := audit_file.read(READ_CHUNK_BYTES):
+            data = leftover + chunk
+            end = data.rfind(b"\n") + 1
+            data, leftover = data[:end], data[end:]
+            if not needle:
+                yield from data.splitlines()
+                continue
+
+            position = data.find(needle)
+            while position != -1:
+                line_start = data.rfind(b"\n", 0, position) + 1
+                line_end = data.find(b"\n", position)
+                yield data[line_start:line_end]
+                position = data.find(needle, line_end)
+
+
+def start_audit(app: Flask) -> None:
+    """Start the audit log if it's enabled."""
+    global audit_log  # noqa: PLW0603 Needed due to how flask loads modules.
+    audit_log = None  # Prevents tests from getting weird
+
+    audit_conf = app.config["audit"]
+    if audit_conf["enabled"]:
+        audit_log = AuditLog(audit_conf)
+        atexit.register(audit_log.flush)
+        logger.info("Writing the audit log to: %s", audit_conf["path"])
+
+    app.cli.add_command(cli)
+
+
+def _parse_time(value: str | None) -> float | None:
+    """Parse an ISO 8601 time, naive ones are local time."""
+    if value is None:
+        return None
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+@cli.command("search")
+@click.option("--since", help="Only records from this time on, ISO 8601, e.g. 2024-06-01T12:00.")
+@click.option("--until", help="Only records before this time, ISO 8601.")
+@click.option("--ip", help="Only this IP.")
+@click.option("--user", "username", help="Only this username.")
+@click.option("--result", type=click.Choice(["success", "failure"]), help="Only this result.")
+@click.option("--count", is_flag=True, help="Print counts by result instead of the records.")
+@click.option("--path", default="", help="Audit dir, defaults to the configured one.")
+def search_command(  # noqa: PLR0913 They're all options
+    since: str | None,
+    until: str | None,
+    ip: str | None,
+    username: str | None,
+    result: str | None,
+    count: bool,  # noqa: FBT001 Click flag
+    path: str,
+) -> None:
+    """Print the matching audit records as JSON lines."""
+    records = search(
+        path or current_app.config["audit"]["path"], _parse_time(since), _parse_time(until), ip, username, result
+    )
+    if count:
+        counts = collections.Counter(record["result"] for record in records)
+        click.echo(json.dumps(dict(counts)))
+        return
+
+    for record in records:
+        click.echo(json.dumps(record, separators=(",", ":"), ensure_ascii=False))
+
+
+logger.debug("Loaded module: %s", __name__)
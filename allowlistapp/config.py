@@ -1,19 +1,32 @@
 """Config Processing."""
 
 import contextlib
+import copy
+import functools
 import logging
 import os
 import pwd
+import sys
+import time
 import typing
 
 import tomlkit
-from argon2 import PasswordHasher
+
+if sys.version_info >= (3, 11):  # noqa: UP036 We still support 3.10
+    import tomllib  # Can't write, but it reads a lot quicker than tomlkit
+
+if typing.TYPE_CHECKING:
+    from argon2 import PasswordHasher
 
 # This means that the logger will have the right name, logging should be done with this object
 logger = logging.getLogger(__name__)
 
 VALID_URL_AUTH_TYPES = ["static", "jellyfin"]
-ph = PasswordHasher()
+
+ARGON2_MIN_MEMORY_KIB = 19 * 1024  # OWASP's lowest recommended argon2id settings
+ARGON2_MIN_TIME_COST = 2
+ARGON2_MAX_TIME_COST = 10
+ARGON2_MAX_PARALLELISM = 4
 
 
 # Default config dictionary, also works as a schema
@@ -24,8 +37,18 @@ DEFAULT_CONFIG: dict[str, dict] = {
         "revert_daily": True,
         "redirect_url": "",
         "db_path": "",
+        "ipv6_prefix": 64,  # Clients are allowed the whole network of this size, not just their address
+        "ipv4_prefix": 32,
+    },
+    "database": {"durability": "write", "group_commit_ms": 5},
+    "expiry": {
+        "enabled": False,
+        "idle_days": 30,  # 0 is no limit
+        "max_per_user": 0,  # 0 is no limit
+        "flush_interval": 60,
+        "check_interval": 3600,
     },
-    "services": {"nginx": {"enabled": False, "allowlist_path": ""}},
+    "services": {"nginx": {"enabled": False, "allowlist_path": "", "shard_mode": "none", "shard_count": 16}},
     "auth": {
         "remote": {"url": ""},
         "static": {
@@ -36,6 +59,68 @@ DEFAULT_CONFIG: dict[str, dict] = {
     "logging": {
         "level": "INFO",
         "path": "",
+        "format": "text",
+        "queue": False,
+        "queue_size": 10000,
+        "overflow": "drop",
+    },
+    "metrics": {"enabled": False},
+    "health": {"max_in_flight_auth": 0, "retry_after": 1},  # 0 is no limit
+    "argon2": {
+        "target_ms": 0,  # Calibrate the costs to take about this long to verify, 0 keeps the library defaults
+        "max_memory_kib": 65536,
+        "time_cost": 0,  # Set by the calibration, set them to 0 to calibrate again
+        "memory_cost": 0,
+        "parallelism": 0,
+    },
+    "check_many": {"enabled": False, "token": ""},
+    "audit": {
+        "enabled": False,
+        "path": "",
+        "max_bytes": 10_000_000,
+        "backup_count": 10,
+        "flush_interval": 1.0,
+        "queue_size": 100_000,
+    },
+    "events": {
+        "enabled": False,
+        "token": "",  # Required, the stream has every username and IP in it
+        "max_streams": 2,  # Each open stream holds a waitress thread, keep this below threads
+        "poll_interval": 0.5,
+        "heartbeat_interval": 15.0,
+    },
+    "replication": {
+        "enabled": False,
+        "token": "",
+        "peers": [],
+        "interval": 5.0,
+        "anti_entropy_interval": 300.0,
+    },
+    "tracing": {
+        "enabled": False,
+        "sample_rate": 1.0,
+        "path": "",
+        "max_bytes": 10_000_000,
+        "backup_count": 5,
+    },
+    "profiling": {
+        "enabled": False,
+        "sample_rate": 0.01,
+        "path": "",
+        "max_files": 1000,  # The oldest profiles are deleted past this, 0 for no limit
+    },
+    "waitress": {  # Passed to waitress.serve by allowlistapp-serve, any waitress option can be added
+        "host": "127.0.0.1",
+        "port": 8080,
+        "unix_socket": "",  # Listen here instead of host and port if set
+        "unix_socket_perms": "660",
+        "threads": 4,
+        "connection_limit": 100,
+        "backlog": 1024,
+        "channel_timeout": 120,
+        "trusted_proxy": "*",  # The app is behind nginx, which sets X-Forwarded-For
+        "trusted_proxy_headers": "x-forwarded-for",
+        "clear_untrusted_proxy_headers": True,
     },
     "flask": {  # This section is for Flask default config entries https://flask.palletsprojects.com/en/3.0.x/config/
         "DEBUG": False,
@@ -44,6 +129,68 @@ DEFAULT_CONFIG: dict[str, dict] = {
 }
 
 
+def get_password_hasher(argon2_conf: dict | None = None) -> "PasswordHasher":
+    """Get the argon2 hasher, argon2 is only imported when static auth is actually used.
+
+    It has the costs from argon2_conf, or the library defaults if they aren't all set.
+    """
+    argon2_conf = argon2_conf or {}
+    return _password_hasher(
+        argon2_conf.get("time_cost", 0), argon2_conf.get("memory_cost", 0), argon2_conf.get("parallelism", 0)
+    )
+
+
+@functools.cache
+def _password_hasher(time_cost: int, memory_cost: int, parallelism: int) -> "PasswordHasher":
+    from argon2 import PasswordHasher
+
+    if not (time_cost and memory_cost and parallelism):
+        return PasswordHasher()
+    return PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+
+
+def calibrate_argon2(target_ms: float, max_memory_kib: int) -> dict:
+    """Find argon2 costs that take about target_ms to verify on this machine, returns them as config.
+
+    The memory cost is halved from max_memory_kib until one pass takes at most half the target, then as many
+    passes are added as fit. It never goes below the OWASP minimum (19MiB, two passes), however slow that is.
+    """
+    parallelism = min(os.cpu_count() or 1, ARGON2_MAX_PARALLELISM)
+    memory_cost = max(max_memory_kib, ARGON2_MIN_MEMORY_KIB)
+    pass_ms = _time_argon2(1, memory_cost, parallelism)
+    while pass_ms * ARGON2_MIN_TIME_COST > target_ms and memory_cost > ARGON2_MIN_MEMORY_KIB:
+        memory_cost = max(memory_cost // 2, ARGON2_MIN_MEMORY_KIB)
+        pass_ms = _time_argon2(1, memory_cost, parallelism)
+
+    time_cost = max(ARGON2_MIN_TIME_COST, min(ARGON2_MAX_TIME_COST, int(target_ms / pass_ms)))
+    costs = {"time_cost": time_cost, "memory_cost": memory_cost, "parallelism": parallelism}
+    verify_ms = _time_argon2(time_cost, memory_cost, parallelism)
+    if verify_ms > target_ms:
+        logger.warning("Argon2 takes %.0fms at the lowest safe costs, over the %sms target", verify_ms, target_ms)
+    logger.info("Calibrated argon2 to %.0fms (target %sms): %s", verify_ms, target_ms, costs)
+    return costs
+
+
+def _time_argon2(time_cost: int, memory_cost: int, parallelism: int) -> float:
+    """Time hashing with some costs in ms, the best of two, verifying takes the same."""
+    from argon2 import PasswordHasher
+
+    hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+    timings = []
+    for _ in range(2):
+        started = time.perf_counter()
+        hasher.hash("calibration")
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+def _plain(config: dict) -> dict:
+    """A plain copy of a config's values, that later changes to the config don't touch."""
+    if isinstance(config, tomlkit.TOMLDocument):
+        return config.unwrap()
+    return copy.deepcopy(config)
+
+
 class ConfigPasswordError(Exception):
     """Custom exception for password issues."""
 
@@ -82,20 +229,22 @@ class AllowListAppConfig:
         """
         self._config_path: str | None = None
         self._config: dict = DEFAULT_CONFIG
+        self._saved_config: dict | None = None  # What's in the config file, so we only write when it changes
         self.instance_path: str = instance_path
 
         self._get_config_file_path()
 
         if not config:  # If no config is passed in (for testing), we load from a file.
             config = self._load_file()
+        else:
+            self._read_saved_config()  # So saving the passed in config is skipped if the file has it already
 
         self._config = self._merge_with_defaults(DEFAULT_CONFIG, config)
 
-        self._write_config()
-
-        self._validate_config()
-
-        self._write_config()
+        try:
+            self._validate_config()
+        finally:
+            self._save_config()  # Even if it doesn't validate, so new default entries are there to fill in
 
         logger.info("Configuration loaded successfully!")
 
@@ -120,15 +269,25 @@ class AllowListAppConfig:
         """Return dictionary items of configuration."""
         return self._config.items()
 
+    def _save_config(self) -> None:
+        """Write configuration to a file, only if it's different to what is already there."""
+        # Comparing the values is cheap, serialising them with tomlkit isn't
+        if _plain(self._config) != self._saved_config:
+            self._write_config()
+        else:
+            logger.debug("Config unchanged, not writing")
+
     def _write_config(self) -> None:
         """Write configuration to a file."""
         if not self._config_path:  # Appease mypy
             msg = "Config path not set, cannot write config"
             raise ValueError(msg, self._config_path)
 
+        config_str = tomlkit.dumps(self._config)
         try:
             with open(self._config_path, "w", encoding="utf8") as toml_file:
-                tomlkit.dump(self._config, toml_file)
+                toml_file.write(config_str)
+            self._saved_config = _plain(self._config)
         except PermissionError as exc:
             user_account = pwd.getpwuid(os.getuid())[0]
             err = f"Fix permissions: chown {user_account} {self._config_path}"
@@ -145,6 +304,13 @@ class AllowListAppConfig:
             error = "['flask']['TESTING'] is True but instance_path is not a tmp_path"
             failed_items.append(error)
 
+        if self._config["services"]["nginx"]["shard_mode"] not in ("none", "user", "hash"):
+            failed_items.append("['services']['nginx']['shard_mode'] has to be one of: none, user, hash")
+
+        failed_items += self._check_config_prefixes()
+
+        failed_items += self._check_config_tokens()
+
         self._warn_unexpected_keys(DEFAULT_CONFIG, self._config, "<root>")
 
         # If the config doesn't validate, we exit.
@@ -155,8 +321,21 @@ class AllowListAppConfig:
         if self._config["app"]["db_path"] == "":
             self._config["app"]["db_path"] = os.path.join(self.instance_path, "database.csv")
 
+        # Ensure audit log dir is set
+        if self._config["audit"]["path"] == "":
+            self._config["audit"]["path"] = os.path.join(self.instance_path, "audit")
+
+        # Ensure trace file path is set
+        if self._config["tracing"]["path"] == "":
+            self._config["tracing"]["path"] = os.path.join(self.instance_path, "traces.jsonl")
+
+        # Ensure profile output path is set
+        if self._config["profiling"]["path"] == "":
+            self._config["profiling"]["path"] = os.path.join(self.instance_path, "profiles")
+
         # Now we check the passwords
         if self._config["app"]["auth_type"] == "static":
+            self._calibrate_argon2()
             (
                 self._config["auth"]["static"]["password_cleartext"],
                 self._config["auth"]["static"]["password_hashed"],
@@ -164,12 +343,33 @@ class AllowListAppConfig:
         else:
             self._check_config_url_auth()
 
+    def _check_config_tokens(self) -> list[str]:
+        """Check the endpoints that give out the allowlist have a token, and the events streams leave threads over."""
+        failed_items = [
+            f"['{section}']['token'] has to be set when {section} is enabled"
+            for section in ("replication", "events", "check_many")
+            if self._config[section]["enabled"] and not self._config[section]["token"]
+        ]
+        if self._config["events"]["enabled"] and not (
+            0 < self._config["events"]["max_streams"] < self._config["waitress"]["threads"]
+        ):
+            failed_items.append("['events']['max_streams'] has to be from 1 to below ['waitress']['threads']")
+        return failed_items
+
+    def _check_config_prefixes(self) -> list[str]:
+        """Check the client network prefixes fit their IP version."""
+        return [
+            f"['app']['{version}_prefix'] has to be from 1 to {max_prefix}"
+            for version, max_prefix in (("ipv6", 128), ("ipv4", 32))
+            if not 0 < self._config["app"][f"{version}_prefix"] <= max_prefix
+        ]
+
     def _warn_unexpected_keys(self, target_dict: dict, base_dict: dict, parent_key: str) -> dict:
         """If the loaded config has a key that isn't in the schema (default config), we log a warning.
 
         This is recursive, be careful.
         """
-        if parent_key != "flask":
+        if parent_key not in ("flask", "waitress"):  # These are passed straight through
             for key, value in base_dict.items():
                 if isinstance(value, dict) and key in target_dict:
                     self._warn_unexpected_keys(target_dict[key], value, key)
@@ -191,7 +391,7 @@ class AllowListAppConfig:
             if isinstance(value, dict) and key in target_dict:
                 self._merge_with_defaults(value, target_dict[key])
             elif key not in target_dict:
-                target_dict[key] = target_dict.get(key, value)
+                target_dict[key] = copy.deepcopy(value)  # Copy so that changing the config never changes the defaults
 
         return target_dict
 
@@ -229,7 +429,23 @@ class AllowListAppConfig:
             raise ValueError(msg, self._config_path)
 
         with open(self._config_path, encoding="utf8") as toml_file:
-            return tomlkit.load(toml_file)
+            config = tomlkit.load(toml_file)
+
+        self._saved_config = config.unwrap()
+        return config
+
+    def _read_saved_config(self) -> None:
+        """Read what's in the config file without using it, for comparing with what we'd save."""
+        if not self._config_path:  # Appease mypy
+            msg = "Config path not set, cannot load config"
+            raise ValueError(msg, self._config_path)
+
+        # A file that doesn't parse is left as None, so it's written over like a missing one
+        with contextlib.suppress(FileNotFoundError, ValueError), open(self._config_path, "rb") as toml_file:
+            if sys.version_info >= (3, 11):  # noqa: UP036 We still support 3.10
+                self._saved_config = tomllib.load(toml_file)
+            else:
+                self._saved_config = tomlkit.load(toml_file).unwrap()
 
     def _check_config_static_password(self, config: dict) -> tuple[str, str]:
         """Check the password parameters in the config."""
@@ -241,7 +457,7 @@ class AllowListAppConfig:
         if config["auth"]["static"]["password_cleartext"] != "":
             logger.info("Plaintext password set, hashing and removing from config file")
             plaintext = config["auth"]["static"]["password_cleartext"]
-            hashed = ph.hash(plaintext)
+            hashed = get_password_hasher(config["argon2"]).hash(plaintext)
             config["auth"]["static"]["password_hashed"] = hashed
             config["auth"]["static"]["password_cleartext"] = ""
         else:
@@ -249,6 +465,19 @@ class AllowListAppConfig:
 
         return config["auth"]["static"]["password_cleartext"], config["auth"]["static"]["password_hashed"]
 
+    def _calibrate_argon2(self) -> None:
+        """Calibrate the argon2 costs if there's a target and they haven't been yet, they're saved in the config."""
+        argon2_conf = self._config["argon2"]
+        if argon2_conf["target_ms"] > 0 and not (
+            argon2_conf["time_cost"] and argon2_conf["memory_cost"] and argon2_conf["parallelism"]
+        ):
+            argon2_conf.update(calibrate_argon2(argon2_conf["target_ms"], argon2_conf["max_memory_kib"]))
+
+    def set_password_hash(self, hashed: str) -> None:
+        """Replace the static password hash, and save it."""
+        self._config["auth"]["static"]["password_hashed"] = hashed
+        self._save_config()
+
     def _check_config_url_auth(self) -> None:
         """Check the remote parameters in the settings."""
         if self._config["app"]["auth_type"] not in VALID_URL_AUTH_TYPES:
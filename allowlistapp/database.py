@@ -1,25 +1,180 @@
 """Handles the database of the app."""
 
+import atexit
+import contextlib
 import csv
+import fcntl
 import logging
+import os
+import stat
+import threading
+import time
+import typing
+from collections.abc import Callable, Iterator
 
 from flask import current_app
 
+from . import metrics, tracing
+
 logger = logging.getLogger(__name__)
 
 
 CSV_SCHEMA = {"username": "", "ip": "", "date": ""}
 
+# write: write every change, let the OS flush it. fsync: write and sync every change before returning.
+# group: sync every change, changes arriving within group_commit_ms share one write and sync.
+# async: like group, but requests don't wait for the write.
+DURABILITY_MODES = ("write", "fsync", "group", "async")
+
 database_path: str | None = None
+durability = "write"
+group_commit_seconds = 0.005
+
+
+class _DatabaseLock:
+    """Exclusive lock on <db_path>.lock, held across processes with flock and across threads with an RLock.
+
+    flock locks belong to the open file, so everything in this process has to share this one object.
+    """
+
+    def __init__(self) -> None:
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._lock_file: typing.IO | None = None
+
+    @contextlib.contextmanager
+    def hold(self, lock_path: str) -> Iterator[None]:
+        with self._thread_lock:
+            if self._depth == 0:
+                if self._lock_file is None or self._lock_file.name != lock_path:
+                    if self._lock_file:
+                        self._lock_file.close()
+                    self._lock_file = open(lock_path, "a+b")  # noqa: SIM115 Kept open to hold the lock
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0 and self._lock_file:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+
+_lock = _DatabaseLock()
+
+
+class _Committer:
+    """Background writer for the group and async durability modes.
+
+    Writes that pile up while one is waiting are merged, only the latest allowlist gets written and synced.
+    Each write gets a ticket, a ticket is done once a write that started after it has finished.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._snapshot: Callable[[], list] | None = None
+        self._callbacks: dict[Callable[[], None], None] = {}  # Ordered set
+        self._requested = 0
+        self._written = 0
+        self._failed = 0
+        self._error: BaseException | None = None
+        self._thread: threading.Thread | None = None
+
+    def submit(self, snapshot: Callable[[], list], on_written: Callable[[], None] | None) -> int:
+        """Queue a write, returns the ticket to wait on."""
+        with self._cond:
+            self._snapshot = snapshot
+            if on_written:
+                self._callbacks[on_written] = None
+            self._requested += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="database-committer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return self._requested
+
+    def wait(self, ticket: int) -> None:
+        """Wait until the write for a ticket is on disk, raises if it failed."""
+        with self._cond:
+            while self._written < ticket and self._failed < ticket:
+                self._cond.wait()
+            if self._written < ticket and self._error:
+                raise self._error
+
+    def flush(self) -> None:
+        """Wait for everything queued so far."""
+        with self._cond:
+            ticket = self._requested
+        self.wait(ticket)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._requested == max(self._written, self._failed):
+                    self._cond.wait()
+
+            time.sleep(group_commit_seconds)  # Let the other requests in this burst join the write
+
+            with self._cond:
+                snapshot, callbacks = self._snapshot, list(self._callbacks)
+                self._callbacks = {}
+                ticket = self._requested
+                merged = ticket - max(self._written, self._failed)
+            assert snapshot is not None  # noqa: S101 Appease mypy, always set by submit
+
+            try:
+                with db_lock():
+                    _timed_write(snapshot(), sync=True)
+                    for callback in callbacks:
+                        callback()
+            except Exception as exc:
+                logger.exception("Background database write failed")
+                with self._cond:
+                    self._failed, self._error = ticket, exc
+                    self._cond.notify_all()
+            else:
+                with self._cond:
+                    self._written = ticket
+                    self._cond.notify_all()
+            metrics.DB_GROUP_COMMIT_WRITES.observe(merged)
+
+
+_committer = _Committer()
+atexit.register(_committer.flush)
+
+
+class Commit:
+    """A database write, wait() returns once it's as durable as the durability mode promises."""
+
+    def __init__(self, ticket: int | None = None) -> None:
+        """Initialise the commit, without a ticket it's already done."""
+        self.ticket = ticket
+
+    def wait(self) -> None:
+        """Wait for the write, only blocks in group mode."""
+        if self.ticket is not None and durability == "group":
+            _committer.wait(self.ticket)
 
 
 def start_database() -> None:
     """Start this module."""
-    global database_path  # noqa: PLW0603 Needed due to how flask loads modules.
+    global database_path, durability, group_commit_seconds  # noqa: PLW0603 Needed due to how flask loads modules.
+    database_conf = current_app.config["database"]
     database_path = current_app.config["app"]["db_path"]
+    durability = database_conf["durability"]
+    if durability not in DURABILITY_MODES:
+        logger.warning("Invalid database durability: %s, valid modes: %s, using write", durability, DURABILITY_MODES)
+        durability = "write"
+    group_commit_seconds = database_conf["group_commit_ms"] / 1000
     db_check()
 
 
+def db_lock() -> contextlib.AbstractContextManager[None]:
+    """Lock the database against changes from other threads and processes, this is re-entrant."""
+    assert database_path is not None  # noqa: S101 Appease mypy, this module should be an object
+    return _lock.hold(database_path + ".lock")
+
+
 def db_get_allowlist() -> list:
     """Get the allowlist as a dict."""
     assert database_path is not None  # noqa: S101 Appease mypy, this module should be an object
@@ -37,22 +192,32 @@ def db_get_allowlist() -> list:
 
 def db_write_allowlist(allowlist: list) -> None:
     """Insert an IP into the allowlist, returns if an IP has been inserted."""
-    assert database_path is not None  # noqa: S101 Appease mypy, this module should be an object
-    with open(database_path, "w", newline="") as csv_file:
-        csv_writer = csv.DictWriter(
-            csv_file,
-            CSV_SCHEMA.keys(),
-            delimiter=",",
-            quotechar='"',
-            quoting=csv.QUOTE_MINIMAL,
-        )
-        csv_writer.writeheader()
-        for item in allowlist:
-            csv_writer.writerow(item)
+    _timed_write(allowlist, sync=durability != "write")
 
     logger.info("DB write complete.")
 
 
+def db_commit_allowlist(snapshot: Callable[[], list], on_written: Callable[[], None] | None = None) -> Commit:
+    """Write the allowlist the way the durability mode says, call with the lock held.
+
+    In the group and async modes the write happens later in the background, snapshot is called then (with the
+    lock held) to get the allowlist as it is at that point, and on_written right after the write.
+    Wait on the returned commit after releasing the lock, the background write needs it.
+    """
+    if durability in ("group", "async"):
+        return Commit(_committer.submit(snapshot, on_written))
+
+    db_write_allowlist(snapshot())
+    if on_written:
+        on_written()
+    return Commit()
+
+
+def db_flush() -> None:
+    """Wait for any background writes to finish."""
+    _committer.flush()
+
+
 def db_check() -> None:
     """Check the 'schema' of the database."""
     assert database_path is not None  # noqa: S101 Appease mypy, this module should be an object
@@ -78,13 +243,57 @@ def db_check() -> None:
 
 def db_reset() -> None:
     """Clear the database."""
-    assert database_path is not None  # noqa: S101 Appease mypy, this module should be an object
     logger.info("CLEARING THE DATABASE...")
-    with open(database_path, "w", newline="") as csv_file:
-        csv_writer = csv.DictWriter(
-            csv_file, CSV_SCHEMA.keys(), delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL
-        )
-        csv_writer.writeheader()
+    _write_csv([], sync=durability != "write")
+
+
+def _timed_write(allowlist: list, *, sync: bool) -> None:
+    with metrics.DB_WRITE_SECONDS.time(), tracing.span("db write", rows=len(allowlist), sync=sync):
+        _write_csv(allowlist, sync=sync)
+
+
+def _write_csv(allowlist: list, *, sync: bool = False) -> None:
+    """Replace the database file, readers see either the old file or the new one, never a partial one.
+
+    The new file is written next to the database and renamed over it while holding the lock, with sync it's also
+    on disk before this returns.
+    """
+    assert database_path is not None  # noqa: S101 Appease mypy, this module should be an object
+    tmp_path = f"{database_path}.{os.getpid()}.tmp"
+
+    with db_lock():
+        try:
+            with open(tmp_path, "w", newline="") as csv_file:
+                csv_writer = csv.DictWriter(
+                    csv_file,
+                    CSV_SCHEMA.keys(),
+                    delimiter=",",
+                    quotechar='"',
+                    quoting=csv.QUOTE_MINIMAL,
+                )
+                csv_writer.writeheader()
+                for item in allowlist:
+                    csv_writer.writerow(item)
+
+                if sync:
+                    csv_file.flush()
+                    os.fsync(csv_file.fileno())
+
+            with contextlib.suppress(FileNotFoundError):  # Keep the permissions of the existing database
+                os.chmod(tmp_path, stat.S_IMODE(os.stat(database_path).st_mode))
+
+            os.replace(tmp_path, database_path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+        if sync:  # The rename isn't durable until the directory is synced
+            dir_fd = os.open(os.path.dirname(os.path.abspath(database_path)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
 
 
 logger.debug("Loaded module: %s", __name__)
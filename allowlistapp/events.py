@@ -0,0 +1,124 @@
+"""Server-sent events stream of allowlist changes, for firewall sync scripts, dashboards and the like.
+
+GET /events streams every change from the journal as it happens, the event type is the change (add, remove, expire,
+reset) and the id is its sequence number. A new stream starts with a reset and an add for every entry, so the
+consumer doesn't need to read anything else. Reconnecting with Last-Event-ID carries on from there, or starts
+over with the whole allowlist if the journal doesn't go back that far.
+
+Each open stream holds a server thread for as long as the client stays, so only max_streams are allowed at once,
+leaving threads for the logins and /check_auth/. The token is always required, the stream has every IP in it.
+"""
+
+import hmac
+import json
+import logging
+import threading
+import time
+from collections.abc import Iterator
+
+from flask import Blueprint, Flask, Response, abort, current_app, request, stream_with_context
+
+from . import al_handler, ala_auth, database, journal
+
+logger = logging.getLogger(__name__)
+bp = Blueprint("events", __name__)
+
+STREAM_RETRY_AFTER = 30  # Streams last a long time, no point trying again straight away
+
+_stream_slots: threading.BoundedSemaphore | None = None
+
+
+def format_event(event: dict, *, with_id: bool = True) -> str:
+    """Format a journal event as a server-sent event."""
+    lines = f"event: {event['op']}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n"
+    if with_id:
+        lines = f"id: {event['seq']}\n{lines}"
+    return lines
+
+
+def _full_state(allowlist: al_handler.AllowList, follower: journal.Journal) -> list[str]:
+    """A reset and an add for every entry, and follow the journal from there."""
+    with database.db_lock():
+        entries = allowlist.snapshot()
+        seq = follower.latest_seq()
+        follower.seek(seq)
+
+    events = [{"seq": seq, "op": "reset"}] + [{"seq": seq, "op": "add", "entry": entry} for entry in entries]
+    # Only the last one gets the id, a client dropping out part way through has to start over
+    return [format_event(event, with_id=event is events[-1]) for event in events]
+
+
+def stream(
+    allowlist: al_handler.AllowList,
+    last_event_id: int | None,
+    poll_interval: float,
+    heartbeat_interval: float,
+) -> Iterator[str]:
+    """Stream the changes after last_event_id, or everything if it's None, forever."""
+    assert database.database_path is not None  # noqa: S101 Appease mypy
+    follower = journal.Journal(database.database_path)
+    try:
+        if last_event_id is None or not follower.seek(last_event_id):
+            yield from _full_state(allowlist, follower)
+
+        last_sent = time.monotonic()
+        while True:
+            if follower.changed():
+                events = follower.read_new()
+                lines = _full_state(allowlist, follower) if events is None else [format_event(e) for e in events]
+                if lines:
+                    yield "".join(lines)
+                    last_sent = time.monotonic()
+
+            if time.monotonic() - last_sent > heartbeat_interval:
+                yield ": keepalive\n\n"  # Comments are ignored by clients, this notices ones that have gone away
+                last_sent = time.monotonic()
+
+            time.sleep(poll_interval)
+    finally:
+        follower.close()
+
+
+@bp.route("/events", methods=["GET"])
+def events() -> Response:
+    """Stream the allowlist changes."""
+    assert ala_auth.al is not None  # noqa: S101 Appease mypy
+    events_conf = current_app.config["events"]
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {events_conf['token']}"):
+        abort(401)
+
+    assert _stream_slots is not None  # noqa: S101 Appease mypy
+    if not _stream_slots.acquire(blocking=False):
+        response = Response("too many streams", status=503, mimetype="text/plain")
+        response.headers["Retry-After"] = str(STREAM_RETRY_AFTER)
+        return response
+
+    last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_event_id"))
+    try:
+        since = int(last_event_id) if last_event_id else None
+    except ValueError:
+        since = None
+
+    response = Response(
+        stream_with_context(
+            stream(ala_auth.al, since, events_conf["poll_interval"], events_conf["heartbeat_interval"])
+        ),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # Stop nginx buffering the stream
+    )
+    response.call_on_close(_stream_slots.release)  # When the client goes away
+    return response
+
+
+def start_events(app: Flask) -> None:
+    """Serve the events stream if it's enabled."""
+    global _stream_slots  # noqa: PLW0603 Needed due to how flask loads modules.
+    _stream_slots = None  # Prevents tests from getting weird
+
+    if app.config["events"]["enabled"]:
+        _stream_slots = threading.BoundedSemaphore(app.config["events"]["max_streams"])
+        app.register_blueprint(bp)
+        logger.info("Serving allowlist changes at /events, at most %s at once", app.config["events"]["max_streams"])
+
+
+logger.debug("Loaded module: %s", __name__)
@@ -0,0 +1,128 @@
+"""Health and readiness endpoints, and shedding logins when too many are in progress.
+
+/healthz is only the process answering, it doesn't touch anything. /readyz checks the database, the nginx
+allowlist and the auth backend can be used, and is 503 if one can't.
+
+Logins are slow (argon2, remote auth, nginx reloads), with max_in_flight_auth set the logins past that many at once
+get a 503 with Retry-After straight away, rather than queueing and taking every thread from /check_auth/.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from flask import Blueprint, Flask, Response, current_app, g, jsonify, request
+
+from . import al_handler, ala_auth, config, database, metrics
+
+logger = logging.getLogger(__name__)
+bp = Blueprint("health", __name__)
+
+AUTH_ENDPOINT = "auth.authenticate"
+REMOTE_CHECK_TIMEOUT = 2
+REMOTE_CHECK_CACHE_SECONDS = 10  # Don't send a request to the auth backend every time /readyz is polled
+
+_auth_slots: threading.BoundedSemaphore | None = None
+_remote_check: tuple[float, str, str] | None = None  # (when, url, result)
+
+
+@bp.route("/healthz", methods=["GET"])
+def healthz() -> tuple[str, int]:
+    """The process is up."""
+    return "ok", 200
+
+
+@bp.route("/readyz", methods=["GET"])
+def readyz() -> tuple[Response, int]:
+    """Check everything needed to handle logins, each check is "ok", "disabled" or what's wrong."""
+    checks = {"storage": _check_storage(), "nginx": _check_nginx(), "auth": _check_auth()}
+    ready = all(result in ("ok", "disabled") for result in checks.values())
+    if not ready:
+        logger.warning("Not ready: %s", checks)
+    return jsonify(ready=ready, checks=checks), 200 if ready else 503
+
+
+def _check_storage() -> str:
+    if ala_auth.al is None or database.database_path is None:
+        return "allowlist not loaded"
+    if not os.access(database.database_path, os.R_OK | os.W_OK):
+        return f"can't read and write {database.database_path}"
+    if not os.access(os.path.dirname(database.database_path) or ".", os.W_OK):  # The journal rotation needs this
+        return f"can't write to {os.path.dirname(database.database_path)}"
+    return "ok"
+
+
+def _check_nginx() -> str:
+    nginx_conf = current_app.config["services"]["nginx"]
+    if not nginx_conf["enabled"]:
+        return "disabled"
+    if al_handler.nginx_allowlist is None:
+        return "nginx handler not loaded"
+    allowlist_path = nginx_conf["allowlist_path"]
+    if os.path.exists(allowlist_path) and not os.access(allowlist_path, os.W_OK):
+        return f"can't write {allowlist_path}"
+    if not os.access(os.path.dirname(allowlist_path) or ".", os.W_OK):
+        return f"can't write to {os.path.dirname(allowlist_path)}"
+    return "ok"
+
+
+def _check_auth() -> str:
+    if current_app.config["app"]["auth_type"] == "static":
+        try:
+            config.get_password_hasher(current_app.config["argon2"])
+        except ImportError:
+            return "argon2 not installed"
+        return "ok" if current_app.config["auth"]["static"]["password_hashed"] else "no password set"
+
+    global _remote_check  # noqa: PLW0603 Needed due to how flask loads modules.
+    url = current_app.config["auth"]["remote"]["url"]
+    if _remote_check and _remote_check[1] == url and time.monotonic() - _remote_check[0] < REMOTE_CHECK_CACHE_SECONDS:
+        return _remote_check[2]
+
+    import requests
+
+    try:
+        response = requests.get(url, timeout=REMOTE_CHECK_TIMEOUT)
+        result = "ok" if response.status_code < 500 else f"{url} returned {response.status_code}"  # noqa: PLR2004 5xx
+    except requests.RequestException as exc:
+        result = f"{url} unreachable: {type(exc).__name__}"
+    _remote_check = (time.monotonic(), url, result)
+    return result
+
+
+def _shed_auth() -> Response | None:
+    """Reject a login straight away if too many are in progress."""
+    if request.endpoint != AUTH_ENDPOINT or _auth_slots is None:
+        return None
+    if not _auth_slots.acquire(blocking=False):
+        metrics.AUTH_SHED_TOTAL.inc()
+        response = Response("busy", status=503, mimetype="text/plain")
+        response.headers["Retry-After"] = str(current_app.config["health"]["retry_after"])
+        return response
+    g.auth_slot = True
+    return None
+
+
+def _release_auth(_exc: BaseException | None) -> None:
+    if g.pop("auth_slot", False) and _auth_slots is not None:
+        _auth_slots.release()
+
+
+def start_health(app: Flask) -> None:
+    """Serve the health endpoints and start shedding logins if max_in_flight_auth is set."""
+    global _auth_slots, _remote_check  # noqa: PLW0603 Needed due to how flask loads modules.
+    _auth_slots = None  # Prevents tests from getting weird
+    _remote_check = None
+
+    app.register_blueprint(bp)
+
+    max_in_flight = app.config["health"]["max_in_flight_auth"]
+    if max_in_flight > 0:
+        _auth_slots = threading.BoundedSemaphore(max_in_flight)
+        app.before_request(_shed_auth)
+        app.teardown_request(_release_auth)
+        logger.info("Shedding logins past %s at once", max_in_flight)
+
+
+logger.debug("Loaded module: %s", __name__)
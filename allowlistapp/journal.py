@@ -0,0 +1,192 @@
+"""Change journal for the allowlist database, keeps multiple worker processes in sync.
+
+Every change to the allowlist is appended to <db_path>.journal as a JSON line with a sequence number, and the
+latest sequence number is kept in <db_path>.seq, which every process has memory mapped. Checking for changes
+from other processes is a read of that mapped counter, only when it moves is the journal read, and only from
+where this process got up to.
+
+Writers hold the database lock (database.db_lock) for the whole change. The database file can lag behind the
+journal (see the group and async durability modes), so loading the database always replays the journal on top,
+applying an event twice does nothing. When the journal gets too big it's replaced with an empty one, but only
+right after a write of the whole database, processes that notice (the inode changed) reload the whole database.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+SEQ_FORMAT = "<Q"
+SEQ_SIZE = struct.calcsize(SEQ_FORMAT)
+JOURNAL_MAX_BYTES = 1_000_000
+
+
+class Journal:
+    """A process's view of the change journal."""
+
+    def __init__(self, db_path: str) -> None:
+        """Open (and create if needed) the journal files for a database."""
+        self.journal_path = db_path + ".journal"
+        self.seq_path = db_path + ".seq"
+
+        self.seq = 0  # The last sequence number this process has applied
+        self._offset = 0  # How far into the journal this process has read
+        self._read_lock = threading.Lock()
+
+        with database.db_lock():
+            if not os.path.exists(self.seq_path) or os.path.getsize(self.seq_path) < SEQ_SIZE:
+                with open(self.seq_path, "wb") as seq_file:
+                    seq_file.write(bytes(SEQ_SIZE))
+            if not os.path.exists(self.journal_path):
+                open(self.journal_path, "ab").close()
+
+            with open(self.seq_path, "r+b") as seq_file:
+                self._seq_map = mmap.mmap(seq_file.fileno(), SEQ_SIZE)
+            self._journal_file = open(self.journal_path, "rb")  # noqa: SIM115 Lives as long as the object
+
+    def latest_seq(self) -> int:
+        """The latest sequence number written by any process."""
+        return struct.unpack_from(SEQ_FORMAT, self._seq_map)[0]
+
+    def changed(self) -> bool:
+        """Check if another process has made a change this process hasn't seen, this doesn't lock."""
+        return self.latest_seq() != self.seq
+
+    def replay(self) -> list[dict]:
+        """Read the whole journal, call with the lock held when loading the whole database."""
+        with self._read_lock:
+            self._reopen_if_rotated()
+            self._offset = 0
+            self.seq = 0
+        events = self.read_new() or []
+        self.seq = self.latest_seq()
+        return events
+
+    def read_new(self) -> list[dict] | None:
+        """Read the changes made since this process last synced.
+
+        Returns None if the journal was replaced, meaning the whole database has to be reloaded.
+        """
+        with self._read_lock:
+            if self._reopen_if_rotated():
+                logger.info("Journal was replaced, the whole database needs to be reloaded")
+                return None
+
+            self._journal_file.seek(self._offset)
+            data = self._journal_file.read()
+            # A writer might be part way through a line, leave that for next time
+            complete = data[: data.rfind(b"\n") + 1]
+            self._offset += len(complete)
+
+            events = []
+            for line in complete.splitlines():
+                event = json.loads(line)
+                if event["seq"] > self.seq:
+                    events.append(event)
+                    self.seq = event["seq"]
+
+            return events
+
+    def read_since(self, since: int, limit: int) -> tuple[list[dict], bool]:
+        """Read up to limit events after since, without moving this process's place in the journal.
+
+        Also returns if the journal still has everything after since, if not the reader has missed changes.
+        """
+        events = []
+        first_seq = None
+        with open(self.journal_path, "rb") as journal_file:
+            for line in journal_file:
+                if not line.endswith(b"\n"):
+                    break  # Still being written
+                event = json.loads(line)
+                if first_seq is None:
+                    first_seq = event["seq"]
+                if event["seq"] > since:
+                    events.append(event)
+                    if len(events) >= limit:
+                        break
+
+        return events, self._covers(since, first_seq)
+
+    def seek(self, seq: int) -> bool:
+        """Read the changes after seq next time, returns if the journal still has all of them."""
+        with self._read_lock:
+            self._reopen_if_rotated()
+            self._offset = 0
+            self.seq = seq
+            self._journal_file.seek(0)
+            first_line = self._journal_file.readline()
+
+        first_seq = json.loads(first_line)["seq"] if first_line.endswith(b"\n") else None
+        return self._covers(seq, first_seq)
+
+    def _covers(self, since: int, first_seq: int | None) -> bool:
+        """Check if a journal starting at first_seq has every change after since."""
+        latest = self.latest_seq()
+        return since == latest or (since < latest and first_seq is not None and first_seq <= since + 1)
+
+    def append(self, events: list[dict]) -> list[dict]:
+        """Number and append events to the journal, call with the lock held. Returns the numbered events."""
+        seq = self.latest_seq()
+        numbered = []
+        lines = []
+        for event in events:
+            seq += 1
+            numbered_event = {"seq": seq, **event}
+            numbered.append(numbered_event)
+            lines.append(json.dumps(numbered_event, separators=(",", ":")) + "\n")
+
+        with open(self.journal_path, "a", encoding="utf8") as journal_file:
+            journal_file.writelines(lines)
+
+        struct.pack_into(SEQ_FORMAT, self._seq_map, 0, seq)  # Only bump the counter once the events are there
+
+        # Our own events don't need to be read back
+        self._journal_file.seek(0, os.SEEK_END)
+        self._offset = self._journal_file.tell()
+        self.seq = seq
+
+        return numbered
+
+    def rotate_if_needed(self) -> None:
+        """Replace the journal with an empty one if it's too big.
+
+        Call with the lock held right after writing the whole database, everything in the journal has to be in it.
+        """
+        if os.path.getsize(self.journal_path) <= JOURNAL_MAX_BYTES:
+            return
+
+        logger.info("Journal over %s bytes, starting a new one", JOURNAL_MAX_BYTES)
+        tmp_path = self.journal_path + ".tmp"
+        open(tmp_path, "wb").close()  # Just creating it
+        os.replace(tmp_path, self.journal_path)
+        with self._read_lock:
+            self._reopen_if_rotated()
+
+    def _reopen_if_rotated(self) -> bool:
+        """Reopen the journal if it has been replaced, returns if it was."""
+        try:
+            rotated = os.stat(self.journal_path).st_ino != os.fstat(self._journal_file.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+            open(self.journal_path, "ab").close()  # Just creating it
+
+        if rotated:
+            self._journal_file.close()
+            self._journal_file = open(self.journal_path, "rb")  # noqa: SIM115 Lives as long as the object
+            self._offset = 0
+        return rotated
+
+    def close(self) -> None:
+        """Close the files."""
+        self._journal_file.close()
+        self._seq_map.close()
+
+
+logger.debug("Loaded module: %s", __name__)
@@ -0,0 +1,94 @@
+"""When each allowlist entry was last used, so entries nobody uses any more can be expired.
+
+A lookup that matches an entry only notes the time in memory. A background thread merges those into
+<db_path>.lastseen.json every flush_interval, under a lock so the worker processes each add theirs, keeping the
+latest time for each entry. The file is {ip: {username: unix time}}, entries that aren't in the allowlist any more
+are dropped from it when it's written.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterator
+
+logger = logging.getLogger(__name__)
+
+Key = tuple[str, str]  # (ip, username), same as the journal
+
+
+class LastSeen:
+    """Last used times of the allowlist entries, noted in memory and written to disk in batches."""
+
+    def __init__(self, db_path: str) -> None:
+        """Initialise the last seen times for a database, nothing is read until it's needed."""
+        self.path = db_path + ".lastseen.json"
+        self.lock_path = db_path + ".lastseen.lock"
+        self._pending: dict[Key, float] = {}
+        self._pending_lock = threading.Lock()  # Only ever held for a dict operation, lookups don't wait on the disk
+
+    def touch(self, item: dict) -> None:
+        """Note an entry was just used, this never touches the disk."""
+        with self._pending_lock:
+            self._pending[(item["ip"], item["username"])] = time.time()
+
+    def flush(self, allowlist: list[dict] | None = None) -> None:
+        """Merge the times noted since the last flush into the file, dropping entries not in allowlist if given."""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+
+        with _locked(self.lock_path):  # Other worker processes write here too
+            seen = self._read()
+            for key, seen_time in pending.items():
+                seen[key] = max(seen_time, seen.get(key, 0))
+            if allowlist is not None:
+                keys = {(item["ip"], item["username"]) for item in allowlist}
+                seen = {key: seen_time for key, seen_time in seen.items() if key in keys}
+            if pending or allowlist is not None:
+                self._write(seen)
+
+    def load(self) -> dict[Key, float]:
+        """The last seen times from every process, as of their last flush, and this process's up to now."""
+        with _locked(self.lock_path):
+            seen = self._read()
+        with self._pending_lock:
+            for key, seen_time in self._pending.items():
+                seen[key] = max(seen_time, seen.get(key, 0))
+        return seen
+
+    def _read(self) -> dict[Key, float]:
+        try:
+            with open(self.path, encoding="utf8") as seen_file:
+                by_ip = json.load(seen_file)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning("Couldn't read %s, starting it again", self.path)
+            return {}
+        return {(ip, username): seen_time for ip, users in by_ip.items() for username, seen_time in users.items()}
+
+    def _write(self, seen: dict[Key, float]) -> None:
+        by_ip: dict[str, dict[str, float]] = {}
+        for (ip, username), seen_time in seen.items():
+            by_ip.setdefault(ip, {})[username] = seen_time  # Not rounded, it's compared with when entries were added
+
+        write_path = self.path + ".tmp"
+        with open(write_path, "w", encoding="utf8") as seen_file:
+            json.dump(by_ip, seen_file, separators=(",", ":"))
+        os.replace(write_path, self.path)  # Readers never see half a file
+
+
+@contextlib.contextmanager
+def _locked(lock_path: str) -> Iterator[None]:
+    with open(lock_path, "a+b") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+logger.debug("Loaded module: %s", __name__)
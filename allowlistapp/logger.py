@@ -1,12 +1,21 @@
 """Setup the logger functionality for allowlistapp."""
 
+import atexit
+import datetime
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 from flask import Flask
 
+from . import metrics
+
 LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]  # Valid str logging levels.
 LOG_FORMAT = "%(asctime)s:%(levelname)s:%(name)s:%(message)s"  # This is the logging message format that I like.
+LOG_FORMATS = ["text", "json"]
+OVERFLOW_POLICIES = ["drop", "block"]  # When the log queue is full, drop the message or wait for space.
+HANDLER_NAMES = ("allowlistapp_console", "allowlistapp_file")  # The handlers we add, others (pytest's) are left be.
 
 
 # In flask the root logger doesn't have any handlers, its all in app.logger
@@ -19,6 +28,65 @@ LOG_FORMAT = "%(asctime)s:%(levelname)s:%(name)s:%(message)s"  # This is the log
 logger = logging.getLogger(__name__)  # This is where we log to in this module, following the standard of every module.
 
 
+class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line, for log shippers."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format the record as JSON."""
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, tz=datetime.timezone.utc).isoformat(),  # noqa: UP017 datetime.UTC is 3.11+
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(QueueHandler):
+    """Puts records on a bounded queue for the listener thread to write out, so request threads never do log I/O.
+
+    When the queue is full the record is dropped or waited on, depending on the overflow policy. Drops are counted,
+    and logged once there's room again.
+    """
+
+    def __init__(self, log_queue: queue.Queue, listener: QueueListener, overflow: str) -> None:
+        super().__init__(log_queue)
+        self._log_queue = log_queue
+        self.listener = listener
+        self.overflow = overflow
+        self.dropped = 0
+        self._stopped = False
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.overflow == "block":
+            self._log_queue.put(record)
+            return
+
+        try:
+            if self.dropped:
+                self._log_queue.put_nowait(self._dropped_record(self.dropped))
+                self.dropped = 0
+            self._log_queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.LOG_DROPPED_TOTAL.inc()
+
+    def stop(self) -> None:
+        """Stop the listener once everything queued has been written out."""
+        if not self._stopped:
+            self._stopped = True
+            atexit.unregister(self.stop)  # So reconfiguring doesn't pile up exit hooks holding old listeners
+            self.listener.stop()
+
+    def _dropped_record(self, dropped: int) -> logging.LogRecord:
+        return logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0, "Log queue was full, dropped %s messages", (dropped,), None
+        )
+
+
 # Pass in the whole app object to make it obvious we are configuring the logger object within the app object.
 def setup_logger(app: Flask, logging_conf: dict, in_logger: logging.Logger | None = None) -> None:
     """Setup the logger, set configuration per logging_conf.
@@ -34,6 +102,8 @@ def setup_logger(app: Flask, logging_conf: dict, in_logger: logging.Logger | Non
     # The root logger has no handlers initially in flask, app.logger does though.
     app.logger.handlers.clear()  # Remove the Flask default handlers
 
+    _remove_queue_handler(in_logger)  # Back to writing directly while we reconfigure
+
     # If the logger doesn't have a console handler (root logger doesn't by default)
     if not _has_console_handler(in_logger):
         _add_console_handler(in_logger)
@@ -49,9 +119,53 @@ def setup_logger(app: Flask, logging_conf: dict, in_logger: logging.Logger | Non
     logging.getLogger("werkzeug").setLevel(logging.DEBUG)  # Only will be used in dev, debug logs incoming requests.
     logging.getLogger("urllib3").setLevel(logging.WARNING)  # Bit noisy when set to info, used by requests module.
 
+    log_format = logging_conf.get("format", "text")
+    if log_format not in LOG_FORMATS:
+        logger.warning("❗ Invalid logging format: %s, defaulting to text", log_format)
+        log_format = "text"
+    formatter = JSONFormatter() if log_format == "json" else logging.Formatter(LOG_FORMAT)
+    for handler in _our_handlers(in_logger):
+        handler.setFormatter(formatter)
+
+    if logging_conf.get("queue", False):
+        _add_queue_handler(in_logger, logging_conf.get("queue_size", 10000), logging_conf.get("overflow", "drop"))
+
     logger.info("Logger configuration set!")
 
 
+def _our_handlers(in_logger: logging.Logger) -> list[logging.Handler]:
+    """The handlers added by this module."""
+    return [handler for handler in in_logger.handlers if handler.get_name() in HANDLER_NAMES]
+
+
+def _add_queue_handler(in_logger: logging.Logger, queue_size: int, overflow: str) -> None:
+    """Move our handlers behind a queue, written out by a listener thread."""
+    if overflow not in OVERFLOW_POLICIES:
+        logger.warning("❗ Invalid logging overflow policy: %s, defaulting to drop", overflow)
+        overflow = "drop"
+
+    handlers = _our_handlers(in_logger)
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        in_logger.removeHandler(handler)
+    queue_handler = _QueueHandler(log_queue, listener, overflow)
+    in_logger.addHandler(queue_handler)
+    listener.start()
+    atexit.register(queue_handler.stop)  # Write out whatever is left on the queue
+    logger.debug("Logging through a queue of %s, %s when full", queue_size, overflow)
+
+
+def _remove_queue_handler(in_logger: logging.Logger) -> None:
+    """Stop the queue listener, if there is one, and put our handlers back on the logger."""
+    for handler in in_logger.handlers[:]:
+        if isinstance(handler, _QueueHandler):
+            handler.stop()  # Writes out everything still queued
+            in_logger.removeHandler(handler)
+            for output_handler in handler.listener.handlers:
+                in_logger.addHandler(output_handler)
+
+
 def _has_file_handler(in_logger: logging.Logger) -> bool:
     """Check if logger has a file handler."""
     return any(isinstance(handler, logging.FileHandler) for handler in in_logger.handlers)
@@ -66,6 +180,7 @@ def _add_console_handler(in_logger: logging.Logger) -> None:
     """Add a console handler to the logger."""
     formatter = logging.Formatter(LOG_FORMAT)
     console_handler = logging.StreamHandler()
+    console_handler.set_name("allowlistapp_console")
     console_handler.setFormatter(formatter)
 
     in_logger.addHandler(console_handler)
@@ -100,6 +215,7 @@ def _add_file_handler(in_logger: logging.Logger, log_path: str) -> None:
         raise PermissionError(err) from exc
 
     formatter = logging.Formatter(LOG_FORMAT)
+    file_handler.set_name("allowlistapp_file")
     file_handler.setFormatter(formatter)
     in_logger.addHandler(file_handler)
     logger.info("Logging to file: %s", log_path)
@@ -0,0 +1,301 @@
+"""Prometheus text format metrics for allowlistapp.
+
+Recording a value never takes a lock, each thread gets its own shard of counts that are summed when scraped.
+"""
+
+import abc
+import bisect
+import logging
+import threading
+import time
+import typing
+import weakref
+
+from flask import Blueprint, Response
+
+logger = logging.getLogger(__name__)
+bp = Blueprint("metrics", __name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Most of what we time is sub millisecond (lookups), the slow end is argon2, remote auth and nginx reloads.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class _ShardOwner:
+    """Held only by a thread's thread-local, so it's freed when the thread exits."""
+
+
+class _ShardedValues:
+    """A fixed width list of floats per thread, written without locking."""
+
+    def __init__(self, width: int) -> None:
+        """Initialise the shards."""
+        self._width = width
+        self._local = threading.local()
+        self._shards: list[list[float]] = []
+        self._base = [0.0] * width  # What the shards of exited threads counted
+        self._lock = threading.Lock()  # Only taken when a thread starts or stops recording, and when scraped
+
+    def shard(self) -> list[float]:
+        """Get the shard for the current thread."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = [0.0] * self._width
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            self._local.owner = owner = _ShardOwner()
+            weakref.finalize(owner, self._retire, shard).atexit = False
+            return shard
+
+    def _retire(self, shard: list[float]) -> None:
+        """Merge the shard of a thread that has exited into the base, so shards don't pile up."""
+        with self._lock:
+            for i, value in enumerate(shard):
+                self._base[i] += value
+            self._shards = [other for other in self._shards if other is not shard]  # Not remove(), that compares values
+
+    def totals(self) -> list[float]:
+        """Sum all the shards, this is a snapshot and can be a few observations behind."""
+        with self._lock:  # A retiring shard is counted exactly once
+            totals = list(self._base)
+            for shard in self._shards:
+                for i, value in enumerate(shard):
+                    totals[i] += value
+        return totals
+
+
+class _Timer:
+    """Context manager that observes the elapsed time on exit."""
+
+    def __init__(self, histogram: "_HistogramChild") -> None:
+        self._histogram = histogram
+        self._start = 0.0
+
+    def __enter__(self) -> "_Timer":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class _Metric(abc.ABC):
+    """Base for a metric family, children are created per set of label values."""
+
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        """Initialise the metric family and add it to the registry."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], typing.Any] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values: str) -> typing.Any:  # noqa: ANN401 The child type depends on the metric type.
+        """Get the child metric for a set of label values."""
+        if len(values) != len(self.labelnames):
+            msg = f"{self.name} expects labels {self.labelnames}, got {values}"
+            raise ValueError(msg)
+
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self) -> typing.Any:  # noqa: ANN401 The child type depends on the metric type.
+        """Create the child for a new set of label values."""
+
+    def _label_str(self, values: tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, values, strict=True)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        """Render this metric family in the prometheus text format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    @abc.abstractmethod
+    def _render_child(self, values: tuple[str, ...], child: typing.Any) -> list[str]:  # noqa: ANN401
+        """Render the lines for one child."""
+
+
+class _CounterChild:
+    def __init__(self) -> None:
+        self._values = _ShardedValues(1)
+
+    def inc(self, amount: float = 1) -> None:
+        self._values.shard()[0] += amount
+
+    def get(self) -> float:
+        return self._values.totals()[0]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+
+    metric_type = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        """Increment the counter, only for metrics without labels."""
+        self.labels().inc(amount)
+
+    def _render_child(self, values: tuple[str, ...], child: _CounterChild) -> list[str]:
+        return [f"{self.name}{self._label_str(values)} {_fmt(child.get())}"]
+
+
+class _GaugeChild:
+    def __init__(self) -> None:
+        self._value = 0.0
+
+    def set(self, value: float) -> None:
+        self._value = value  # A single assignment, no lock needed
+
+    def get(self) -> float:
+        return self._value
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+
+    metric_type = "gauge"
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def set(self, value: float) -> None:
+        """Set the gauge, only for metrics without labels."""
+        self.labels().set(value)
+
+    def _render_child(self, values: tuple[str, ...], child: _GaugeChild) -> list[str]:
+        return [f"{self.name}{self._label_str(values)} {_fmt(child.get())}"]
+
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        # One slot per bucket, one for +Inf, one for the sum
+        self._values = _ShardedValues(len(buckets) + 2)
+
+    def observe(self, value: float) -> None:
+        shard = self._values.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+    def get(self) -> tuple[list[float], float, float]:
+        """Get the cumulative bucket counts, the count and the sum."""
+        totals = self._values.totals()
+        cumulative = []
+        running = 0.0
+        for count in totals[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, running, totals[-1]
+
+
+class Histogram(_Metric):
+    """Distribution of observations in buckets."""
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Initialise the histogram, buckets are upper bounds and must be sorted."""
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        """Observe a value, only for metrics without labels."""
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        """Time a block of code, only for metrics without labels."""
+        return self.labels().time()
+
+    def _render_child(self, values: tuple[str, ...], child: _HistogramChild) -> list[str]:
+        cumulative, count, total = child.get()
+        lines = []
+        for bound, bucket_count in zip([*self.buckets, float("inf")], cumulative, strict=True):
+            le = 'le="+Inf"' if bound == float("inf") else f'le="{_fmt(bound)}"'
+            lines.append(f"{self.name}_bucket{self._label_str(values, le)} {_fmt(bucket_count)}")
+        lines.append(f"{self.name}_count{self._label_str(values)} {_fmt(count)}")
+        lines.append(f"{self.name}_sum{self._label_str(values)} {_fmt(total)}")
+        return lines
+
+
+def _fmt(value: float) -> str:
+    """Format a number for the text format, counts don't need a decimal point."""
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def render() -> str:
+    """Render every registered metric."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+@bp.route("/metrics", methods=["GET"])
+def metrics_endpoint() -> Response:
+    """Prometheus scrape endpoint."""
+    return Response(render(), content_type=CONTENT_TYPE)
+
+
+REGISTRY: list[_Metric] = []
+
+LOOKUP_SECONDS = Histogram("allowlistapp_lookup_seconds", "Time taken by AllowList.is_in_allowlist.")
+ALLOWLIST_ENTRIES = Gauge("allowlistapp_allowlist_entries", "Number of entries in the in memory allowlist.")
+DB_WRITE_SECONDS = Histogram("allowlistapp_db_write_seconds", "Time taken to write the allowlist database.")
+DB_GROUP_COMMIT_WRITES = Histogram(
+    "allowlistapp_db_group_commit_writes",
+    "Number of changes merged into each background database write.",
+    buckets=(1, 2, 5, 10, 25, 50, 100),
+)
+NGINX_RENDER_SECONDS = Histogram("allowlistapp_nginx_render_seconds", "Time taken to render the nginx allowlist.")
+NGINX_WRITE_SECONDS = Histogram("allowlistapp_nginx_write_seconds", "Time taken to write the nginx allowlist file.")
+NGINX_RELOAD_SECONDS = Histogram("allowlistapp_nginx_reload_seconds", "Time taken by the nginx reload subprocess.")
+ARGON2_VERIFY_SECONDS = Histogram("allowlistapp_argon2_verify_seconds", "Time taken to verify the static password.")
+REMOTE_AUTH_SECONDS = Histogram("allowlistapp_remote_auth_seconds", "Time taken by the remote auth request.")
+REPLICATION_CHANGES_TOTAL = Counter(
+    "allowlistapp_replication_changes_total", "Changes applied from each replication peer.", ("peer",)
+)
+REPLICATION_ERRORS_TOTAL = Counter("allowlistapp_replication_errors_total", "Failed pulls from each peer.", ("peer",))
+LOG_DROPPED_TOTAL = Counter("allowlistapp_log_dropped_total", "Log messages dropped because the log queue was full.")
+AUDIT_DROPPED_TOTAL = Counter("allowlistapp_audit_dropped_total", "Audit records dropped because the queue was full.")
+ALLOWLIST_EXPIRED_TOTAL = Counter("allowlistapp_allowlist_expired_total", "Allowlist entries expired for being idle.")
+AUTH_SHED_TOTAL = Counter("allowlistapp_auth_shed_total", "Logins turned away because too many were in progress.")
+AUTH_COALESCED_TOTAL = Counter("allowlistapp_auth_coalesced_total", "Logins that shared the result of one in progress.")
+AUTH_TOTAL = Counter("allowlistapp_auth_total", "Authentication attempts by result.", ("result",))
+
+# Make sure both results show up as zero before the first login
+AUTH_TOTAL.labels("success")
+AUTH_TOTAL.labels("failure")
+
+
+logger.debug("Loaded module: %s", __name__)
@@ -0,0 +1,160 @@
+"""Opt in cProfile sampling of requests, for finding out where the time goes in production."""
+
+import contextlib
+import cProfile
+import datetime
+import io
+import itertools
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import typing
+from collections.abc import Iterable, Iterator
+
+import click
+from flask import Flask, current_app
+from flask.cli import AppGroup
+
+if typing.TYPE_CHECKING:
+    from _typeshed.wsgi import StartResponse, WSGIApplication, WSGIEnvironment
+
+logger = logging.getLogger(__name__)
+cli = AppGroup("profiles", help="List and aggregate the request profiles.")
+
+PROFILE_SUFFIX = ".prof"
+
+
+class ProfilerMiddleware:
+    """WSGI middleware that profiles a random sample of requests and dumps a pstats file for each."""
+
+    def __init__(self, wsgi_app: "WSGIApplication", profiling_conf: dict) -> None:
+        """Initialise the middleware.
+
+        Args:
+            wsgi_app: The WSGI app to wrap, normally app.wsgi_app.
+            profiling_conf: The profiling configuration {"enabled": bool, "sample_rate": float, "path": "",
+                "max_files": int}
+        """
+        self.wsgi_app = wsgi_app
+        self.sample_rate = profiling_conf["sample_rate"]
+        self.path = profiling_conf["path"]
+        self.max_files = profiling_conf["max_files"]
+        # Only one profiler can be active at once (enforced from python 3.12), so concurrent requests are skipped.
+        self._profiling = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def __call__(self, environ: "WSGIEnvironment", start_response: "StartResponse") -> Iterable[bytes]:
+        """Handle a request, profiling it if it's sampled.
+
+        The profile stops at the first chunk of the body, which is all of it for a normal response. A streamed one
+        (/events, /check_many/) is passed on as it's made rather than held, the rest of it isn't profiled.
+        """
+        if random.random() >= self.sample_rate or not self._profiling.acquire(blocking=False):  # noqa: S311 Not crypto
+            return self.wsgi_app(environ, start_response)
+
+        app_iter = None
+        try:
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            app_iter = profile.runcall(self.wsgi_app, environ, start_response)
+            chunks = iter(app_iter)
+            first = profile.runcall(next, chunks, None)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self._dump(profile, environ, elapsed_ms)
+        except BaseException:
+            if hasattr(app_iter, "close"):
+                app_iter.close()  # type: ignore[union-attr]
+            raise
+        finally:
+            self._profiling.release()
+
+        return _Passthrough(first, chunks, app_iter)
+
+    def _dump(self, profile: cProfile.Profile, environ: "WSGIEnvironment", elapsed_ms: float) -> None:
+        """Write the profile, the name has enough in it to find the slow ones without opening them.
+
+        Past max_files the oldest profiles are deleted, like a rotating log.
+        """
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        path_slug = re.sub(r"[^A-Za-z0-9]+", "_", environ.get("PATH_INFO", "")).strip("_") or "root"
+        file_name = f"{timestamp}.{environ.get('REQUEST_METHOD', '')}.{path_slug}.{elapsed_ms:.0f}ms{PROFILE_SUFFIX}"
+        profile.dump_stats(os.path.join(self.path, file_name))
+        logger.debug("Wrote request profile: %s", file_name)
+
+        if self.max_files > 0:
+            for stale_path in list_profiles(self.path)[: -self.max_files]:
+                with contextlib.suppress(FileNotFoundError):  # Another worker got there first
+                    os.remove(stale_path)
+
+
+class _Passthrough:
+    """The rest of a profiled response body, after the first chunk that was read while profiling."""
+
+    def __init__(self, first: bytes | None, chunks: Iterator[bytes], app_iter: Iterable[bytes]) -> None:
+        self.first = first
+        self.chunks = chunks
+        self.app_iter = app_iter
+
+    def __iter__(self) -> Iterator[bytes]:
+        # Not a generator, closing it would close the app's body, that's only for close()
+        return itertools.chain([] if self.first is None else [self.first], self.chunks)
+
+    def close(self) -> None:
+        """Close the app's body, the server calls this when the response is done or the client has gone."""
+        if hasattr(self.app_iter, "close"):
+            self.app_iter.close()
+
+
+def list_profiles(path: str, match: str = "") -> list[str]:
+    """List profile files, oldest first, optionally only those with match in the name."""
+    try:
+        names = sorted(name for name in os.listdir(path) if name.endswith(PROFILE_SUFFIX) and match in name)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(path, name) for name in names]
+
+
+def start_profiling(app: Flask) -> None:
+    """Wrap the app in the profiler if it's enabled."""
+    profiling_conf = app.config["profiling"]
+    if profiling_conf["enabled"]:
+        app.wsgi_app = ProfilerMiddleware(app.wsgi_app, profiling_conf)  # type: ignore[method-assign]
+        logger.info("Profiling %s%% of requests to: %s", profiling_conf["sample_rate"] * 100, profiling_conf["path"])
+
+    app.cli.add_command(cli)
+
+
+@cli.command("list")
+@click.option("--match", default="", help="Only profiles with this in the file name, e.g. authenticate.")
+def list_command(match: str) -> None:
+    """List the saved request profiles."""
+    for path in list_profiles(current_app.config["profiling"]["path"], match):
+        click.echo(os.path.basename(path))
+
+
+@cli.command("aggregate")
+@click.option("--match", default="", help="Only profiles with this in the file name, e.g. authenticate.")
+@click.option("--sort", default="cumulative", help="pstats sort key.")
+@click.option("--limit", default=30, help="Number of functions to show.")
+@click.option("--output", default="", help="Also save the combined stats to this file.")
+def aggregate_command(match: str, sort: str, limit: int, output: str) -> None:
+    """Combine the saved request profiles and print the top functions."""
+    paths = list_profiles(current_app.config["profiling"]["path"], match)
+    if not paths:
+        click.echo("No profiles found")
+        return
+
+    stream = io.StringIO()
+    stats = pstats.Stats(*paths, stream=stream)
+    stats.sort_stats(sort).print_stats(limit)
+    click.echo(f"Aggregated {len(paths)} profiles")
+    click.echo(stream.getvalue())
+    if output:
+        stats.dump_stats(output)
+
+
+logger.debug("Loaded module: %s", __name__)
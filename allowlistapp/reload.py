@@ -0,0 +1,88 @@
+"""Reload the config without restarting, triggered by SIGHUP."""
+
+import logging
+import signal
+import threading
+import typing
+
+from flask import Flask
+
+from . import ala_auth, config
+from . import logger as ala_logger
+
+logger = logging.getLogger(__name__)
+
+# These can change without a restart, everything else is logged as needing one.
+HOT_RELOAD_KEYS = [
+    ("app", "allowed_subnets"),
+    ("app", "redirect_url"),
+    ("logging", "level"),
+    ("auth", "static"),
+    ("auth", "remote"),
+    ("expiry", "idle_days"),
+    ("expiry", "max_per_user"),
+]
+
+
+def reload_config(app: Flask) -> None:
+    """Re-read the config file and apply what changed to the running app."""
+    logger.info("Reloading config")
+    try:
+        new_conf = config.AllowListAppConfig(instance_path=app.instance_path)
+    except Exception:
+        logger.exception("Config reload failed, keeping the current config")
+        return
+
+    for section, key in HOT_RELOAD_KEYS:
+        old_value = app.config[section][key]
+        new_value = new_conf[section][key]
+        if old_value == new_value:
+            continue
+
+        if (section, key) == ("app", "allowed_subnets"):
+            assert ala_auth.al is not None  # noqa: S101 Appease mypy
+            ala_auth.al.update_allowed_subnets(old_value, new_value)
+
+        app.config[section][key] = new_value
+
+        if section == "logging":
+            ala_logger.setup_logger(app, app.config["logging"])
+
+        logger.info("Config [%s][%s] reloaded", section, key)
+
+    for key_path in _changed_keys(app.config, new_conf):
+        if tuple(key_path[:2]) not in HOT_RELOAD_KEYS:
+            logger.warning("Config change to %s needs a restart to take effect", "".join(f"[{k}]" for k in key_path))
+
+    logger.info("Config reload complete")
+
+
+def _changed_keys(old: typing.Any, new: typing.Any, parent: tuple = ()) -> list[tuple]:  # noqa: ANN401 Nested config
+    """List the paths of the config entries that differ, this is recursive."""
+    changed = []
+    for key, value in new.items():
+        if parent == () and key not in old:
+            continue
+        old_value = old.get(key) if isinstance(old, dict) else None
+        if isinstance(value, dict) and isinstance(old_value, dict):
+            changed.extend(_changed_keys(old_value, value, (*parent, key)))
+        elif old_value != value:
+            changed.append((*parent, key))
+    return changed
+
+
+def start_reload_handler(app: Flask) -> None:
+    """Reload the config on SIGHUP, signal handlers can only be set from the main thread."""
+    if not hasattr(signal, "SIGHUP") or threading.current_thread() is not threading.main_thread():
+        logger.debug("Not handling SIGHUP, not in the main thread or not supported")
+        return
+
+    def _handle_sighup(_signum: int, _frame: object) -> None:
+        # Signal handlers interrupt whatever the main thread is doing, so do the actual work in a thread.
+        threading.Thread(target=reload_config, args=(app,), daemon=True).start()
+
+    signal.signal(signal.SIGHUP, _handle_sighup)
+    logger.debug("Reloading config on SIGHUP")
+
+
+logger.debug("Loaded module: %s", __name__)
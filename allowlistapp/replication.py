@@ -0,0 +1,281 @@
+"""Replication of the allowlist between nodes, each running their own allowlistapp with their own database.
+
+Every node serves its journal as a change feed at /replication/changes?since=<seq>, peers poll it and apply the
+changes through the normal write path. Changes keep the node they came from and their sequence number there, so
+they're applied once per node however many peers pass them on, applying one twice would do nothing anyway.
+If a peer has been away long enough that the journal has been replaced since, and every anti_entropy_interval
+regardless, the hash of the entries is compared and the whole allowlist is fetched and merged if they differ.
+
+Only entries from logins are replicated, the allowed_subnets ("default" entries) belong to each node's config.
+Removals, expiries and daily resets are replicated too, a reset removes the logins dated before it. Dates are
+UTC, so the nodes' clocks need to be in sync rather than in the same timezone. So a comparison doesn't bring back
+what was taken out here, entries the local journal removed, or dated before its last reset, aren't merged in.
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import typing
+import uuid
+
+from flask import Blueprint, Flask, abort, current_app, jsonify, request
+
+from . import al_handler, ala_auth, database, metrics
+
+if typing.TYPE_CHECKING:
+    from flask import Response
+
+logger = logging.getLogger(__name__)
+bp = Blueprint("replication", __name__, url_prefix="/replication")
+
+FEED_LIMIT = 1000  # Changes per page of the feed
+REQUEST_TIMEOUT = 10
+
+node_id: str | None = None
+
+
+def _state_path() -> str:
+    assert database.database_path is not None  # noqa: S101 Appease mypy, this module should be an object
+    return database.database_path + ".replication.json"
+
+
+def load_state() -> dict:
+    """Load the replication state, where this node is up to with each peer and each origin."""
+    try:
+        with open(_state_path(), encoding="utf8") as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {"node_id": "", "cursors": {}, "applied": {}}
+
+
+def _save_state(state: dict) -> None:
+    """Save the replication state, call with the database lock held."""
+    tmp_path = f"{_state_path()}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, _state_path())
+
+
+def shared_entries(allowlist: list[dict]) -> list[dict]:
+    """The entries that are replicated, sorted so every node lists them the same way."""
+    entries = [item for item in allowlist if item["username"] != "default"]
+    return sorted(entries, key=lambda item: (item["ip"], item["username"]))
+
+
+def entries_hash(entries: list[dict]) -> str:
+    """Hash the replicated entries, nodes with the same entries have the same hash."""
+    digest = hashlib.sha256()
+    for item in entries:
+        digest.update(f"{item['ip']}\t{item['username']}\n".encode())
+    return digest.hexdigest()
+
+
+def _allowlist() -> al_handler.AllowList:
+    assert ala_auth.al is not None  # noqa: S101 Appease mypy
+    return ala_auth.al
+
+
+@bp.before_request
+def _check_token() -> None:
+    """The feed has every username and IP in it, so peers need the shared token."""
+    token = current_app.config["replication"]["token"]
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        abort(401)
+
+
+@bp.route("/changes", methods=["GET"])
+def changes() -> "Response":
+    """Changes after ?since=<seq>, complete is false if some have been missed and the snapshot is needed."""
+    since = request.args.get("since", 0, type=int)
+    limit = min(request.args.get("limit", FEED_LIMIT, type=int), FEED_LIMIT)
+    allowlist = _allowlist()
+
+    events, complete = allowlist.journal.read_since(since, limit)
+    feed = [change for change in map(_feed_change, events) if change is not None]
+
+    return jsonify(
+        node=node_id,
+        seq=events[-1]["seq"] if events else since,
+        latest=allowlist.journal.latest_seq(),
+        complete=complete,
+        changes=feed,
+    )
+
+
+def _feed_change(event: dict) -> dict | None:
+    """A journal event as a change for the feed, None if it isn't replicated."""
+    change = {"origin": event.get("origin", node_id), "origin_seq": event.get("origin_seq", event["seq"])}
+    if event["op"] == "reset" and "date" in event:  # Resets from before they had a date can't be applied safely
+        return {"op": "reset", "date": event["date"], **change}
+    if event["op"] in ("add", "remove", "expire") and event["entry"]["username"] != "default":
+        return {"op": event["op"], "entry": event["entry"], **change}
+    return None
+
+
+def _removed_locally(events: list[dict]) -> tuple[set[tuple[str, str, str]], float]:
+    """The (ip, username, date) of the entries the journal events removed, and the time of the last reset."""
+    removed = set()
+    reset_time = -math.inf
+    for event in events:
+        if event["op"] in ("remove", "expire"):
+            removed.add((event["entry"]["ip"], event["entry"]["username"], event["entry"]["date"]))
+        elif event["op"] == "reset":
+            reset_time = max(reset_time, al_handler.parse_date(event.get("date", "")) or -math.inf)
+    return removed, reset_time
+
+
+def _after_reset(entry: dict, reset_time: float) -> bool:
+    """Check if an entry was added after the reset, ones with an unknown date are kept."""
+    added = al_handler.parse_date(entry["date"])
+    return added is None or added > reset_time
+
+
+@bp.route("/snapshot", methods=["GET"])
+def snapshot() -> "Response":
+    """The replicated entries, their hash and the seq they're up to, ?hash_only=1 leaves out the entries."""
+    allowlist = _allowlist()
+    with database.db_lock():
+        entries = shared_entries(allowlist.snapshot())
+        seq = allowlist.journal.latest_seq()
+
+    result: dict[str, typing.Any] = {"node": node_id, "seq": seq, "hash": entries_hash(entries)}
+    if not request.args.get("hash_only", type=int):
+        result["entries"] = entries
+    return jsonify(result)
+
+
+class Puller:
+    """Polls the peers' change feeds and applies their changes to the local allowlist."""
+
+    def __init__(self, allowlist: al_handler.AllowList, replication_conf: dict) -> None:
+        """Initialise the puller.
+
+        Args:
+            allowlist: The local allowlist.
+            replication_conf: The replication configuration {"peers": [], "token": "", "interval": 5.0, ...}
+        """
+        import requests  # Only needed when there are peers
+
+        self.allowlist = allowlist
+        self.peers = [peer.rstrip("/") for peer in replication_conf["peers"]]
+        self.interval = replication_conf["interval"]
+        self.anti_entropy_interval = replication_conf["anti_entropy_interval"]
+        self._session = requests.Session()
+        self._session.headers["Authorization"] = f"Bearer {replication_conf['token']}"
+        self._last_compared: dict[str, float] = {}
+
+    def run(self) -> None:
+        """Poll forever."""
+        while True:
+            self.pull_all()
+            time.sleep(self.interval)
+
+    def pull_all(self) -> None:
+        """Pull from every peer once, a peer that's down is logged and tried again next time."""
+        import requests
+
+        for peer in self.peers:
+            try:
+                self.pull(peer)
+            except (requests.RequestException, ValueError, KeyError) as exc:
+                logger.warning("Replication from %s failed: %s", peer, exc)
+                metrics.REPLICATION_ERRORS_TOTAL.labels(peer).inc()
+
+    def pull(self, peer: str) -> None:
+        """Apply the changes from a peer since last time, falling back to comparing snapshots."""
+        cursor = load_state()["cursors"].get(peer, 0)
+        while True:
+            feed = self._get(peer, "/replication/changes", {"since": cursor, "limit": FEED_LIMIT})
+            if not feed["complete"]:
+                logger.info("Missed changes from %s, comparing the whole allowlist", peer)
+                self.compare(peer, move_cursor=True)
+                return
+
+            self._apply(peer, feed["changes"], feed["seq"])
+            if feed["seq"] >= feed["latest"] or feed["seq"] == cursor:
+                break
+            cursor = feed["seq"]
+
+        last_compared = self._last_compared.get(peer)
+        if last_compared is None or time.monotonic() - last_compared > self.anti_entropy_interval:
+            self.compare(peer)
+
+    def compare(self, peer: str, *, move_cursor: bool = False) -> None:
+        """Compare the hash of the entries with a peer, and merge in the peer's entries if they're different."""
+        self._last_compared[peer] = time.monotonic()
+        remote = self._get(peer, "/replication/snapshot", {"hash_only": 1})
+        if remote["hash"] != entries_hash(shared_entries(self.allowlist.snapshot())):
+            remote = self._get(peer, "/replication/snapshot", {})
+            # The peer might not have had the removals from here yet, those entries aren't brought back
+            removed, reset_time = _removed_locally(self.allowlist.journal.read_since(0, sys.maxsize)[0])
+            entries = [
+                entry
+                for entry in remote["entries"]
+                if (entry["ip"], entry["username"], entry["date"]) not in removed and _after_reset(entry, reset_time)
+            ]
+            added = self.allowlist.apply_changes([{"op": "add", "entry": entry} for entry in entries])
+            logger.info("Merged %s entries from %s", len(added), peer)
+            metrics.REPLICATION_CHANGES_TOTAL.labels(peer).inc(len(added))
+
+        if move_cursor:
+            self._apply(peer, [], remote["seq"], restart=True)
+
+    def _apply(self, peer: str, changes: list[dict], seq: int, *, restart: bool = False) -> None:
+        """Apply the changes not seen yet and record how far this node got with the peer.
+
+        With restart the peer's feed is followed from seq even if it's behind, the peer might have been reset.
+        """
+        applied = load_state()["applied"]
+        new_changes = [
+            change
+            for change in changes
+            if change["origin"] != node_id and change["origin_seq"] > applied.get(change["origin"], 0)
+        ]
+        if new_changes:
+            count = len(self.allowlist.apply_changes(new_changes))
+            logger.info("Applied %s changes from %s", count, peer)
+            metrics.REPLICATION_CHANGES_TOTAL.labels(peer).inc(count)
+
+        with database.db_lock():  # Other workers might be pulling too
+            state = load_state()
+            state["cursors"][peer] = seq if restart else max(state["cursors"].get(peer, 0), seq)
+            for change in new_changes:
+                origin = change["origin"]
+                state["applied"][origin] = max(state["applied"].get(origin, 0), change["origin_seq"])
+            _save_state(state)
+
+    def _get(self, peer: str, path: str, params: dict) -> dict:
+        response = self._session.get(peer + path, params=params, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+
+def start_replication(app: Flask) -> None:
+    """Serve the change feed and start pulling from the peers, if replication is enabled."""
+    global node_id  # noqa: PLW0603 Needed due to how flask loads modules.
+    replication_conf = app.config["replication"]
+    if not replication_conf["enabled"]:
+        return
+
+    with database.db_lock():  # The node id is shared by every worker using this database
+        state = load_state()
+        if not state["node_id"]:
+            state["node_id"] = uuid.uuid4().hex
+            _save_state(state)
+    node_id = state["node_id"]
+
+    app.register_blueprint(bp)
+    logger.info("Replication enabled, node id: %s, peers: %s", node_id, replication_conf["peers"])
+
+    if replication_conf["peers"]:
+        puller = Puller(_allowlist(), replication_conf)
+        threading.Thread(target=puller.run, name="replication-puller", daemon=True).start()
+
+
+logger.debug("Loaded module: %s", __name__)
@@ -0,0 +1,45 @@
+"""Production entry point, runs the app with waitress set up from the [waitress] section of the config.
+
+allowlistapp-serve [--instance-path PATH]
+"""
+
+import argparse
+import logging
+
+from . import create_app
+
+logger = logging.getLogger(__name__)
+
+
+def waitress_options(waitress_conf: dict) -> dict:
+    """Turn the [waitress] config into waitress.serve arguments, a unix socket replaces the host and port.
+
+    Everything else is passed straight through, so any waitress option can go in the config.
+    """
+    options = dict(waitress_conf)
+    if options["unix_socket"]:
+        del options["host"], options["port"]
+    else:
+        del options["unix_socket"], options["unix_socket_perms"]
+    return options
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Run the app with waitress."""
+    parser = argparse.ArgumentParser(description="Serve allowlistapp with waitress, configured from config.toml.")
+    parser.add_argument("--instance-path", default=None, help="Flask instance path, where config.toml is looked for.")
+    args = parser.parse_args(argv)
+
+    import waitress  # Only needed here
+
+    app = create_app(instance_path=args.instance_path)
+    options = waitress_options(app.config["waitress"])
+    if "unix_socket" in options:
+        logger.info("Serving on unix socket: %s", options["unix_socket"])
+    else:
+        logger.info("Serving on: %s:%s", options["host"], options["port"])
+    waitress.serve(app, **options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Startup time report, to keep an eye on cold start time for short lived workers and container restarts."""
+
+import logging
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+STARTUP_SECONDS = metrics.Gauge("allowlistapp_startup_seconds", "Time taken by each phase of startup.", ("phase",))
+
+
+class StartupReport:
+    """Times the phases of startup, each phase runs from the previous mark to the next."""
+
+    def __init__(self, import_seconds: float = 0) -> None:
+        """Start timing, import_seconds is how long importing the package took, if known."""
+        self.phases: dict[str, float] = {}
+        if import_seconds:
+            self.phases["import"] = import_seconds
+        self._start = time.perf_counter()
+        self._last = self._start
+
+    def mark(self, phase: str) -> None:
+        """Finish timing a phase."""
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def total(self) -> float:
+        """Total startup time, including the import."""
+        return sum(self.phases.values())
+
+    def finish(self) -> None:
+        """Log the report and export it as metrics."""
+        for phase, seconds in self.phases.items():
+            STARTUP_SECONDS.labels(phase).set(seconds)
+        STARTUP_SECONDS.labels("total").set(self.total())
+
+        phases_str = ", ".join(f"{phase}: {seconds * 1000:.1f}ms" for phase, seconds in self.phases.items())
+        logger.info("Startup took %.1fms (%s)", self.total() * 1000, phases_str)
+
+
+logger.debug("Loaded module: %s", __name__)
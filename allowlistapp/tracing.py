@@ -0,0 +1,225 @@
+"""Request tracing, a tree of timed spans for each sampled login, for finding out why some are slow.
+
+A trace starts when a traced request does, code marks the parts worth timing with `with tracing.span("name"):`,
+which does nothing outside a trace. Spans nest through a contextvar, so they don't need passing around. Finished
+traces are written as OTLP JSON (the OpenTelemetry protocol's JSON encoding, one ExportTraceServiceRequest per
+line, as the collector's file exporter writes them) to a rotating file, so any OpenTelemetry tool can read them.
+
+Work done in other threads (group commit database writes) isn't in the trace, only the waiting for it is.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import time
+from collections.abc import Iterator
+from logging.handlers import RotatingFileHandler
+
+import click
+from flask import Flask, Response, current_app, g, request
+from flask.cli import AppGroup
+
+logger = logging.getLogger(__name__)
+cli = AppGroup("traces", help="Look at the request traces.")
+
+TRACED_ENDPOINTS = ("auth.authenticate",)
+SERVICE_NAME = "allowlistapp"
+STATUS_ERROR = 2  # OTLP status codes, 0 is unset
+
+_current: contextvars.ContextVar["Span | None"] = contextvars.ContextVar("allowlistapp_span", default=None)
+_exporter: logging.Logger | None = None
+_sample_rate = 1.0
+
+
+class Span:
+    """A timed part of a trace, the spans of a trace share one list that they add themselves to when finished."""
+
+    def __init__(self, name: str, parent: "Span | None" = None, attributes: dict | None = None) -> None:
+        """Start the span, it's a new trace without a parent."""
+        self.name = name
+        self.attributes = attributes or {}
+        self.trace_id: str = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id: str = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else ""
+        self.finished: list[Span] = parent.finished if parent else []
+        self.error = ""
+        self.end_ns = 0
+        self.start_ns = time.time_ns()
+
+    def finish(self) -> None:
+        """End the span."""
+        self.end_ns = time.time_ns()
+        self.finished.append(self)
+
+    def to_otlp(self) -> dict:
+        """The span in OTLP JSON."""
+        otlp = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 2 if not self.parent_id else 1,  # Server for the request, internal for the rest
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {},
+        }
+        if self.parent_id:
+            otlp["parentSpanId"] = self.parent_id
+        return otlp
+
+
+def _attribute(key: str, value: str | bool | float) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}  # int64 is a string in OTLP JSON
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: str | bool | float) -> Iterator[Span | None]:
+    """Time a part of the current trace, this does nothing when there isn't one."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, parent, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.error = type(exc).__name__
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+def export(root: Span) -> None:
+    """Write a finished trace to the trace file."""
+    if _exporter is None:
+        return
+    request_json = {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": [_attribute("service.name", SERVICE_NAME)]},
+                "scopeSpans": [
+                    {
+                        "scope": {"name": __name__},
+                        "spans": [item.to_otlp() for item in sorted(root.finished, key=lambda item: item.start_ns)],
+                    }
+                ],
+            }
+        ]
+    }
+    _exporter.info(json.dumps(request_json, separators=(",", ":")))
+
+
+def _start_request_trace() -> None:
+    if request.endpoint not in TRACED_ENDPOINTS or random.random() >= _sample_rate:  # noqa: S311 Not crypto
+        return
+    root = Span(
+        f"{request.method} {request.path}",
+        attributes={"http.request.method": request.method, "url.path": request.path},
+    )
+    g.trace_token = _current.set(root)
+
+
+def _end_request_trace(exc: BaseException | None) -> None:
+    token = g.pop("trace_token", None)
+    if token is None:
+        return
+    root = _current.get()
+    _current.reset(token)
+    if root is None:
+        return
+    if exc is not None:
+        root.error = type(exc).__name__
+    root.finish()
+    export(root)
+
+
+def _record_status(response: Response) -> Response:
+    root = _current.get()
+    if root is not None and not root.parent_id:
+        root.attributes["http.response.status_code"] = response.status_code
+    return response
+
+
+def start_tracing(app: Flask) -> None:
+    """Trace the logins if it's enabled."""
+    global _exporter, _sample_rate  # noqa: PLW0603 Needed due to how flask loads modules.
+    if _exporter:
+        for handler in list(_exporter.handlers):
+            _exporter.removeHandler(handler)
+            handler.close()
+    _exporter = None  # Prevents tests from getting weird
+
+    tracing_conf = app.config["tracing"]
+    if tracing_conf["enabled"]:
+        handler = RotatingFileHandler(
+            tracing_conf["path"], maxBytes=tracing_conf["max_bytes"], backupCount=tracing_conf["backup_count"]
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _exporter = logging.getLogger(f"{__name__}.export")
+        _exporter.propagate = False  # Not in the app log
+        _exporter.setLevel(logging.INFO)
+        _exporter.addHandler(handler)
+        _sample_rate = tracing_conf["sample_rate"]
+
+        app.before_request(_start_request_trace)
+        app.after_request(_record_status)
+        app.teardown_request(_end_request_trace)
+        logger.info("Tracing %s%% of logins to: %s", _sample_rate * 100, tracing_conf["path"])
+
+    app.cli.add_command(cli)
+
+
+def read_traces(path: str) -> Iterator[list[dict]]:
+    """Read the spans of each trace in a trace file."""
+    with open(path, encoding="utf8") as trace_file:
+        for line in trace_file:
+            request_json = json.loads(line)
+            yield [
+                otlp_span
+                for resource_spans in request_json["resourceSpans"]
+                for scope_spans in resource_spans["scopeSpans"]
+                for otlp_span in scope_spans["spans"]
+            ]
+
+
+def _duration_ms(otlp_span: dict) -> float:
+    return (int(otlp_span["endTimeUnixNano"]) - int(otlp_span["startTimeUnixNano"])) / 1_000_000
+
+
+@cli.command("slowest")
+@click.option("--limit", default=10, help="Number of traces to show.")
+@click.option("--path", default="", help="Trace file, defaults to the configured one.")
+def slowest_command(limit: int, path: str) -> None:
+    """Print the slowest traces as trees of spans, with how long each took."""
+    traces = sorted(
+        read_traces(path or current_app.config["tracing"]["path"]),
+        key=lambda spans: max(_duration_ms(otlp_span) for otlp_span in spans),
+        reverse=True,
+    )
+    for spans in traces[:limit]:
+        children: dict[str, list[dict]] = {}
+        for otlp_span in spans:
+            children.setdefault(otlp_span.get("parentSpanId", ""), []).append(otlp_span)
+
+        def _print_tree(parent_id: str, depth: int, children: dict[str, list[dict]] = children) -> None:
+            for otlp_span in sorted(children.get(parent_id, []), key=lambda item: int(item["startTimeUnixNano"])):
+                error = f" ({otlp_span['status']['message']})" if otlp_span["status"] else ""
+                click.echo(f"{'  ' * depth}{otlp_span['name']}: {_duration_ms(otlp_span):.2f}ms{error}")
+                _print_tree(otlp_span["spanId"], depth + 1)
+
+        click.echo(f"trace {spans[0]['traceId']}")
+        _print_tree("", 1)
+
+
+logger.debug("Loaded module: %s", __name__)
@@ -0,0 +1,143 @@
+"""Compare benchmark results against the stored baseline and flag regressions.
+
+Examples:
+    pytest benchmarks --no-cov --bench-json bench.json
+    python benchmarks/compare.py bench.json
+    python benchmarks/compare.py bench.json --baseline benchmarks/baseline.json --threshold 0.1
+    python benchmarks/compare.py bench-1.json bench-2.json bench-3.json --update
+
+Exits non zero if anything regressed by more than its threshold. Thresholds are per benchmark name (glob
+patterns, first match wins) in benchmarks/thresholds.json, anything unmatched uses --threshold.
+Baselines are only meaningful on the machine they were recorded on, re-record with --update after a change
+that is meant to move the numbers. Given several runs, each benchmark's fastest one is used, a noisy machine only
+ever makes things slower.
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+DEFAULT_THRESHOLDS = os.path.join(BENCHMARKS_DIR, "thresholds.json")
+DEFAULT_THRESHOLD = 0.25  # 25% slower is a regression
+STAT = "median"
+
+
+def load_runs(paths: list[str]) -> dict:
+    """Load --bench-json files, merged into one keeping each benchmark's fastest run."""
+    merged: dict = {}
+    for path in paths:
+        with open(path, encoding="utf8") as json_file:
+            run = json.load(json_file)
+        if not merged:
+            merged = run
+            continue
+        for name, result in run["benchmarks"].items():
+            if name not in merged["benchmarks"] or result[STAT] < merged["benchmarks"][name][STAT]:
+                merged["benchmarks"][name] = result
+    return merged
+
+
+def load_results(path: str) -> dict[str, dict]:
+    """Load the benchmarks out of a --bench-json file."""
+    return load_runs([path])["benchmarks"]
+
+
+def load_thresholds(path: str) -> dict[str, float]:
+    """Load the per benchmark thresholds, it's fine if there are none."""
+    try:
+        with open(path, encoding="utf8") as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+
+
+def threshold_for(name: str, thresholds: dict[str, float], default: float) -> float:
+    """Get the threshold for a benchmark, first matching pattern wins."""
+    for pattern, threshold in thresholds.items():
+        if fnmatch.fnmatch(name, pattern):
+            return threshold
+    return default
+
+
+def compare(baseline: dict[str, dict], current: dict[str, dict], thresholds: dict[str, float], default: float) -> list:
+    """Compare two sets of results, returns rows of (name, baseline, current, change, threshold, status)."""
+    rows: list[tuple] = []
+    for name in sorted(set(baseline) | set(current)):
+        if name not in current:
+            rows.append((name, baseline[name][STAT], None, None, None, "missing"))
+            continue
+        if name not in baseline:
+            rows.append((name, None, current[name][STAT], None, None, "new"))
+            continue
+
+        before = baseline[name][STAT]
+        after = current[name][STAT]
+        change = (after - before) / before if before else 0.0
+        threshold = threshold_for(name, thresholds, default)
+        status = "ok"
+        if change > threshold:
+            status = "REGRESSION"
+        elif change < -threshold:
+            status = "improved"
+        rows.append((name, before, after, change, threshold, status))
+    return rows
+
+
+def _fmt_seconds(seconds: float | None) -> str:
+    if seconds is None:
+        return "-"
+    for unit, scale in [("s", 1), ("ms", 1e3), ("us", 1e6)]:
+        if seconds * scale >= 1:
+            return f"{seconds * scale:.2f}{unit}"
+    return f"{seconds * 1e9:.0f}ns"
+
+
+def print_report(rows: list) -> None:
+    """Print the comparison as a table."""
+    print(f"{'name':<45} {'baseline':>10} {'current':>10} {'change':>8} {'limit':>6}  status")  # noqa: T201
+    for name, before, after, change, threshold, status in rows:
+        change_str = "-" if change is None else f"{change * 100:+.1f}%"
+        threshold_str = "-" if threshold is None else f"{threshold * 100:.0f}%"
+        print(  # noqa: T201
+            f"{name:<45} {_fmt_seconds(before):>10} {_fmt_seconds(after):>10} {change_str:>8} {threshold_str:>6}  "
+            f"{status}"
+        )
+
+
+def main() -> None:
+    """Compare, print the report and exit 1 on regressions."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("current", nargs="+", help="Results from pytest benchmarks --bench-json, one or more runs.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--thresholds", default=DEFAULT_THRESHOLDS)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Default allowed slowdown.")
+    parser.add_argument("--update", action="store_true", help="Replace the baseline with the current results.")
+    args = parser.parse_args()
+
+    current = load_runs(args.current)
+    rows = compare(
+        load_results(args.baseline),
+        current["benchmarks"],
+        load_thresholds(args.thresholds),
+        args.threshold,
+    )
+    print_report(rows)
+
+    if args.update:
+        with open(args.baseline, "w", encoding="utf8") as json_file:
+            json.dump(current, json_file, indent=2, sort_keys=True)
+        print(f"Baseline updated: {args.baseline}")  # noqa: T201
+        return
+
+    regressions = [row for row in rows if row[-1] == "REGRESSION"]
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed")  # noqa: T201
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
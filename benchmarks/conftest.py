@@ -0,0 +1,148 @@
+"""Fixtures and the timing harness for the benchmarks.
+
+Run with: pytest benchmarks --no-cov
+Coverage tracing slows everything down a lot, so the numbers are meaningless with it on.
+"""
+
+import datetime
+import ipaddress
+import json
+import platform
+import random
+import statistics
+import time
+from collections.abc import Callable
+
+import pytest
+
+from allowlistapp import al_handler, database
+from tests import conftest as tests_conftest
+
+SIZES = [10, 1_000, 10_000, 100_000]
+TARGET_SECONDS = 0.5  # Roughly how long to spend timing each benchmark
+MAX_ROUNDS = 1000
+
+_results: dict[str, dict] = {}
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    """Add the benchmark options."""
+    parser.addoption("--bench-json", default="", help="Write the benchmark results to this JSON file.")
+    parser.addoption(
+        "--bench-sizes",
+        default=",".join(str(size) for size in SIZES),
+        help="Comma separated allowlist sizes to benchmark.",
+    )
+
+
+def pytest_generate_tests(metafunc: pytest.Metafunc) -> None:
+    """Parametrise every benchmark that takes a size by the --bench-sizes option."""
+    if "size" in metafunc.fixturenames:
+        sizes = [int(size) for size in metafunc.config.getoption("--bench-sizes").split(",")]
+        metafunc.parametrize("size", sizes)
+
+
+def pytest_terminal_summary(terminalreporter: pytest.TerminalReporter, config: pytest.Config) -> None:
+    """Print a table of results, and write them out if asked to."""
+    if not _results:
+        return
+
+    terminalreporter.section("benchmarks")
+    terminalreporter.write_line(f"{'name':<45} {'min':>12} {'median':>12} {'mean':>12} {'rounds':>7}")
+    for name, result in sorted(_results.items()):
+        terminalreporter.write_line(
+            f"{name:<45} {_fmt_seconds(result['min']):>12} {_fmt_seconds(result['median']):>12} "
+            f"{_fmt_seconds(result['mean']):>12} {result['rounds']:>7}"
+        )
+
+    json_path = config.getoption("--bench-json")
+    if json_path:
+        output = {
+            "machine": {"python": platform.python_version(), "platform": platform.platform()},
+            "date": str(datetime.datetime.now()),
+            "benchmarks": _results,
+        }
+        with open(json_path, "w", encoding="utf8") as json_file:
+            json.dump(output, json_file, indent=2, sort_keys=True)
+        terminalreporter.write_line(f"Wrote benchmark results to: {json_path}")
+
+
+def _fmt_seconds(seconds: float) -> str:
+    for unit, scale in [("s", 1), ("ms", 1e3), ("us", 1e6)]:
+        if seconds * scale >= 1:
+            return f"{seconds * scale:.2f}{unit}"
+    return f"{seconds * 1e9:.0f}ns"
+
+
+@pytest.fixture
+def bench(request: pytest.FixtureRequest) -> Callable:
+    """Time a function, the result is stored under the test's name."""
+
+    def _bench(func: Callable, setup: Callable | None = None, *, self_timed: bool = False) -> float:
+        """Run func repeatedly, setup (if given) runs untimed before every round. Returns the median.
+
+        If self_timed, func returns how long the interesting part took instead of being timed as a whole.
+        """
+        timings: list[float] = []
+        deadline = time.perf_counter() + TARGET_SECONDS
+        while len(timings) < MAX_ROUNDS:
+            if setup:
+                setup()
+            start = time.perf_counter()
+            elapsed = func()
+            if not self_timed:
+                elapsed = time.perf_counter() - start
+            timings.append(elapsed)
+            if len(timings) >= 3 and time.perf_counter() > deadline:  # noqa: PLR2004 Always do a few rounds
+                break
+
+        name = request.node.name.removeprefix("test_")
+        _results[name] = {
+            "min": min(timings),
+            "median": statistics.median(timings),
+            "mean": statistics.fmean(timings),
+            "rounds": len(timings),
+        }
+        return _results[name]["median"]
+
+    return _bench
+
+
+def _make_entries(size: int, seed: int = 0) -> list[dict]:
+    """Make a mixed IPv4/IPv6, host/network allowlist, the same every time for a given size and seed."""
+    rng = random.Random(seed)
+    entries = []
+    for i in range(size):
+        kind = i % 4
+        if kind == 0:
+            ip = str(ipaddress.IPv4Address(rng.getrandbits(32)))
+        elif kind == 1:
+            ip = str(ipaddress.IPv4Network((rng.getrandbits(24) << 8, 24)))
+        elif kind == 2:  # noqa: PLR2004
+            ip = str(ipaddress.IPv6Address(rng.getrandbits(128)))
+        else:
+            ip = str(ipaddress.IPv6Network((rng.getrandbits(64) << 64, 64)))
+        entries.append({"username": f"user{i % 50}", "ip": ip, "date": "2024-01-01 00:00:00.000000"})
+    return entries
+
+
+@pytest.fixture
+def make_entries() -> Callable:
+    """Function returns a function, so benchmarks can make workloads of any size."""
+    return _make_entries
+
+
+# The same fixtures as the tests, a fixture is registered by being a name in a conftest
+db_path = tests_conftest.db_path
+ala_conf = tests_conftest.ala_conf
+
+
+@pytest.fixture
+def make_allowlist(db_path, ala_conf) -> Callable:
+    """Function returns a function that builds an AllowList of a given size."""
+
+    def _make_allowlist(size: int) -> al_handler.AllowList:
+        database.db_write_allowlist(_make_entries(size))
+        return al_handler.AllowList(ala_conf)
+
+    return _make_allowlist
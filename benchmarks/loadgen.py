@@ -0,0 +1,276 @@
+"""End to end load generator for allowlistapp.
+
+Boots the app under waitress in a subprocess against a temporary instance dir, and for remote auth a stub
+Jellyfin style auth server, then hammers it with a mix of requests from many client threads.
+
+Examples:
+    python benchmarks/loadgen.py --clients 32 --duration 10
+    python benchmarks/loadgen.py --auth remote --stub-latency-ms 50 --mix check_auth=50,authenticate=50
+    python benchmarks/loadgen.py --threads 8 --nginx --json loadgen.json
+"""
+
+import argparse
+import contextlib
+import http.client
+import http.server
+import ipaddress
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+
+import tomlkit
+
+PASSWORD = "hunter2"  # noqa: S105 Only used against the throwaway instance.
+ENDPOINTS = {
+    "check_auth": ("GET", "/check_auth/"),
+    "authenticate": ("POST", "/authenticate/"),
+    "home": ("GET", "/"),
+}
+SERVER_START_TIMEOUT = 30
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _StubAuthHandler(http.server.BaseHTTPRequestHandler):
+    """Accepts PASSWORD and nothing else, like a Jellyfin authenticatebyname endpoint."""
+
+    latency = 0.0
+
+    def do_POST(self) -> None:  # noqa: N802 Name required by BaseHTTPRequestHandler
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.latency)
+        self.send_response(200 if body.get("Pw") == PASSWORD else 401)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args: object) -> None:
+        """Don't log every request to stderr."""
+
+
+def start_stub_auth_server(latency: float) -> tuple[http.server.ThreadingHTTPServer, str]:
+    """Start the stub remote auth server in a thread, returns the server and its url."""
+    handler = type("StubAuthHandler", (_StubAuthHandler,), {"latency": latency})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def write_instance_config(instance_path: str, args: argparse.Namespace, stub_url: str) -> None:
+    """Write the config.toml for the app under test."""
+    config: dict = {
+        "app": {"auth_type": "static", "revert_daily": False},
+        "auth": {"static": {"password_cleartext": PASSWORD}},
+        "logging": {"level": args.log_level},
+    }
+    if args.auth == "remote":
+        config["app"]["auth_type"] = "jellyfin"
+        config["auth"] = {"remote": {"url": stub_url}}
+    if args.nginx:
+        config["services"] = {
+            "nginx": {"enabled": True, "allowlist_path": os.path.join(instance_path, "ipallowlist.conf")}
+        }
+
+    with open(os.path.join(instance_path, "config.toml"), "w", encoding="utf8") as toml_file:
+        tomlkit.dump(config, toml_file)
+
+
+def start_app_server(instance_path: str, port: int, threads: int) -> subprocess.Popen:
+    """Start the app under waitress in a subprocess, wait until it accepts connections."""
+    code = (
+        "import waitress\n"
+        "from allowlistapp import create_app\n"
+        f"waitress.serve(create_app(instance_path={instance_path!r}), listen='127.0.0.1:{port}', threads={threads})\n"
+    )
+    log_file = open(os.path.join(instance_path, "server.log"), "w", encoding="utf8")  # noqa: SIM115 Closed with the process
+    process = subprocess.Popen([sys.executable, "-c", code], stdout=log_file, stderr=subprocess.STDOUT)  # noqa: S603 Our own interpreter
+
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            msg = f"App server exited during startup, see {log_file.name}"
+            raise RuntimeError(msg)
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return process
+        time.sleep(0.1)
+
+    process.terminate()
+    msg = f"App server didn't start within {SERVER_START_TIMEOUT}s, see {log_file.name}"
+    raise RuntimeError(msg)
+
+
+def parse_mix(mix: str) -> tuple[list[str], list[int]]:
+    """Parse 'check_auth=90,authenticate=5,home=5' into names and weights."""
+    names, weights = [], []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            msg = f"Unknown endpoint in mix: {name}, valid: {list(ENDPOINTS)}"
+            raise argparse.ArgumentTypeError(msg)
+        names.append(name)
+        weights.append(int(weight or 1))
+    return names, weights
+
+
+def _random_client_ip(rng: random.Random) -> str:
+    if rng.random() < 0.5:  # noqa: PLR2004 Half and half
+        return str(ipaddress.IPv4Address(rng.getrandbits(32)))
+    return str(ipaddress.IPv6Address(rng.getrandbits(128)))
+
+
+def client_worker(
+    port: int,
+    args: argparse.Namespace,
+    stop_at: float,
+    seed: int,
+    outcomes: list[tuple[dict[str, list[float]], dict[str, int]]],
+) -> None:
+    """Send requests until stop_at, append per endpoint latencies and error counts to outcomes."""
+    rng = random.Random(seed)
+    names, weights = parse_mix(args.mix)
+    ips = [_random_client_ip(rng) for _ in range(args.ips_per_client)]
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    latencies: dict[str, list[float]] = defaultdict(list)
+    failures: dict[str, int] = defaultdict(int)
+
+    while time.monotonic() < stop_at:
+        name = rng.choices(names, weights)[0]
+        method, path = ENDPOINTS[name]
+        headers = {"X-Forwarded-For": rng.choice(ips)}
+        body = None
+        if method == "POST":
+            body = urllib.parse.urlencode({"username": "loadgen", "password": PASSWORD})
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 500:  # noqa: PLR2004 Server errors, 403s are expected from /check_auth/
+                failures[name] += 1
+        except (OSError, http.client.HTTPException):
+            failures[name] += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        latencies[name].append(time.perf_counter() - start)
+
+    conn.close()
+    outcomes.append((latencies, failures))  # list.append is atomic, no lock needed
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    """Nearest rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarise(outcomes: list[tuple[dict[str, list[float]], dict[str, int]]], duration: float) -> dict:
+    """Summarise the run per endpoint and in total."""
+    results: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    for latencies, failures in outcomes:
+        for name, values in latencies.items():
+            results[name].extend(values)
+        for name, count in failures.items():
+            errors[name] += count
+
+    summary = {}
+    everything: list[float] = []
+    for name in sorted(set(results) | set(errors)):
+        values = sorted(results.get(name, []))
+        everything.extend(values)
+        summary[name] = _summarise_one(values, errors.get(name, 0), duration)
+    summary["total"] = _summarise_one(sorted(everything), sum(errors.values()), duration)
+    return summary
+
+
+def _summarise_one(values: list[float], error_count: int, duration: float) -> dict:
+    requests = len(values) + error_count
+    return {
+        "requests": requests,
+        "errors": error_count,
+        "error_rate": error_count / requests if requests else 0.0,
+        "throughput": len(values) / duration,
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "p999": percentile(values, 99.9),
+        "max": values[-1] if values else 0.0,
+    }
+
+
+def print_summary(summary: dict) -> None:
+    """Print the summary as a table, latencies in milliseconds."""
+    print(f"{'endpoint':<14} {'requests':>9} {'err%':>6} {'req/s':>9} {'p50':>9} {'p99':>9} {'p999':>9} {'max':>9}")  # noqa: T201
+    for name, row in summary.items():
+        print(  # noqa: T201
+            f"{name:<14} {row['requests']:>9} {row['error_rate'] * 100:>6.2f} {row['throughput']:>9.1f} "
+            f"{row['p50'] * 1e3:>9.2f} {row['p99'] * 1e3:>9.2f} {row['p999'] * 1e3:>9.2f} {row['max'] * 1e3:>9.2f}"
+        )
+
+
+def main() -> None:
+    """Run the load test."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--auth", choices=["static", "remote"], default="static")
+    parser.add_argument("--threads", type=int, default=4, help="Waitress worker threads.")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent client threads.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run for.")
+    parser.add_argument("--mix", default="check_auth=90,authenticate=5,home=5", help="Weighted endpoint mix.")
+    parser.add_argument("--ips-per-client", type=int, default=4, help="X-Forwarded-For addresses per client.")
+    parser.add_argument("--stub-latency-ms", type=float, default=20, help="Remote auth stub response time.")
+    parser.add_argument("--nginx", action="store_true", help="Enable the nginx handler, reloads included.")
+    parser.add_argument("--log-level", default="WARNING", help="Log level of the app under test.")
+    parser.add_argument("--json", default="", help="Also write the summary to this JSON file.")
+    args = parser.parse_args()
+    parse_mix(args.mix)  # Fail early on a bad mix
+
+    with tempfile.TemporaryDirectory(prefix="allowlistapp-loadgen-") as instance_path:
+        stub_server, stub_url = start_stub_auth_server(args.stub_latency_ms / 1000)
+        write_instance_config(instance_path, args, stub_url)
+        port = _free_port()
+        app_process = start_app_server(instance_path, port, args.threads)
+
+        outcomes: list[tuple[dict[str, list[float]], dict[str, int]]] = []
+        try:
+            start = time.monotonic()
+            stop_at = start + args.duration
+            workers = [
+                threading.Thread(target=client_worker, args=(port, args, stop_at, seed, outcomes))
+                for seed in range(args.clients)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.monotonic() - start
+        finally:
+            app_process.terminate()
+            app_process.wait()
+            stub_server.shutdown()
+
+    summary = summarise(outcomes, elapsed)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf8") as json_file:
+            json.dump({"args": vars(args), "summary": summary}, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Benchmark the in memory allowlist."""
+
+import ipaddress
+import itertools
+
+
+def test_is_in_allowlist_hit_first(bench, make_allowlist, size):
+    """Lookup of an address in the first entry, the best case."""
+    allowlist = make_allowlist(size)
+    ip = str(ipaddress.ip_network(allowlist.allowlist[0]["ip"])[0])
+
+    bench(lambda: allowlist.is_in_allowlist(ip))
+
+
+def test_is_in_allowlist_hit_last(bench, make_allowlist, size):
+    """Lookup of an address in the last entry."""
+    allowlist = make_allowlist(size)
+    ip = str(ipaddress.ip_network(allowlist.allowlist[-1]["ip"])[0])
+
+    bench(lambda: allowlist.is_in_allowlist(ip))
+
+
+def test_is_in_allowlist_miss_v4(bench, make_allowlist, size):
+    """Lookup of an IPv4 address that isn't in the list, what most /check_auth/ requests from strangers cost."""
+    allowlist = make_allowlist(size)
+
+    bench(lambda: allowlist.is_in_allowlist("198.51.100.1"))
+
+
+def test_is_in_allowlist_miss_v6(bench, make_allowlist, size):
+    """Lookup of an IPv6 address that isn't in the list."""
+    allowlist = make_allowlist(size)
+
+    bench(lambda: allowlist.is_in_allowlist("2001:db8::1"))
+
+
+def test_add_to_allowlist(bench, make_allowlist, size):
+    """Add a new address, this includes the lookup and the database write."""
+    allowlist = make_allowlist(size)
+    addresses = (str(ipaddress.IPv4Address("203.0.113.0") + i) for i in itertools.count())
+
+    # Take the previous round's entry back out so the list stays the same size
+    def _setup() -> None:
+        if len(allowlist.allowlist) > size:
+            allowlist.allowlist.pop()
+
+    bench(lambda: allowlist.add_to_allowlist("bench", next(addresses)), setup=_setup)
+
+
+def test_check_many(bench, make_allowlist, size):
+    """Check 100k addresses at once, half of them in the allowlist, like replaying an access log."""
+    allowlist = make_allowlist(size)
+    hits = [str(ipaddress.ip_network(item["ip"])[0]) for item in allowlist.allowlist]
+    misses = [str(ipaddress.IPv4Address("198.18.0.0") + i) for i in range(50_000)]
+    ips = list(itertools.islice(itertools.cycle(hits), 50_000)) + misses
+
+    bench(lambda: sum(allowed for _, allowed in allowlist.check_many(ips)))
@@ -0,0 +1,15 @@
+"""Benchmark searching the audit log."""
+
+from allowlistapp import audit
+
+
+def test_audit_search_user(bench, tmp_path, size):
+    """Search size * 10 audit records for one username, most lines are skipped without parsing."""
+    audit_log = audit.AuditLog(
+        {"path": str(tmp_path), "max_bytes": 10**9, "backup_count": 10, "flush_interval": 3600.0, "queue_size": 10**7}
+    )
+    for number in range(size * 10):
+        audit_log.record(f"10.0.{number // 256 % 256}.{number % 256}", f"user{number % 1000}", number % 3 != 0, 0.01)
+    audit_log.flush()
+
+    bench(lambda: sum(1 for _ in audit.search(str(tmp_path), username="user7")))
@@ -0,0 +1,17 @@
+"""Benchmark the CSV database."""
+
+from allowlistapp import database
+
+
+def test_db_get_allowlist(bench, db_path, make_entries, size):
+    """Read the whole database, what happens at startup."""
+    database.db_write_allowlist(make_entries(size))
+
+    bench(database.db_get_allowlist)
+
+
+def test_db_write_allowlist(bench, db_path, make_entries, size):
+    """Write the whole database, what happens on every add."""
+    entries = make_entries(size)
+
+    bench(lambda: database.db_write_allowlist(entries))
@@ -0,0 +1,39 @@
+"""Benchmark rendering and writing the nginx allowlist."""
+
+import os
+
+from allowlistapp import al_handler_nginx
+
+
+def test_nginx_write(bench, tmp_path, fp, make_entries, size):
+    """Render and write the nginx allowlist, the reload subprocess is mocked out."""
+    nginx_allowlist = al_handler_nginx.NGINXAllowlist()
+    fp.register(nginx_allowlist.reload_nginx_command, returncode=0)
+    fp.keep_last_process(keep=True)
+
+    ala_conf = {"services": {"nginx": {"allowlist_path": os.path.join(tmp_path, "ipallowlist.conf")}}}
+    entries = make_entries(size)
+
+    bench(lambda: nginx_allowlist.write(ala_conf, entries))
+
+
+def test_nginx_write_sharded_add(bench, tmp_path, fp, make_entries, size):
+    """Write the nginx allowlist for one add with hash sharding, only the one shard is rendered and written."""
+    nginx_allowlist = al_handler_nginx.NGINXAllowlist()
+    fp.register(nginx_allowlist.reload_nginx_command, returncode=0)
+    fp.keep_last_process(keep=True)
+
+    ala_conf = {
+        "services": {
+            "nginx": {
+                "allowlist_path": os.path.join(tmp_path, "ipallowlist.conf"),
+                "shard_mode": "hash",
+                "shard_count": 64,
+            }
+        }
+    }
+    entries = make_entries(size)
+    nginx_allowlist.write(ala_conf, entries)
+    events = [{"op": "add", "entry": entries[-1]}]
+
+    bench(lambda: nginx_allowlist.write(ala_conf, entries, events))
@@ -0,0 +1,33 @@
+"""Benchmark cold start, the import of the package and create_app."""
+
+import copy
+import subprocess
+import sys
+
+from argon2 import PasswordHasher
+
+from allowlistapp import create_app
+
+IMPORT_CODE = "import time; s = time.perf_counter(); import allowlistapp; print(time.perf_counter() - s)"
+
+
+def test_import_time(bench):
+    """Import the package in a fresh interpreter, what every worker and container restart pays."""
+
+    def _import() -> float:
+        result = subprocess.run([sys.executable, "-c", IMPORT_CODE], capture_output=True, text=True, check=True)  # noqa: S603 Our own interpreter
+        return float(result.stdout)
+
+    bench(_import, self_timed=True)
+
+
+def test_create_app(bench, tmp_path):
+    """Create the app with an already hashed password and an existing instance dir, like a restart."""
+    config = {
+        "app": {"auth_type": "static", "revert_daily": False},
+        "auth": {"static": {"password_cleartext": "", "password_hashed": PasswordHasher().hash("hunter2")}},
+        "logging": {"level": "WARNING"},
+        "flask": {"TESTING": True},
+    }
+
+    bench(lambda: create_app(copy.deepcopy(config), instance_path=tmp_path))
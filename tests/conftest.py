@@ -3,15 +3,16 @@
 Fixtures defined in a conftest.py can be used by any test in that package without needing to import them.
 """
 
+import csv
 import os
-from collections.abc import Callable
+from collections.abc import Callable, Iterator
 
 import pytest
 import tomlkit
 from flask import Flask
 from flask.testing import FlaskClient, FlaskCliRunner
 
-from allowlistapp import create_app
+from allowlistapp import al_handler, create_app, database
 
 TEST_CONFIGS_LOCATION = os.path.join(os.getcwd(), "tests", "configs")
 
@@ -73,3 +74,39 @@ def place_test_config(get_test_config) -> Callable:
             tomlkit.dump(config, file)
 
     return _place_test_config
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch) -> Iterator[str]:
+    """Point the database module at a temporary file, without needing a flask app."""
+    path = os.path.join(tmp_path, "database.csv")
+    monkeypatch.setattr(database, "database_path", path)
+    monkeypatch.setattr(al_handler, "nginx_allowlist", None)
+    yield path
+    database.db_flush()  # Don't leave background writes for the next test
+
+
+@pytest.fixture
+def ala_conf() -> dict:
+    """The least config an AllowList needs, for tests without a flask app."""
+    return {"app": {"revert_daily": False, "allowed_subnets": []}}
+
+
+@pytest.fixture
+def db_rows(db_path) -> Callable:
+    """Function returns a function, that reads the (username, ip) of every row in the database."""
+
+    def _db_rows() -> list[tuple[str, str]]:
+        try:
+            with open(db_path) as f:
+                return [(row["username"], row["ip"]) for row in csv.DictReader(f)]
+        except FileNotFoundError:
+            return []
+
+    return _db_rows
+
+
+@pytest.fixture
+def db_ips(db_rows) -> Callable:
+    """Function returns a function, that reads the ip of every row in the database."""
+    return lambda: [ip for _, ip in db_rows()]
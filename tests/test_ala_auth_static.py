@@ -1,12 +1,17 @@
 """PyTest, Tests the hello API endpoint."""
 
+import concurrent.futures
 import csv
 import os
+import threading
+import time
 from http import HTTPStatus
 
 import pytest
 from flask.testing import FlaskClient
 
+from allowlistapp import ala_auth
+
 
 def test_auth_static_fail(client: FlaskClient):
     """Test static authentication failure."""
@@ -44,3 +49,66 @@ def test_auth_static_success(tmp_path, headers, expected_entry, client: FlaskCli
     assert len(allowlist) == 1
     assert allowlist[0]["ip"] == expected_entry
     assert allowlist[0]["username"] == ""
+
+
+def test_auth_ipv6_network(tmp_path, client: FlaskClient):
+    """TEST: An IPv6 client is allowed its /64, so its next privacy address doesn't need another login."""
+    headers = {"X-Forwarded-For": "2001:db8:0:1:aaaa:bbbb:cccc:dddd"}
+    response = client.post("/authenticate/", data={"username": "", "password": "hunter2"}, headers=headers)
+    assert response.status_code == HTTPStatus.OK
+
+    response = client.get("/check_auth/", headers={"X-Forwarded-For": "2001:db8:0:1:1111:2222:3333:4444"})
+    assert response.status_code == HTTPStatus.OK
+    response = client.get("/check_auth/", headers={"X-Forwarded-For": "2001:db8:0:2::1"})
+    assert response.status_code == HTTPStatus.FORBIDDEN
+
+    with open(os.path.join(tmp_path, "database.csv")) as f:
+        assert [row["ip"] for row in csv.DictReader(f)] == ["2001:db8:0:1::/64"]
+
+
+def test_auth_coalesced(monkeypatch, app):
+    """TEST: The same login sent a few times at once is checked and added once, and they all get the result."""
+    check_password_static = ala_auth.check_password_static
+    checks = []
+
+    def _slow_check(password: str) -> bool:
+        checks.append(password)
+        time.sleep(0.3)  # Long enough for the others to catch up
+        return check_password_static(password)
+
+    monkeypatch.setattr(ala_auth, "check_password_static", _slow_check)
+
+    def _login(password: str) -> int:
+        return app.test_client().post("/authenticate/", data={"username": "", "password": password}).status_code
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(_login, ["hunter2", "hunter2", "hunter2", "hunter3"]))
+
+    assert results == [HTTPStatus.OK] * 3 + [HTTPStatus.FORBIDDEN]
+    assert sorted(checks) == ["hunter2", "hunter3"]  # A wrong password doesn't get the right one's result
+
+    # TEST: Once it's finished the next one is checked again
+    assert _login("hunter2") == HTTPStatus.OK
+    assert len(checks) == 3  # noqa: PLR2004 Checked again
+
+
+def test_single_flight_error():
+    """TEST: Everyone waiting on a call that raises gets the exception, and the key is free again after."""
+    single_flight = ala_auth.SingleFlight()
+    started = threading.Event()
+
+    def _fail() -> int:
+        started.set()
+        time.sleep(0.2)
+        raise ValueError("failed")  # noqa: EM101 It is a test
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(single_flight.run, "key", _fail)
+        started.wait()
+        follower = executor.submit(single_flight.run, "key", lambda: 1)
+        with pytest.raises(ValueError, match="failed"):
+            leader.result()
+        with pytest.raises(ValueError, match="failed"):
+            follower.result()
+
+    assert single_flight.run("key", lambda: 1) == (1, False)
@@ -0,0 +1,136 @@
+"""Test the in memory allowlist keeping itself small."""
+
+import csv
+
+import pytest
+
+from allowlistapp import al_handler, database
+
+
+def test_insert_prunes_subsumed(db_path, ala_conf, db_rows):
+    """TEST: Adding a network removes the same user's entries inside it, and other workers see that."""
+    worker_1 = al_handler.AllowList(ala_conf)
+    worker_2 = al_handler.AllowList(ala_conf)
+    worker_1.add_to_allowlist("bob", "10.0.0.1")
+    worker_1.add_to_allowlist("bob", "10.0.0.2")
+    worker_1.add_to_allowlist("alice", "10.0.0.3")
+    worker_1.add_to_allowlist("bob", "10.0.1.1")
+
+    assert worker_2.add_to_allowlist("bob", "10.0.0.0/24")
+    assert db_rows() == [("alice", "10.0.0.3"), ("bob", "10.0.1.1"), ("bob", "10.0.0.0/24")]
+
+    worker_1.is_in_allowlist("10.0.0.1")  # Syncs
+    assert [item["ip"] for item in worker_1.allowlist] == ["10.0.0.3", "10.0.1.1", "10.0.0.0/24"]
+
+    # TEST: A network inside one that's already there isn't added
+    assert not worker_1.add_to_allowlist("carol", "10.0.0.128/25")
+    assert not worker_1.add_to_allowlist("carol", "10.0.0.0/24")
+
+
+def test_insert_keeps_default_entries(db_path, db_rows, ala_conf):
+    """TEST: The allowed_subnets are never pruned, nor do they prune anything."""
+    ala_conf["app"]["allowed_subnets"] = ["192.168.1.0/24"]
+    allowlist = al_handler.AllowList(ala_conf)
+    allowlist.add_to_allowlist("default", "192.168.0.0/16")
+    allowlist.add_to_allowlist("bob", "172.16.0.1")
+    allowlist.add_to_allowlist("default", "172.16.0.0/12")
+    assert db_rows() == [
+        ("default", "192.168.1.0/24"),
+        ("default", "192.168.0.0/16"),
+        ("bob", "172.16.0.1"),
+        ("default", "172.16.0.0/12"),
+    ]
+
+
+def test_compact(db_path, ala_conf, db_rows):
+    """TEST: Duplicates are dropped and each user's entries merged, other workers see the merge."""
+    rows = [
+        ("default", "192.168.1.0/24"),
+        ("default", "192.168.1.0/24"),
+        ("bob", "10.0.0.1"),
+        ("bob", "10.0.0.1"),
+        ("alice", "10.0.0.2"),
+        ("bob", "10.0.0.0"),
+        ("bob", "10.0.0.2/31"),
+        ("bob", "2001:db8::1"),
+        ("bob", "10.0.0.9"),
+    ]
+    with open(db_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=database.CSV_SCHEMA.keys())
+        writer.writeheader()
+        for number, (username, ip) in enumerate(rows):
+            writer.writerow({"username": username, "ip": ip, "date": f"2024-01-0{number + 1}"})
+
+    worker_1 = al_handler.AllowList(ala_conf)
+    worker_2 = al_handler.AllowList(ala_conf)
+    stats = worker_1.compact()
+
+    expected = [
+        ("default", "192.168.1.0/24"),
+        ("alice", "10.0.0.2"),
+        ("bob", "10.0.0.0/30"),
+        ("bob", "2001:db8::1"),
+        ("bob", "10.0.0.9"),
+    ]
+    assert db_rows() == expected
+    assert stats["rows_before"] == len(rows)
+    assert stats["rows_after"] == len(expected)
+    assert stats["bytes_after"] < stats["bytes_before"]
+    assert next(item for item in worker_1.allowlist if item["ip"] == "10.0.0.0/30")["date"] == "2024-01-07"
+
+    worker_2.is_in_allowlist("10.0.0.1")  # Syncs
+    assert ("bob", "10.0.0.0/30") in [(item["username"], item["ip"]) for item in worker_2.allowlist]
+    assert ("bob", "10.0.0.1") not in [(item["username"], item["ip"]) for item in worker_2.allowlist]
+
+    # TEST: Compacting again changes nothing
+    stats = worker_1.compact()
+    assert stats["rows_before"] == stats["rows_after"]
+
+
+def test_compact_cli(app):
+    """TEST: The compact command reports what it saved."""
+    result = app.test_cli_runner().invoke(args=["allowlist", "compact"])
+    assert "Rows: " in result.output
+    assert "Bytes: " in result.output
+
+
+def test_check_many(db_path, ala_conf):
+    """TEST: The batch check agrees with is_in_allowlist, for both IP versions and things that aren't IPs."""
+    allowlist = al_handler.AllowList(ala_conf)
+    for ip in ["10.0.0.0/24", "10.0.1.0/24", "10.0.0.128/25", "192.168.5.5", "2001:db8::/64", "10.0.3.7"]:
+        allowlist.add_to_allowlist("bob", ip)
+
+    ips = ["10.0.0.0", "10.0.1.255", "10.0.2.0", "192.168.5.5", "192.168.5.6", "10.0.3.7", "9.255.255.255"]
+    ips += ["2001:db8::1", "2001:db8:0:1::", "::ffff:10.0.0.1", "not an ip", "", "10.0.0.1/32"]
+    assert list(allowlist.check_many(ips)) == [(ip, allowlist.is_in_allowlist(ip)) for ip in ips]
+    assert dict(allowlist.check_many(["10.0.1.255", "10.0.2.0"])) == {"10.0.1.255": True, "10.0.2.0": False}
+
+
+def test_range_index():
+    """TEST: Addresses are read in network order, the byteorder argument is needed before python 3.11."""
+    ranges = al_handler._RangeIndex([{"ip": "10.0.0.0/24"}, {"ip": "2001:db8::/64"}])
+
+    assert "10.0.0.5" in ranges
+    assert "5.0.0.10" not in ranges  # What 10.0.0.5 would be little endian
+    assert "2001:db8::ff" in ranges
+    assert "ff00::b80d:120" not in ranges
+
+
+@pytest.mark.parametrize(
+    ("ip", "expected"),
+    [
+        ("2001:db8:1:2:a:b:c:d", "2001:db8:1:2::/64"),
+        ("10.1.2.3", "10.1.2.3"),
+        ("10.1.2.3/8", "10.1.2.3/8"),  # Only addresses are widened
+        ("not an ip", "not an ip"),
+    ],
+)
+def test_client_network(ip, expected):
+    """TEST: Client IPs are widened to the configured prefix."""
+    assert al_handler.client_network(ip, {"ipv6_prefix": 64, "ipv4_prefix": 32}) == expected
+
+
+def test_client_network_ipv4():
+    """TEST: IPv4 clients are widened too if it's set."""
+    assert al_handler.client_network("10.1.2.3", {"ipv6_prefix": 128, "ipv4_prefix": 24}) == "10.1.2.0/24"
+    assert al_handler.client_network("2001:db8::1", {"ipv6_prefix": 128, "ipv4_prefix": 24}) == "2001:db8::1"
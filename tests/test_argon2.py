@@ -0,0 +1,54 @@
+"""Test the argon2 cost calibration and rehashing."""
+
+import os
+from http import HTTPStatus
+
+import tomlkit
+
+from allowlistapp import config, create_app
+
+
+def test_calibrate_argon2():
+    """TEST: The calibrated costs are never below the minimums, and a bigger target doesn't get fewer passes."""
+    fast = config.calibrate_argon2(1, config.ARGON2_MIN_MEMORY_KIB)
+    assert fast["time_cost"] == config.ARGON2_MIN_TIME_COST
+    assert fast["memory_cost"] == config.ARGON2_MIN_MEMORY_KIB
+    assert 1 <= fast["parallelism"] <= config.ARGON2_MAX_PARALLELISM
+
+    slow = config.calibrate_argon2(1000, config.ARGON2_MIN_MEMORY_KIB)
+    assert slow["time_cost"] >= fast["time_cost"]
+    assert slow["time_cost"] <= config.ARGON2_MAX_TIME_COST
+
+
+def test_calibrate_on_startup(tmp_path, get_test_config):
+    """TEST: With a target set, the costs are calibrated once and saved in the config file."""
+    test_config = get_test_config("valid_argon2.toml")
+    test_config["argon2"] = {"target_ms": 1, "max_memory_kib": config.ARGON2_MIN_MEMORY_KIB}
+    app = create_app(test_config, instance_path=tmp_path)
+    assert app.config["argon2"]["time_cost"] == config.ARGON2_MIN_TIME_COST
+
+    with open(os.path.join(tmp_path, "config.toml"), encoding="utf8") as config_file:
+        saved = tomlkit.load(config_file)
+    assert saved["argon2"]["memory_cost"] == config.ARGON2_MIN_MEMORY_KIB
+
+
+def test_rehash_on_login(tmp_path, get_test_config):
+    """TEST: A password hashed with other costs is rehashed with the configured ones on login, and still works."""
+    app = create_app(get_test_config("valid_argon2.toml"), instance_path=tmp_path)
+    client = app.test_client()
+    old_hash = app.config["auth"]["static"]["password_hashed"]
+
+    response = client.post("/authenticate/", data={"username": "", "password": "hunter2"})
+    assert response.status_code == HTTPStatus.OK
+
+    new_hash = app.config["auth"]["static"]["password_hashed"]
+    assert new_hash != old_hash
+    assert "$m=19456,t=2,p=1$" in new_hash
+    with open(os.path.join(tmp_path, "config.toml"), encoding="utf8") as config_file:
+        assert tomlkit.load(config_file)["auth"]["static"]["password_hashed"] == new_hash
+
+    response = client.post("/authenticate/", data={"username": "", "password": "hunter2"})
+    assert response.status_code == HTTPStatus.OK
+    assert app.config["auth"]["static"]["password_hashed"] == new_hash  # Not rehashed again
+    response = client.post("/authenticate/", data={"username": "", "password": "hunter3"})
+    assert response.status_code == HTTPStatus.FORBIDDEN
@@ -0,0 +1,106 @@
+"""Test the audit log."""
+
+import datetime
+import json
+import os
+import time
+import typing
+
+from allowlistapp import audit, create_app
+
+
+def _audit_conf(path, **overrides: float) -> dict:
+    return {
+        "path": str(path),
+        "max_bytes": 10_000_000,
+        "backup_count": 10,
+        "flush_interval": 60.0,
+        "queue_size": 100,
+    } | overrides
+
+
+def test_audit_disabled(tmp_path, client):
+    """TEST: Nothing is audited unless enabled."""
+    client.post("/authenticate/", data={"username": "", "password": "hunter2"})
+    assert audit.audit_log is None
+    assert not os.path.exists(os.path.join(tmp_path, "audit"))
+
+
+def test_audit_enabled(tmp_path, get_test_config):
+    """TEST: Logins are recorded once flushed, and the CLI can search them."""
+    app = create_app(get_test_config("valid_audit.toml"), instance_path=tmp_path)
+    client = app.test_client()
+
+    client.post("/authenticate/", data={"username": "alice", "password": "hunter2"})
+    client.post("/authenticate/", data={"username": "bob", "password": "wrong"})
+    assert audit.audit_log is not None
+    audit.audit_log.flush()
+
+    with open(os.path.join(tmp_path, "audit", "audit.jsonl"), encoding="utf8") as audit_file:
+        records = [json.loads(line) for line in audit_file]
+    assert [(r["ip"], r["user"], r["result"]) for r in records] == [
+        ("127.0.0.1", "alice", "success"),
+        ("127.0.0.1", "bob", "failure"),
+    ]
+    assert records[0]["ms"] >= 0
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["audit", "search", "--user", "bob"])
+    assert [json.loads(line)["result"] for line in result.output.splitlines()] == ["failure"]
+
+    result = runner.invoke(args=["audit", "search", "--count"])
+    assert json.loads(result.output) == {"success": 1, "failure": 1}
+
+
+def test_audit_search(tmp_path):
+    """TEST: Every filter is applied, a username that is a prefix of another doesn't match it."""
+    audit_log = audit.AuditLog(_audit_conf(tmp_path))
+    audit_log.record("10.0.0.1", "bob", True, 0.01)  # It's the auth result
+    audit_log.record("10.0.0.1", "bobby", False, 0.01)
+    audit_log.record("10.0.0.10", "bob", False, 0.01)
+    audit_log.flush()
+
+    def _search(**filters: typing.Any) -> list[tuple]:  # noqa: ANN401 Passed straight to search
+        return [(r["ip"], r["user"], r["result"]) for r in audit.search(str(tmp_path), **filters)]
+
+    assert _search(username="bob") == [("10.0.0.1", "bob", "success"), ("10.0.0.10", "bob", "failure")]
+    assert _search(ip="10.0.0.1") == [("10.0.0.1", "bob", "success"), ("10.0.0.1", "bobby", "failure")]
+    assert _search(ip="10.0.0.1", result="failure") == [("10.0.0.1", "bobby", "failure")]
+    assert _search(since=time.time() + 60) == []
+    assert _search(until=time.time() - 60) == []
+    assert len(_search(since=time.time() - 60)) == 3  # noqa: PLR2004 All of them
+
+
+def test_audit_rotation(tmp_path):
+    """TEST: Big files are rotated, the oldest are deleted, and search still reads them in order."""
+    audit_log = audit.AuditLog(_audit_conf(tmp_path, max_bytes=1, backup_count=2))
+    for number in range(4):
+        audit_log.record("10.0.0.1", f"user{number}", True, 0.01)  # It's the auth result
+        audit_log.flush()  # Every flush goes over max_bytes
+
+    files = audit.audit_files(str(tmp_path))
+    assert len(files) == 2  # noqa: PLR2004 backup_count
+    assert [r["user"] for r in audit.search(str(tmp_path))] == ["user2", "user3"]
+
+
+def test_audit_rotation_name(tmp_path):
+    """TEST: A rotated file is named for when it was rotated, in UTC."""
+    audit_log = audit.AuditLog(_audit_conf(tmp_path, max_bytes=1))
+    audit_log.record("10.0.0.1", "bob", True, 0.01)  # It's the auth result
+    audit_log.flush()
+
+    rotated = [name for name in os.listdir(tmp_path) if name.startswith("audit-")]
+    assert len(rotated) == 1
+    stamp = datetime.datetime.strptime(rotated[0], "audit-%Y%m%dT%H%M%S.%fZ.jsonl")
+    rotated_at = stamp.replace(tzinfo=datetime.timezone.utc).timestamp()  # noqa: UP017 datetime.UTC is 3.11+
+    assert abs(time.time() - rotated_at) < 60  # noqa: PLR2004
+    assert not os.path.exists(os.path.join(tmp_path, audit.CURRENT_FILE))
+
+
+def test_audit_queue_full(tmp_path):
+    """TEST: Records past the queue size are dropped rather than held."""
+    audit_log = audit.AuditLog(_audit_conf(tmp_path, queue_size=2))
+    for _ in range(5):
+        audit_log.record("10.0.0.1", "bob", True, 0.01)  # It's the auth result
+    audit_log.flush()
+    assert len(list(audit.search(str(tmp_path)))) == 2  # noqa: PLR2004 The queue size
@@ -0,0 +1,56 @@
+"""Test checking a batch of IPs over HTTP and from the CLI."""
+
+import json
+from http import HTTPStatus
+
+import pytest
+
+from allowlistapp import config, create_app
+
+
+def test_check_many_disabled(client):
+    """TEST: The endpoint isn't there unless enabled."""
+    response = client.post("/check_many/", data="10.0.0.1\n")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_check_many(tmp_path, get_test_config):
+    """TEST: Each line gets a result, in order, and the token is needed."""
+    app = create_app(get_test_config("valid_check_many.toml"), instance_path=tmp_path)
+    client = app.test_client()
+
+    response = client.post("/check_many/", data="10.0.0.1\n")
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+    response = client.post(
+        "/check_many/", data="10.0.0.1\n10.0.1.1\n\n10.0.0.255\n", headers={"Authorization": "Bearer sekrit"}
+    )
+    assert response.status_code == HTTPStatus.OK
+    assert response.data == b"10.0.0.1 yep\n10.0.1.1 nope\n10.0.0.255 yep\n"
+
+    # TEST: It can't be enabled without a token
+    test_config = get_test_config("valid_check_many.toml")
+    test_config["check_many"]["token"] = ""
+    with pytest.raises(config.ConfigValidationError):
+        create_app(test_config, instance_path=tmp_path / "no_token")
+
+
+def test_check_cli(tmp_path, get_test_config):
+    """TEST: The IPs in an access log are checked."""
+    app = create_app(get_test_config("valid_check_many.toml"), instance_path=tmp_path)
+    log_path = tmp_path / "access.log"
+    log_path.write_text(
+        '10.0.0.1 - - [01/Jun/2024:12:00:00 +0000] "GET / HTTP/1.1" 200 1\n'
+        '10.0.1.1 - - [01/Jun/2024:12:00:01 +0000] "GET / HTTP/1.1" 403 1\n'
+        "\n"
+    )
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["allowlist", "check", str(log_path)])
+    assert result.output == "10.0.0.1 yep\n10.0.1.1 nope\n"
+
+    result = runner.invoke(args=["allowlist", "check", "--denied", str(log_path)])
+    assert result.output == "10.0.1.1 nope\n"
+
+    result = runner.invoke(args=["allowlist", "check", "--count"], input="10.0.0.7\n10.0.0.8\n8.8.8.8\n")
+    assert json.loads(result.output) == {"yep": 2, "nope": 1}
@@ -104,3 +104,11 @@ def test_config_invalid_allowed_subnets(tmp_path, get_test_config, caplog):
 
     with caplog.at_level(logging.ERROR):
         assert "Invalid IP/network address: TEST_INVALID_IP" in caplog.text
+
+
+def test_config_invalid_prefix(tmp_path, get_test_config):
+    """TEST: A client network prefix longer than the IP version allows doesn't validate."""
+    test_config = get_test_config("valid_testing_true.toml")
+    test_config["app"]["ipv4_prefix"] = 33
+    with pytest.raises(config.ConfigValidationError, match="ipv4_prefix"):
+        create_app(test_config, instance_path=tmp_path)
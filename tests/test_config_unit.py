@@ -118,3 +118,59 @@ def test_load_write_no_config_path(place_test_config, tmp_path):
     # TEST: PermissionsError is raised.
     with pytest.raises(ValueError, match="Config path not set, cannot write config"):
         conf._write_config()
+
+
+def test_config_write_only_when_changed(tmp_path, place_test_config, mocker: pytest_mock.plugin.MockerFixture):
+    """Test that the config file is only written when the loaded config differs from what's on disk."""
+    place_test_config("valid_testing_true.toml", tmp_path)
+
+    # The placed config is missing defaults and has a cleartext password, so this one writes.
+    allowlistapp.config.AllowListAppConfig(instance_path=tmp_path)
+
+    spy = mocker.spy(allowlistapp.config.AllowListAppConfig, "_write_config")
+
+    # TEST: Nothing has changed, nothing is written.
+    allowlistapp.config.AllowListAppConfig(instance_path=tmp_path)
+    assert spy.call_count == 0
+
+
+def test_config_passed_write_only_when_changed(tmp_path, get_test_config, mocker: pytest_mock.plugin.MockerFixture):
+    """Test that a passed in config is compared with the file too, and only serialised when it's written."""
+    config = get_test_config("valid_testing_true.toml")
+    allowlistapp.config.AllowListAppConfig(config=config, instance_path=tmp_path)  # Creates the file
+
+    write_spy = mocker.spy(allowlistapp.config.AllowListAppConfig, "_write_config")
+    dumps_spy = mocker.spy(allowlistapp.config.tomlkit, "dumps")
+
+    # TEST: The file already has this config, nothing is written.
+    allowlistapp.config.AllowListAppConfig(config=config, instance_path=tmp_path)
+    assert write_spy.call_count == 0
+    assert dumps_spy.call_count == 0
+
+    # TEST: A changed config is written, and serialised once to do it.
+    allowlistapp.config.AllowListAppConfig(config=config | {"logging": {"level": "DEBUG"}}, instance_path=tmp_path)
+    assert write_spy.call_count == 1
+    assert dumps_spy.call_count == 1
+
+
+def test_config_saved_when_invalid(tmp_path, place_test_config):
+    """Test that a config that doesn't validate is still saved, so the new default entries are there to fill in."""
+    place_test_config("invalid_static_auth_no_password.toml", tmp_path)
+
+    with pytest.raises(allowlistapp.config.ConfigPasswordError):
+        allowlistapp.config.AllowListAppConfig(instance_path=tmp_path)
+
+    # TEST: The sections missing from the file have been added.
+    with open(tmp_path / "config.toml", encoding="utf8") as config_file:
+        assert "[expiry]" in config_file.read()
+
+
+def test_config_defaults_not_shared(tmp_path, get_test_config):
+    """Test that changing a loaded config doesn't change the defaults."""
+    conf = allowlistapp.config.AllowListAppConfig(
+        config=get_test_config("valid_testing_true.toml"), instance_path=tmp_path
+    )
+
+    # TEST: Sections filled in from the defaults are copies.
+    conf["services"]["nginx"]["allowlist_path"] = "changed"
+    assert DEFAULT_CONFIG["services"]["nginx"]["allowlist_path"] == ""
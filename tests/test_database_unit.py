@@ -0,0 +1,144 @@
+"""Unit test the database writes, including from multiple processes at once."""
+
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+import pytest_mock
+
+from allowlistapp import al_handler, database
+
+WRITER_CODE = """
+import sys
+from allowlistapp import al_handler, database
+
+database.database_path = sys.argv[1]
+worker, count = int(sys.argv[2]), int(sys.argv[3])
+database.durability = sys.argv[4]
+allowlist = al_handler.AllowList({"app": {"revert_daily": False, "allowed_subnets": []}})
+for i in range(count):
+    allowlist.add_to_allowlist(f"worker{worker}", f"10.{worker}.{i // 256}.{i % 256}")
+"""
+
+READER_CODE = """
+import csv, os, sys, time
+
+path, stop_file = sys.argv[1], sys.argv[2]
+reads = torn = 0
+while not os.path.exists(stop_file):
+    try:
+        with open(path, newline="") as f:
+            rows = list(csv.reader(f))
+    except FileNotFoundError:
+        continue
+    reads += 1
+    if not rows or rows[0] != ["username", "ip", "date"] or any(len(row) != 3 for row in rows):
+        torn += 1
+print(reads, torn)
+"""
+
+
+@pytest.mark.parametrize("durability", ["write", "group", "async"])
+def test_concurrent_writers(db_path, tmp_path, durability, db_ips):
+    """TEST: Writers in several processes don't lose each other's entries and readers never see a torn file."""
+    workers, count = 4, 50
+    stop_file = os.path.join(tmp_path, "stop")
+
+    reader_args = [sys.executable, "-c", READER_CODE, db_path, stop_file]
+    reader = subprocess.Popen(reader_args, stdout=subprocess.PIPE, text=True)  # noqa: S603
+    writers = [
+        subprocess.Popen([sys.executable, "-c", WRITER_CODE, db_path, str(worker), str(count), durability])  # noqa: S603
+        for worker in range(workers)
+    ]
+    for writer in writers:
+        assert writer.wait(timeout=120) == 0
+
+    open(stop_file, "w").close()
+    reads, torn = (int(value) for value in reader.communicate(timeout=30)[0].split())
+
+    ips = db_ips()
+
+    assert len(ips) == workers * count
+    assert len(set(ips)) == workers * count
+    assert reads > 0
+    assert torn == 0
+
+    # TEST: No temp files left behind
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_failed_write_keeps_database(db_path, mocker: pytest_mock.plugin.MockerFixture):
+    """TEST: If a write fails part way through, the old database is untouched and the temp file is cleaned up."""
+    database.db_write_allowlist([{"username": "user", "ip": "10.0.0.1", "date": ""}])
+
+    mocker.patch("csv.DictWriter.writerow", side_effect=OSError("No space left on device"))
+    with pytest.raises(OSError, match="No space left"):
+        database.db_write_allowlist([{"username": "user", "ip": "10.0.0.2", "date": ""}])
+
+    assert database.db_get_allowlist() == [{"username": "user", "ip": "10.0.0.1", "date": ""}]
+    assert not os.path.exists(f"{db_path}.{os.getpid()}.tmp")
+
+
+def test_fsync(db_path, monkeypatch, mocker: pytest_mock.plugin.MockerFixture):
+    """TEST: With fsync on, the file and the directory are synced."""
+    monkeypatch.setattr(database, "durability", "fsync")
+    fsync = mocker.spy(os, "fsync")
+
+    database.db_reset()
+
+    assert fsync.call_count == 2  # noqa: PLR2004 The file, then the directory
+
+
+def test_group_commit(db_path, monkeypatch, mocker: pytest_mock.plugin.MockerFixture, ala_conf, db_ips):
+    """TEST: Concurrent adds in group mode share writes, and every add is on disk when it returns."""
+    monkeypatch.setattr(database, "durability", "group")
+    monkeypatch.setattr(database, "group_commit_seconds", 0.05)
+    allowlist = al_handler.AllowList(ala_conf)
+    fsync = mocker.spy(os, "fsync")
+    on_disk = []
+
+    def _add(i: int) -> None:
+        allowlist.add_to_allowlist("user", f"10.0.0.{i}")
+        on_disk.append(f"10.0.0.{i}" in db_ips())
+
+    threads = [threading.Thread(target=_add, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert on_disk == [True] * 20
+    assert 0 < fsync.call_count < 20  # noqa: PLR2004 Two per write, far fewer writes than adds
+    assert len(db_ips()) == 20  # noqa: PLR2004
+
+
+def test_async_write_behind(db_path, monkeypatch, ala_conf, db_ips):
+    """TEST: In async mode adds return before the write, other workers still see them through the journal."""
+    monkeypatch.setattr(database, "durability", "async")
+    monkeypatch.setattr(database, "group_commit_seconds", 0.5)
+    allowlist = al_handler.AllowList(ala_conf)
+
+    allowlist.add_to_allowlist("user", "10.0.0.1")
+    assert "10.0.0.1" not in db_ips()
+
+    # A worker starting now, like after a crash, gets it from the journal
+    assert al_handler.AllowList(ala_conf).is_in_allowlist("10.0.0.1")
+
+    database.db_flush()
+    assert db_ips() == ["10.0.0.1"]
+
+
+def test_background_write_failure(db_path, monkeypatch, mocker: pytest_mock.plugin.MockerFixture, ala_conf, db_ips):
+    """TEST: A failed background write is raised in the request waiting on it."""
+    monkeypatch.setattr(database, "durability", "group")
+    allowlist = al_handler.AllowList(ala_conf)
+
+    mocker.patch("csv.DictWriter.writerow", side_effect=OSError("No space left on device"))
+    with pytest.raises(OSError, match="No space left"):
+        allowlist.add_to_allowlist("user", "10.0.0.1")
+
+    mocker.stopall()
+    allowlist.add_to_allowlist("user", "10.0.0.2")
+    assert db_ips() == ["10.0.0.1", "10.0.0.2"]
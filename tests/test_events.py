@@ -0,0 +1,136 @@
+"""Test the server-sent events stream of allowlist changes."""
+
+import json
+from collections.abc import Iterator
+
+import pytest
+from flask import Flask
+
+from allowlistapp import ala_auth, config, create_app, events, journal
+
+AUTH = {"Authorization": "Bearer events-token"}
+
+
+@pytest.fixture
+def app(tmp_path, get_test_config) -> Flask:
+    """An app with the events stream enabled."""
+    return create_app(get_test_config("valid_events.toml"), instance_path=tmp_path)
+
+
+def _parse(chunk: str) -> list[dict]:
+    """Parse server-sent events into dicts of their fields, data decoded."""
+    parsed = []
+    for block in chunk.strip().split("\n\n"):
+        if block.startswith(":"):
+            continue
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        fields["data"] = json.loads(fields["data"])
+        parsed.append(fields)
+    return parsed
+
+
+def _stream(last_event_id: int | None = None) -> Iterator[str]:
+    assert ala_auth.al is not None
+    return events.stream(ala_auth.al, last_event_id, poll_interval=0.01, heartbeat_interval=60)
+
+
+def _login(client, ip: str) -> None:
+    client.post("/authenticate/", data={"username": "user", "password": "hunter2"}, headers={"X-Forwarded-For": ip})
+
+
+def test_stream(app):
+    """TEST: A new stream starts with the whole allowlist, then each change as it happens."""
+    client = app.test_client()
+    changes = _stream()
+
+    start = _parse(next(changes) + next(changes))
+    assert [event["event"] for event in start] == ["reset", "add"]
+    assert start[1]["data"]["entry"]["ip"] == "127.0.0.1"
+    assert "id" not in start[0]
+    assert start[1]["id"] == "1"
+
+    _login(client, "10.0.0.1")
+    added = _parse(next(changes))
+    assert added == [{"id": "2", "event": "add", "data": {"seq": 2, "op": "add", "entry": added[0]["data"]["entry"]}}]
+    assert added[0]["data"]["entry"]["ip"] == "10.0.0.1"
+
+    assert ala_auth.al is not None
+    ala_auth.al.reset()
+    assert [(event["id"], event["event"]) for event in _parse(next(changes))] == [("3", "reset"), ("4", "add")]
+    changes.close()
+
+
+def test_resume(app, monkeypatch):
+    """TEST: Last-Event-ID carries on from there, or starts over if the journal doesn't go back that far."""
+    client = app.test_client()
+    _login(client, "10.0.0.1")
+    _login(client, "10.0.0.2")
+
+    resumed = _parse(next(_stream(2)))
+    assert [(event["id"], event["data"]["entry"]["ip"]) for event in resumed] == [("3", "10.0.0.2")]
+
+    monkeypatch.setattr(journal, "JOURNAL_MAX_BYTES", 100)
+    _login(client, "10.0.0.3")  # Replaces the journal
+    changes = _stream(2)
+    restarted = _parse(next(changes))
+    assert restarted[0]["event"] == "reset"
+    assert "id" not in restarted[0]
+    assert [event["data"]["entry"]["ip"] for event in _parse("".join(next(changes) for _ in range(4)))] == [
+        "127.0.0.1",
+        "10.0.0.1",
+        "10.0.0.2",
+        "10.0.0.3",
+    ]
+
+
+def test_events_endpoint(app):
+    """TEST: The endpoint streams with the Last-Event-ID header, and checks the token."""
+    client = app.test_client()
+    _login(client, "10.0.0.1")
+    assert client.get("/events").status_code == 401  # noqa: PLR2004
+
+    response = client.get("/events", headers={"Last-Event-ID": "1", **AUTH}, buffered=False)
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache"
+    first = _parse(next(response.response).decode())
+    assert [(event["id"], event["event"]) for event in first] == [("2", "add")]
+    response.close()
+
+
+def test_events_max_streams(app):
+    """TEST: Streams past max_streams get a 503, and a closed stream frees its place."""
+    client = app.test_client()
+    streams = [client.get("/events", headers=AUTH, buffered=False) for _ in range(2)]
+    assert [response.status_code for response in streams] == [200, 200]
+
+    response = client.get("/events", headers=AUTH, buffered=False)
+    assert response.status_code == 503  # noqa: PLR2004
+    assert response.headers["Retry-After"] == str(events.STREAM_RETRY_AFTER)
+
+    streams[1].close()  # Last first, the streamed request contexts are a stack in the one test thread
+    response = client.get("/events", headers=AUTH, buffered=False)
+    assert response.status_code == 200  # noqa: PLR2004
+    response.close()
+    streams[0].close()
+
+
+@pytest.mark.parametrize(
+    ("events_conf", "error"),
+    [
+        ({"token": ""}, "['events']['token'] has to be set"),
+        ({"max_streams": 4}, "['events']['max_streams'] has to be from 1 to below ['waitress']['threads']"),
+    ],
+)
+def test_events_config_invalid(tmp_path, get_test_config, events_conf, error):
+    """TEST: The stream needs a token, and can't take every server thread."""
+    test_config = get_test_config("valid_events.toml")
+    test_config["events"] |= events_conf
+    with pytest.raises(config.ConfigValidationError) as exc_info:
+        create_app(test_config, instance_path=tmp_path)
+    assert any(error in item for item in exc_info.value.args[0])
+
+
+def test_events_disabled(tmp_path, get_test_config):
+    """TEST: There's no stream unless it's enabled."""
+    client = create_app(get_test_config("valid_testing_true.toml"), instance_path=tmp_path).test_client()
+    assert client.get("/events").status_code == 404  # noqa: PLR2004
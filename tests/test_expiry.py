@@ -0,0 +1,124 @@
+"""Test tracking when entries were last used, and expiring the idle ones."""
+
+import csv
+import json
+import os
+import time
+
+from allowlistapp import al_handler, create_app, database, lastseen
+
+EXPIRY_CONF = {"idle_days": 30, "max_per_user": 0, "flush_interval": 3600, "check_interval": 3600}
+DAY = 24 * 60 * 60
+
+
+def _write_rows(db_path: str, rows: list[tuple[str, str, str]]) -> None:
+    with open(db_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=database.CSV_SCHEMA.keys())
+        writer.writeheader()
+        for username, ip, date in rows:
+            writer.writerow({"username": username, "ip": ip, "date": date})
+
+
+def _ips(allowlist: al_handler.AllowList) -> list[str]:
+    return [item["ip"] for item in allowlist.allowlist]
+
+
+def test_last_seen_flush(db_path, ala_conf):
+    """TEST: Lookups are only noted in memory until a flush, which merges every worker's and drops old entries."""
+    allowlist = al_handler.AllowList(ala_conf)
+    allowlist.start_expiry(EXPIRY_CONF)
+    allowlist.add_to_allowlist("bob", "10.0.0.1")
+    assert allowlist.last_seen is not None
+
+    assert allowlist.is_in_allowlist("10.0.0.1")
+    assert not os.path.exists(allowlist.last_seen.path)
+    allowlist.last_seen.flush()
+    with open(allowlist.last_seen.path) as f:
+        assert list(json.load(f)) == ["10.0.0.1"]
+
+    # TEST: Another worker's times are merged, not overwritten
+    other = lastseen.LastSeen(db_path)
+    other.touch({"ip": "10.9.9.9", "username": "alice"})
+    other.flush()
+    assert set(allowlist.last_seen.load()) == {("10.0.0.1", "bob"), ("10.9.9.9", "alice")}
+
+    allowlist.last_seen.flush(allowlist.allowlist)
+    assert set(allowlist.last_seen.load()) == {("10.0.0.1", "bob")}
+
+
+def test_expire_idle(db_path, ala_conf):
+    """TEST: Entries idle past idle_days are expired, used ones and the allowed_subnets aren't."""
+    ala_conf["app"]["allowed_subnets"] = ["192.168.0.0/16"]
+    now = time.time()
+    _write_rows(
+        db_path,
+        [
+            ("bob", "10.0.0.1", "2020-01-01 00:00:00"),  # Old but used
+            ("bob", "10.0.0.2", "2020-01-01 00:00:00"),  # Old and never used
+            ("alice", "10.0.0.3", "not a date"),  # Unknown, kept
+        ],
+    )
+    worker_1 = al_handler.AllowList(ala_conf)
+    worker_2 = al_handler.AllowList(ala_conf)
+    worker_1.start_expiry(EXPIRY_CONF)
+    worker_2.start_expiry(EXPIRY_CONF)
+    worker_2.add_to_allowlist("carol", "10.0.0.4")  # Added just now
+
+    assert worker_2.is_in_allowlist("10.0.0.1")
+    assert worker_2.last_seen is not None
+    worker_2.last_seen.flush()
+
+    expired = worker_1.expire(now)
+    assert [item["ip"] for item in expired] == ["10.0.0.2"]
+    assert _ips(worker_1) == ["10.0.0.1", "10.0.0.3", "192.168.0.0/16", "10.0.0.4"]
+
+    # TEST: The other worker sees it, as an expire event
+    assert not worker_2.is_in_allowlist("10.0.0.2")
+    assert "10.0.0.2" not in _ips(worker_2)
+    assert worker_1.journal.replay()[-1]["op"] == "expire"
+
+    # TEST: Everything but the allowed_subnets goes once it's all idle
+    expired = worker_1.expire(now + 31 * DAY)
+    assert _ips(worker_1) == ["10.0.0.3", "192.168.0.0/16"]
+
+
+def test_login_refreshes(db_path, ala_conf):
+    """TEST: Logging in again from an address an entry covers counts as using it, nginx might never ask us."""
+    _write_rows(db_path, [("bob", "10.0.0.0/24", "2020-01-01 00:00:00")])
+    allowlist = al_handler.AllowList(ala_conf)
+    allowlist.start_expiry(EXPIRY_CONF)
+
+    assert not allowlist.add_to_allowlist("bob", "10.0.0.7")
+    assert allowlist.expire() == []
+    assert "10.0.0.0/24" in _ips(allowlist)
+
+
+def test_expire_max_per_user(db_path, ala_conf):
+    """TEST: Only each user's most recently used max_per_user entries are kept."""
+    ala_conf["app"]["allowed_subnets"] = ["192.168.0.0/16"]
+    allowlist = al_handler.AllowList(ala_conf)
+    allowlist.start_expiry({**EXPIRY_CONF, "idle_days": 0, "max_per_user": 2})
+    for ip in ["10.0.0.1", "10.0.0.2", "10.0.0.3"]:
+        allowlist.add_to_allowlist("bob", ip)
+    allowlist.add_to_allowlist("alice", "10.0.1.1")
+
+    assert allowlist.is_in_allowlist("10.0.0.1")  # Used more recently than it was added
+    assert [item["ip"] for item in allowlist.expire()] == ["10.0.0.2"]
+    assert _ips(allowlist) == ["192.168.0.0/16", "10.0.0.1", "10.0.0.3", "10.0.1.1"]
+
+
+def test_expire_cli(tmp_path, get_test_config):
+    """TEST: The expire command expires the idle entries, or says expiry isn't on."""
+    runner = create_app(get_test_config("valid_testing_true.toml"), instance_path=tmp_path).test_cli_runner()
+    assert "Expiry isn't enabled" in runner.invoke(args=["allowlist", "expire"]).output
+
+    test_config = get_test_config("valid_testing_true.toml")
+    test_config["expiry"] = {"enabled": True, "max_per_user": 1, "flush_interval": 3600}
+    app = create_app(test_config, instance_path=tmp_path)
+    client = app.test_client()
+    for ip in ["10.0.0.1", "10.0.0.2"]:
+        client.post("/authenticate/", data={"username": "", "password": "hunter2"}, headers={"X-Forwarded-For": ip})
+
+    result = app.test_cli_runner().invoke(args=["allowlist", "expire"])
+    assert result.output == " 10.0.0.1\n"
+    assert client.get("/check_auth/", headers={"X-Forwarded-For": "10.0.0.1"}).data == b"nope"
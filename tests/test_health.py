@@ -0,0 +1,60 @@
+"""Test the health endpoints and login shedding."""
+
+from http import HTTPStatus
+
+import responses
+
+from allowlistapp import create_app, health
+
+
+def test_healthz(client):
+    """TEST: The process answers."""
+    response = client.get("/healthz")
+    assert response.status_code == HTTPStatus.OK
+    assert response.data == b"ok"
+
+
+def test_readyz(app):
+    """TEST: Ready with the default config, and not ready when nginx can't be written."""
+    client = app.test_client()
+    response = client.get("/readyz")
+    assert response.status_code == HTTPStatus.OK
+    assert response.json == {"ready": True, "checks": {"storage": "ok", "nginx": "disabled", "auth": "ok"}}
+
+    app.config["services"]["nginx"]["enabled"] = True  # But the handler was never started
+    response = client.get("/readyz")
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert not response.json["ready"]
+    assert response.json["checks"]["nginx"] == "nginx handler not loaded"
+
+
+def test_readyz_remote_auth(client_url_auth):
+    """TEST: The remote auth backend is checked, and the result is cached for a bit."""
+    with responses.RequestsMock() as mocked_response:
+        mocked_response.add(responses.GET, "https://jf.example.com", status=HTTPStatus.BAD_GATEWAY)
+        response = client_url_auth.get("/readyz")
+        assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+        assert response.json["checks"]["auth"] == "https://jf.example.com returned 502"
+
+        client_url_auth.get("/readyz")
+        assert len(mocked_response.calls) == 1
+
+
+def test_auth_shedding(tmp_path, get_test_config):
+    """TEST: Logins past max_in_flight_auth get a 503 with Retry-After, other requests don't."""
+    test_config = get_test_config("valid_testing_true.toml")
+    test_config["health"] = {"max_in_flight_auth": 1, "retry_after": 3}
+    client = create_app(test_config, instance_path=tmp_path).test_client()
+
+    assert health._auth_slots is not None
+    assert health._auth_slots.acquire(blocking=False)  # A login in progress
+    response = client.post("/authenticate/", data={"username": "", "password": "hunter2"})
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.headers["Retry-After"] == "3"
+    assert client.get("/check_auth/").status_code == HTTPStatus.FORBIDDEN
+    health._auth_slots.release()
+
+    # TEST: The slot is given back after each login
+    for _ in range(2):
+        response = client.post("/authenticate/", data={"username": "", "password": "hunter2"})
+        assert response.status_code == HTTPStatus.OK
@@ -1,5 +1,7 @@
 """PyTest, Tests the hello API endpoint."""
 
+import gzip
+import re
 from http import HTTPStatus
 
 from flask.testing import FlaskClient
@@ -32,3 +34,49 @@ def test_static_js_exists(client: FlaskClient):
     response = client.get("/static/allowlist.js")
     # TEST: That the javascript loads
     assert response.status_code == HTTPStatus.OK
+
+
+def test_home_cached(client: FlaskClient):
+    """TEST: The home page has an ETag, and asking again with it gets a 304."""
+    response = client.get("/")
+    assert response.headers["Cache-Control"] == "no-cache"
+    etag = response.headers["ETag"]
+
+    response = client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+    assert response.data == b""
+
+
+def test_home_redirect_url_reload(app):
+    """TEST: The home page is rendered again when the redirect_url changes."""
+    client = app.test_client()
+    app.config["app"]["redirect_url"] = "https://example.com/changed"
+    assert b"https://example.com/changed" in client.get("/").data
+
+
+def test_assets(client: FlaskClient):
+    """TEST: The page links hashed assets, which are cached for good, gzipped, and link hashed fonts."""
+    page = client.get("/").data.decode()
+    css_url = re.search(r'href="(assets/zy\.[0-9a-f]+\.css)"', page)[1]  # type: ignore[index]
+    js_url = re.search(r'src="(assets/allowlist\.[0-9a-f]+\.js)"', page)[1]  # type: ignore[index]
+
+    response = client.get(f"/{js_url}")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert response.data == client.get("/static/allowlist.js").data
+
+    response = client.get(f"/{css_url}", headers={"Accept-Encoding": "gzip, deflate, br"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    css = gzip.decompress(response.data).decode()
+    assert "/static/" not in css
+    font_url = re.search(r'url\("(fonts/fira-code-400\.[0-9a-f]+\.woff2)"\)', css)[1]  # type: ignore[index]
+
+    response = client.get(f"/assets/{font_url}", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == HTTPStatus.OK
+    assert "Content-Encoding" not in response.headers  # Already compressed
+    assert response.content_type == "font/woff2"
+
+    response = client.get(f"/assets/{font_url}", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+    assert client.get("/assets/zy.0000.css").status_code == HTTPStatus.NOT_FOUND
@@ -0,0 +1,67 @@
+"""Test that allowlists in different processes, sharing a database, see each other's changes.
+
+Each AllowList has its own journal view, so two in one process behave like two worker processes.
+"""
+
+import os
+
+from allowlistapp import al_handler, journal
+
+
+def test_changes_seen_by_other_workers(db_path, ala_conf, db_ips):
+    """TEST: An add in one worker is seen by the other, and writes don't clobber each other."""
+    worker_1 = al_handler.AllowList(ala_conf)
+    worker_2 = al_handler.AllowList(ala_conf)
+
+    worker_1.add_to_allowlist("user1", "10.0.0.1")
+    assert worker_2.is_in_allowlist("10.0.0.1")
+
+    worker_2.add_to_allowlist("user2", "10.0.0.2")
+    assert worker_1.is_in_allowlist("10.0.0.2")
+
+    # TEST: The second write included the first worker's entry
+    assert db_ips() == ["10.0.0.1", "10.0.0.2"]
+
+    # TEST: A duplicate add from the other worker is caught
+    assert not worker_2.add_to_allowlist("user1", "10.0.0.1")
+
+
+def test_removals_seen_by_other_workers(db_path, ala_conf):
+    """TEST: Removing subnets in one worker is seen by the other."""
+    worker_1 = al_handler.AllowList(ala_conf)
+    worker_2 = al_handler.AllowList(ala_conf)
+
+    worker_1.update_allowed_subnets([], ["192.168.1.0/24"])
+    assert worker_2.is_in_allowlist("192.168.1.10")
+
+    worker_1.update_allowed_subnets(["192.168.1.0/24"], [])
+    assert not worker_2.is_in_allowlist("192.168.1.10")
+    assert worker_2.allowlist == []
+
+
+def test_journal_rotation(db_path, monkeypatch, ala_conf):
+    """TEST: When the journal is replaced, the other worker reloads the whole database."""
+    monkeypatch.setattr(journal, "JOURNAL_MAX_BYTES", 500)
+
+    worker_1 = al_handler.AllowList(ala_conf)
+    worker_2 = al_handler.AllowList(ala_conf)
+
+    inode_before = os.stat(worker_1.journal.journal_path).st_ino
+    for i in range(10):
+        worker_1.add_to_allowlist("user", f"10.0.0.{i}")
+    assert os.stat(worker_1.journal.journal_path).st_ino != inode_before
+
+    for i in range(10):
+        assert worker_2.is_in_allowlist(f"10.0.0.{i}")
+    assert worker_2.journal.seq == worker_1.journal.seq
+
+
+def test_partial_line_not_read(db_path, ala_conf):
+    """TEST: A journal line that is still being written is left until it's complete."""
+    worker_1 = al_handler.AllowList(ala_conf)
+    worker_2 = al_handler.AllowList(ala_conf)
+
+    with open(worker_1.journal.journal_path, "a") as f:
+        f.write('{"seq":1,"op":"add","entry":{"username":"","ip":"10.0.0.1","da')
+
+    assert worker_2.journal.read_new() == []
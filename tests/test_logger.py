@@ -1,10 +1,12 @@
 """Test the logger of the app."""
 
+import json
 import logging
 import os
 from types import FunctionType
 
 import pytest
+import pytest_mock
 from flask import Flask
 
 import allowlistapp.logger
@@ -56,3 +58,49 @@ def test_handlers_added(tmp_path, app: Flask):
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
         handler.close()
+
+
+def test_queue_logging(tmp_path, app: Flask):
+    """TEST: In queue mode our handlers sit behind the queue, and turning it off writes out what was queued."""
+    logger = logging.getLogger("TEST_QUEUE_LOGGER")
+    log_path = os.path.join(tmp_path, "test.log")
+    logging_conf = {"path": log_path, "level": "INFO", "format": "json", "queue": True, "queue_size": 100}
+
+    allowlistapp.logger.setup_logger(app, logging_conf, logger)
+    assert [type(handler) for handler in logger.handlers] == [allowlistapp.logger._QueueHandler]
+
+    logger.info("Queued %s", "message")
+
+    allowlistapp.logger.setup_logger(app, {**logging_conf, "queue": False}, logger)
+    assert len(logger.handlers) == 2  # noqa: PLR2004 Back to the console and file handlers
+
+    with open(log_path) as f:
+        lines = [json.loads(line) for line in f]
+    assert {"level": "INFO", "logger": "TEST_QUEUE_LOGGER", "message": "Queued message"}.items() <= lines[0].items()
+
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def test_queue_logging_exit_hooks(tmp_path, app: Flask, mocker: pytest_mock.MockerFixture):
+    """TEST: Reconfiguring the queue swaps the exit hook for the new listener, rather than adding another."""
+    hooks: list = []
+    mocker.patch("atexit.register", hooks.append)
+    mocker.patch("atexit.unregister", hooks.remove)
+    logger = logging.getLogger("TEST_QUEUE_HOOKS_LOGGER")
+    logging_conf = {"path": os.path.join(tmp_path, "test.log"), "level": "INFO", "queue": True, "queue_size": 100}
+
+    for _ in range(3):
+        allowlistapp.logger.setup_logger(app, logging_conf, logger)
+
+    queue_handler = logger.handlers[0]
+    assert isinstance(queue_handler, allowlistapp.logger._QueueHandler)
+    assert hooks == [queue_handler.stop]
+
+    allowlistapp.logger.setup_logger(app, {**logging_conf, "queue": False}, logger)
+    assert hooks == []
+
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
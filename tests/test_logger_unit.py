@@ -1,7 +1,10 @@
 """Test the logger of the app."""
 
+import json
 import logging
 import os
+import queue
+import sys
 
 import pytest
 import pytest_mock
@@ -63,3 +66,46 @@ def test_set_log_level(log_level_in: str | int, log_level_expected: int):
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
         handler.close()
+
+
+def test_json_formatter():
+    """TEST: The JSON formatter writes one object per record, with the traceback if there is one."""
+    from allowlistapp.logger import JSONFormatter
+
+    try:
+        msg = "Oh no"
+        raise ValueError(msg)  # noqa: TRY301 Need a real traceback
+    except ValueError:
+        record = logging.LogRecord("TEST_LOGGER", logging.ERROR, __file__, 1, "Failed: %s", ("thing",), sys.exc_info())
+
+    entry = json.loads(JSONFormatter().format(record))
+    assert entry["level"] == "ERROR"
+    assert entry["message"] == "Failed: thing"
+    assert "ValueError: Oh no" in entry["exception"]
+
+
+def test_queue_overflow():
+    """TEST: When the queue is full records are dropped and counted, then reported once there's room."""
+    from logging.handlers import QueueListener
+
+    from allowlistapp import metrics
+    from allowlistapp.logger import _QueueHandler
+
+    log_queue: queue.Queue = queue.Queue(maxsize=1)
+    handler = _QueueHandler(log_queue, QueueListener(log_queue), "drop")
+    dropped_before = metrics.LOG_DROPPED_TOTAL.labels().get()
+
+    for i in range(3):
+        handler.handle(logging.LogRecord("TEST_LOGGER", logging.INFO, __file__, 1, "Message %s", (i,), None))
+
+    assert handler.dropped == 2  # noqa: PLR2004
+    assert metrics.LOG_DROPPED_TOTAL.labels().get() == dropped_before + 2
+
+    assert log_queue.get_nowait().getMessage() == "Message 0"
+    log_queue = queue.Queue()  # Plenty of room
+    handler._log_queue = log_queue
+    handler.handle(logging.LogRecord("TEST_LOGGER", logging.INFO, __file__, 1, "Message 3", (), None))
+    assert [log_queue.get_nowait().getMessage() for _ in range(2)] == [
+        "Log queue was full, dropped 2 messages",
+        "Message 3",
+    ]
@@ -0,0 +1,37 @@
+"""Test the metrics endpoint."""
+
+from http import HTTPStatus
+
+from allowlistapp import create_app, metrics
+
+
+def test_metrics_disabled(client):
+    """TEST: The metrics endpoint doesn't exist unless enabled."""
+    response = client.get("/metrics")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_metrics_enabled(tmp_path, get_test_config):
+    """TEST: Authenticating and checking shows up in the metrics."""
+    client = create_app(get_test_config("valid_metrics.toml"), instance_path=tmp_path).test_client()
+
+    failures_before = metrics.AUTH_TOTAL.labels("failure").get()
+    client.post("/authenticate/", data={"username": "", "password": "hunter3"})
+    client.post("/authenticate/", data={"username": "", "password": "hunter2"})
+    client.get("/check_auth/")
+
+    response = client.get("/metrics")
+    assert response.status_code == HTTPStatus.OK
+    assert response.content_type == metrics.CONTENT_TYPE
+
+    text = response.data.decode()
+    for name in [
+        "allowlistapp_lookup_seconds_bucket",
+        "allowlistapp_allowlist_entries 1",
+        "allowlistapp_db_write_seconds_count",
+        "allowlistapp_argon2_verify_seconds_sum",
+        'allowlistapp_auth_total{result="success"}',
+    ]:
+        assert name in text
+
+    assert metrics.AUTH_TOTAL.labels("failure").get() == failures_before + 1
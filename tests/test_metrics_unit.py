@@ -0,0 +1,92 @@
+"""Unit test the metric types."""
+
+import gc
+import threading
+
+import pytest
+
+from allowlistapp import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Use an empty registry so test metrics don't end up in the real one."""
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+    return metrics.REGISTRY
+
+
+def test_histogram_buckets(registry):
+    """TEST: Observations land in the right cumulative buckets."""
+    histogram = metrics.Histogram("test_seconds", "Test.", buckets=(0.1, 1.0))
+
+    for value in [0.05, 0.1, 0.5, 5.0]:
+        histogram.observe(value)
+
+    text = metrics.render()
+    assert 'test_seconds_bucket{le="0.1"} 2' in text  # le is inclusive
+    assert 'test_seconds_bucket{le="1"} 3' in text
+    assert 'test_seconds_bucket{le="+Inf"} 4' in text
+    assert "test_seconds_count 4" in text
+    assert "test_seconds_sum 5.65" in text
+
+
+def test_counter_threads(registry):
+    """TEST: Counts from every thread's shard are summed."""
+    counter = metrics.Counter("test_total", "Test.", ("result",))
+
+    def _work() -> None:
+        for _ in range(1000):
+            counter.labels("ok").inc()
+
+    threads = [threading.Thread(target=_work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counter.labels("ok").get() == 4000  # noqa: PLR2004
+    assert 'test_total{result="ok"} 4000' in metrics.render()
+
+
+def test_wrong_labels(registry):
+    """TEST: Using the wrong number of labels raises."""
+    counter = metrics.Counter("test_total", "Test.", ("result",))
+
+    with pytest.raises(ValueError, match="expects labels"):
+        counter.inc()
+
+
+def test_exited_thread_shards(registry):
+    """TEST: A thread's shard is merged into the total when it exits, rather than kept forever."""
+    counter = metrics.Counter("test_total", "Test.")
+    counter.inc()
+
+    for _ in range(10):
+        thread = threading.Thread(target=counter.inc, args=(2,))
+        thread.start()
+        thread.join()
+    gc.collect()
+
+    values = counter.labels()._values
+    assert len(values._shards) == 1  # Only this thread's is left
+    assert counter.labels().get() == 21  # noqa: PLR2004
+
+
+def test_metric_abstract(registry):
+    """TEST: A metric type has to say how to create and render its children."""
+    with pytest.raises(TypeError, match="abstract"):
+        metrics._Metric("test_total", "Test.")  # type: ignore[abstract]
+
+
+def test_exited_thread_equal_shard(registry):
+    """TEST: Retiring a shard leaves a live shard holding the same counts alone."""
+    counter = metrics.Counter("test_total", "Test.")
+    counter.inc()
+
+    thread = threading.Thread(target=counter.inc)
+    thread.start()
+    thread.join()
+    gc.collect()
+    counter.inc()
+
+    assert counter.labels().get() == 3  # noqa: PLR2004
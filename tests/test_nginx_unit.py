@@ -101,3 +101,73 @@ def test_invalid_allowlist_path(path, expected_log, fp, caplog):
 
     with caplog.at_level(logging.CRITICAL):
         assert expected_log in caplog.text
+
+
+def _sharded_writer(fp, tmp_path, shard_mode: str) -> tuple[al_handler_nginx.NGINXAllowlist, dict]:
+    nginx_allowlist = al_handler_nginx.NGINXAllowlist()
+    fp.register(nginx_allowlist.reload_nginx_command, returncode=0)
+    fp.keep_last_process(keep=True)
+    ala_conf = {
+        "services": {
+            "nginx": {
+                "allowlist_path": os.path.join(tmp_path, "ipallowlist.conf"),
+                "shard_mode": shard_mode,
+                "shard_count": 4,
+            },
+        },
+    }
+    return nginx_allowlist, ala_conf
+
+
+def _includes(tmp_path) -> list[str]:
+    with open(os.path.join(tmp_path, "ipallowlist.conf")) as f:
+        lines = f.read().splitlines()
+    assert lines[-1] == "deny all;"
+    return [
+        os.path.basename(line.removeprefix("include ").removesuffix(";"))
+        for line in lines
+        if line.startswith("include")
+    ]
+
+
+def test_hash_shards(tmp_path, fp, mocker):
+    """TEST: Hash sharding writes every shard once, then only the shard an add lands in."""
+    nginx_allowlist, ala_conf = _sharded_writer(fp, tmp_path, "hash")
+    allowlist = [{"date": "", "ip": f"10.0.0.{i}", "username": "user"} for i in range(20)]
+
+    nginx_allowlist.write(ala_conf, allowlist)
+    assert _includes(tmp_path) == ["hash-000.conf", "hash-001.conf", "hash-002.conf", "hash-003.conf"]
+    shard_text = ""
+    for name in _includes(tmp_path):
+        with open(os.path.join(tmp_path, "ipallowlist.conf.d", name)) as f:
+            shard_text += f.read()
+    assert sorted(shard_text.splitlines()) == sorted(f"allow {item['ip']}; # user, " for item in allowlist)
+
+    write_file = mocker.spy(nginx_allowlist, "_write_file")
+    new_item = {"date": "", "ip": "10.0.1.1", "username": "user"}
+    nginx_allowlist.write(ala_conf, [*allowlist, new_item], [{"op": "add", "entry": new_item}])
+
+    assert write_file.call_count == 1  # Just the shard, the top level file didn't change
+    with open(write_file.call_args.args[0]) as f:
+        assert "allow 10.0.1.1;" in f.read()
+
+
+def test_user_shards(tmp_path, fp):
+    """TEST: User sharding adds and removes a file per user, and a reset clears out the old ones."""
+    nginx_allowlist, ala_conf = _sharded_writer(fp, tmp_path, "user")
+    alice = {"date": "", "ip": "10.0.0.1", "username": "alice"}
+    bob = {"date": "", "ip": "10.0.0.2", "username": "../bob"}
+
+    nginx_allowlist.write(ala_conf, [alice])
+    nginx_allowlist.write(ala_conf, [alice, bob], [{"op": "add", "entry": bob}])
+    includes = _includes(tmp_path)
+    assert len(includes) == 2  # noqa: PLR2004
+    assert all(name.startswith(("user-alice-", "user-_bob-")) for name in includes)
+
+    nginx_allowlist.write(ala_conf, [bob], [{"op": "remove", "entry": alice}])
+    assert [name for name in _includes(tmp_path) if "alice" in name] == []
+    assert len(os.listdir(os.path.join(tmp_path, "ipallowlist.conf.d"))) == 1
+
+    nginx_allowlist.write(ala_conf, [], [{"op": "reset"}])
+    assert _includes(tmp_path) == []
+    assert os.listdir(os.path.join(tmp_path, "ipallowlist.conf.d")) == []
@@ -0,0 +1,82 @@
+"""Test the request profiling."""
+
+import itertools
+import os
+from collections.abc import Iterator
+from http import HTTPStatus
+
+from allowlistapp import create_app, profiling
+
+
+def test_profiling_disabled(tmp_path, client):
+    """TEST: No profiles are written unless enabled."""
+    client.get("/check_auth/")
+    assert not os.path.exists(os.path.join(tmp_path, "profiles"))
+
+
+def test_profiling_enabled(tmp_path, get_test_config):
+    """TEST: Sampled requests are profiled, and the CLI can list and aggregate them."""
+    app = create_app(get_test_config("valid_profiling.toml"), instance_path=tmp_path)
+    client = app.test_client()
+
+    response = client.post("/authenticate/", data={"username": "", "password": "hunter2"})
+    assert response.status_code == HTTPStatus.OK
+    assert response.data == b"yep"  # The body still makes it through the middleware
+
+    client.get("/check_auth/")
+
+    profiles = os.listdir(os.path.join(tmp_path, "profiles"))
+    assert len(profiles) == 2  # noqa: PLR2004 Two requests, sample rate of 1
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["profiles", "list", "--match", "authenticate"])
+    assert ".POST.authenticate." in result.output
+    assert "check_auth" not in result.output
+
+    result = runner.invoke(args=["profiles", "aggregate", "--limit", "5"])
+    assert "Aggregated 2 profiles" in result.output
+    assert "function calls" in result.output
+
+
+def test_profiling_aggregate_nothing(app):
+    """TEST: Aggregating with no profiles doesn't blow up."""
+    result = app.test_cli_runner().invoke(args=["profiles", "aggregate"])
+    assert "No profiles found" in result.output
+
+
+def test_profiling_streamed(tmp_path):
+    """TEST: A streamed response is passed on as it's made, the profile stops at the first chunk."""
+    closed = []
+
+    def _endless(environ, start_response) -> Iterator[bytes]:  # It's WSGI
+        start_response("200 OK", [("Content-Type", "text/event-stream")])
+        try:
+            while True:
+                yield b"data: x\n\n"
+        finally:
+            closed.append(True)
+
+    middleware = profiling.ProfilerMiddleware(_endless, {"sample_rate": 1.0, "path": str(tmp_path), "max_files": 0})
+    body = middleware({"PATH_INFO": "/events", "REQUEST_METHOD": "GET"}, lambda *_: None)
+    assert len(os.listdir(tmp_path)) == 1
+    assert list(itertools.islice(body, 3)) == [b"data: x\n\n"] * 3
+
+    # TEST: The next request is profiled too, the stream doesn't hold the profiler
+    middleware({"PATH_INFO": "/events", "REQUEST_METHOD": "GET"}, lambda *_: None).close()
+    assert len(os.listdir(tmp_path)) == 2  # noqa: PLR2004 Both requests
+    assert closed == [True]
+
+    body.close()  # type: ignore[attr-defined]
+    assert closed == [True, True]
+
+
+def test_profiling_max_files(tmp_path):
+    """TEST: Past max_files the oldest profiles are deleted."""
+    middleware = profiling.ProfilerMiddleware(
+        lambda environ, start_response: [b"ok"], {"sample_rate": 1.0, "path": str(tmp_path), "max_files": 2}
+    )
+    for path in ("/first", "/second", "/third"):
+        middleware({"PATH_INFO": path, "REQUEST_METHOD": "GET"}, lambda *_: None)
+
+    names = [os.path.basename(path) for path in profiling.list_profiles(str(tmp_path))]
+    assert [name.split(".")[2] for name in names] == ["second", "third"]
@@ -0,0 +1,74 @@
+"""Test reloading the config without a restart."""
+
+import csv
+import logging
+import os
+
+import pytest
+import tomlkit
+
+from allowlistapp import ala_auth, create_app, reload
+
+
+def _edit_config(tmp_path, edit) -> None:
+    config_path = os.path.join(tmp_path, "config.toml")
+    with open(config_path) as f:
+        config = tomlkit.load(f)
+    edit(config)
+    with open(config_path, "w") as f:
+        tomlkit.dump(config, f)
+
+
+def _db_ips(tmp_path) -> list[str]:
+    with open(os.path.join(tmp_path, "database.csv")) as f:
+        return [row["ip"] for row in csv.DictReader(f)]
+
+
+def test_reload_config(tmp_path, place_test_config, caplog: pytest.LogCaptureFixture):
+    """TEST: Hot reloadable config is applied, subnets are reconciled, and other changes are warned about."""
+    place_test_config("valid_reload.toml", tmp_path)
+    app = create_app(test_config=None, instance_path=tmp_path)
+    client = app.test_client()
+
+    # A user logs in, their entry should survive the reload
+    client.post("/authenticate/", data={"username": "", "password": "hunter2"}, headers={"X-Forwarded-For": "10.1.1.1"})
+    assert ala_auth.al is not None
+    allowlist_before = ala_auth.al
+
+    def _edit(config) -> None:
+        config["app"]["allowed_subnets"] = ["127.0.0.1", "172.16.0.0/12"]
+        config["app"]["redirect_url"] = "https://after.example.com"
+        config["logging"]["level"] = "WARNING"
+        config["app"]["revert_daily"] = True
+
+    _edit_config(tmp_path, _edit)
+
+    with caplog.at_level(logging.INFO):
+        reload.reload_config(app)
+        assert "Config change to [app][revert_daily] needs a restart to take effect" in caplog.text
+        assert logging.getLogger().getEffectiveLevel() == logging.WARNING  # caplog resets this on exit
+
+    # TEST: The allowlist object is the same, only the changed subnets were touched
+    assert ala_auth.al is allowlist_before
+    assert _db_ips(tmp_path) == ["127.0.0.1", "10.1.1.1", "172.16.0.0/12"]
+
+    # TEST: The rest of the hot reloadable config is applied
+    assert b"https://after.example.com" in client.get("/").data
+
+
+def test_reload_invalid_config(tmp_path, place_test_config, caplog: pytest.LogCaptureFixture):
+    """TEST: A config that doesn't validate is not applied."""
+    place_test_config("valid_reload.toml", tmp_path)
+    app = create_app(test_config=None, instance_path=tmp_path)
+
+    def _edit(config) -> None:
+        config["app"]["auth_type"] = "not a real auth type"
+        config["app"]["redirect_url"] = "https://after.example.com"
+
+    _edit_config(tmp_path, _edit)
+
+    with caplog.at_level(logging.ERROR):
+        reload.reload_config(app)
+        assert "Config reload failed, keeping the current config" in caplog.text
+
+    assert app.config["app"]["redirect_url"] == "https://before.example.com"
@@ -0,0 +1,241 @@
+"""Test replicating the allowlist between nodes."""
+
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+import tomlkit
+
+from allowlistapp import ala_auth, config, create_app, replication
+
+TOKEN = {"Authorization": "Bearer replication-token"}
+
+# Not waitress, it drops the X-Forwarded-For the tests use to log in from different addresses
+SERVER_CODE = """
+import sys
+from werkzeug.serving import make_server
+from allowlistapp import create_app
+make_server("127.0.0.1", int(sys.argv[2]), create_app(instance_path=sys.argv[1]), threaded=True).serve_forever()
+"""
+
+
+@pytest.fixture
+def client(tmp_path, get_test_config):
+    """A node with replication enabled and no peers."""
+    return create_app(get_test_config("valid_replication.toml"), instance_path=tmp_path).test_client()
+
+
+def _login(client, ip: str) -> None:
+    client.post("/authenticate/", data={"username": "user", "password": "hunter2"}, headers={"X-Forwarded-For": ip})
+
+
+def test_replication_needs_token(tmp_path, get_test_config, client):
+    """TEST: The feed needs the token, and replication can't be enabled without one."""
+    assert client.get("/replication/changes").status_code == 401  # noqa: PLR2004
+    assert client.get("/replication/changes", headers={"Authorization": "Bearer wrong"}).status_code == 401  # noqa: PLR2004
+    assert client.get("/replication/changes", headers=TOKEN).status_code == 200  # noqa: PLR2004
+
+    test_config = get_test_config("valid_replication.toml")
+    test_config["replication"]["token"] = ""
+    with pytest.raises(config.ConfigValidationError):
+        create_app(test_config, instance_path=tmp_path / "no_token")
+
+
+def test_change_feed(client):
+    """TEST: The feed has the logins, not the allowed_subnets, and pages through the journal."""
+    _login(client, "10.0.0.1")
+    _login(client, "10.0.0.2")
+
+    feed = client.get("/replication/changes", headers=TOKEN).json
+    assert feed["complete"]
+    assert [change["entry"]["ip"] for change in feed["changes"]] == ["10.0.0.1", "10.0.0.2"]
+    assert {change["origin"] for change in feed["changes"]} == {replication.node_id}
+    assert feed["seq"] == feed["latest"]
+
+    page = client.get("/replication/changes", query_string={"since": 0, "limit": 2}, headers=TOKEN).json
+    assert [change["entry"]["ip"] for change in page["changes"]] == ["10.0.0.1"]  # The first event is the subnet
+    assert page["seq"] < page["latest"]
+
+    # TEST: A peer that's ahead of us (we lost our database) is told it's missed changes
+    assert not client.get("/replication/changes", query_string={"since": 1000}, headers=TOKEN).json["complete"]
+
+
+def test_apply_changes(client):
+    """TEST: Changes from other nodes are applied once and keep their origin when passed on."""
+    assert ala_auth.al is not None
+    change = {"op": "add", "entry": {"username": "user", "ip": "10.0.0.9", "date": ""}, "origin": "a", "origin_seq": 3}
+
+    assert len(ala_auth.al.apply_changes([change])) == 1
+    assert ala_auth.al.apply_changes([change]) == []
+    assert ala_auth.al.is_in_allowlist("10.0.0.9")
+
+    feed = client.get("/replication/changes", headers=TOKEN).json
+    assert feed["changes"] == [change]
+
+    snapshot = client.get("/replication/snapshot", headers=TOKEN).json
+    assert snapshot["entries"] == [change["entry"]]
+    assert snapshot["hash"] == replication.entries_hash(snapshot["entries"])
+    assert "entries" not in client.get("/replication/snapshot?hash_only=1", headers=TOKEN).json
+
+
+def test_apply_removals(client):
+    """TEST: Expiries and resets from other nodes are applied, a reset only removes the logins from before it."""
+    assert ala_auth.al is not None
+    old = {"username": "user", "ip": "10.0.0.1", "date": "2024-01-01 00:00:00"}
+    new = {"username": "user", "ip": "10.0.0.2", "date": "2024-01-03 00:00:00"}
+    gone = {"username": "user", "ip": "10.0.0.3", "date": "2024-01-01 00:00:00"}
+    ala_auth.al.apply_changes(
+        [{"op": "add", "entry": entry, "origin": "a", "origin_seq": 1} for entry in (old, new, gone)]
+    )
+
+    applied = ala_auth.al.apply_changes(
+        [
+            {"op": "expire", "entry": gone, "origin": "a", "origin_seq": 2},
+            {"op": "reset", "date": "2024-01-02 00:00:00", "origin": "a", "origin_seq": 3},
+        ]
+    )
+    assert [(change["op"], change["entry"]["ip"]) for change in applied] == [
+        ("expire", "10.0.0.3"),
+        ("remove", "10.0.0.1"),
+    ]
+    assert [item["ip"] for item in ala_auth.al.allowlist if item["username"] == "user"] == ["10.0.0.2"]
+
+    # TEST: This node's own expiries and resets go out on the feed
+    ala_auth.al.reset()
+    feed = client.get("/replication/changes", headers=TOKEN).json["changes"]
+    assert [change["op"] for change in feed[-2:]] == ["remove", "reset"]
+    assert feed[-1]["origin"] == replication.node_id
+    assert "date" in feed[-1]
+
+
+def test_apply_reset_timezones(client):
+    """TEST: A reset compares the dates as times, whatever timezone each was written in."""
+    assert ala_auth.al is not None
+    before = {"username": "user", "ip": "10.0.0.1", "date": "2024-01-02 01:00:00+02:00"}  # 23:00 UTC the day before
+    after = {"username": "user", "ip": "10.0.0.2", "date": "2024-01-01 23:30:00-01:00"}  # 00:30 UTC
+    unknown = {"username": "user", "ip": "10.0.0.3", "date": "not a date"}
+    ala_auth.al.apply_changes(
+        [{"op": "add", "entry": entry, "origin": "a", "origin_seq": 1} for entry in (before, after, unknown)]
+    )
+
+    reset = {"op": "reset", "date": "2024-01-02 00:00:00+00:00", "origin": "a", "origin_seq": 2}
+    assert [change["entry"]["ip"] for change in ala_auth.al.apply_changes([reset])] == ["10.0.0.1"]
+    assert [item["ip"] for item in ala_auth.al.allowlist if item["username"] == "user"] == ["10.0.0.2", "10.0.0.3"]
+
+
+def test_relay_reset_removes(client, monkeypatch):
+    """TEST: The removes from another node's reset are passed on with their own seqs, over as many pages as it takes."""
+    assert ala_auth.al is not None
+    monkeypatch.setattr(replication, "FEED_LIMIT", 5)
+    entries = [{"username": "user", "ip": f"10.0.0.{number}", "date": "2024-01-01 00:00:00"} for number in range(12)]
+    ala_auth.al.apply_changes([{"op": "add", "entry": entry, "origin": "a", "origin_seq": 1} for entry in entries])
+    ala_auth.al.apply_changes([{"op": "reset", "date": "2024-01-02 00:00:00+00:00", "origin": "a", "origin_seq": 2}])
+
+    removes = []
+    since = 0
+    while True:
+        feed = client.get("/replication/changes", query_string={"since": since}, headers=TOKEN).json
+        removes += [change for change in feed["changes"] if change["op"] == "remove"]
+        if feed["seq"] >= feed["latest"]:
+            break
+        since = feed["seq"]
+
+    assert len(removes) == len(entries)
+    assert {change["origin"] for change in removes} == {replication.node_id}
+    seqs = [change["origin_seq"] for change in removes]
+    assert seqs == sorted(set(seqs))
+
+
+def test_compare_keeps_removals(client, monkeypatch):
+    """TEST: A comparison with a peer that hasn't had the removals from here yet doesn't bring them back."""
+    assert ala_auth.al is not None
+    expired = {"username": "user", "ip": "10.0.0.1", "date": "2099-01-01 00:00:00"}
+    before_reset = {"username": "user", "ip": "10.0.0.2", "date": "2000-01-01 00:00:00"}
+    new = {"username": "user", "ip": "10.0.0.3", "date": "2099-01-01 00:00:00"}
+    ala_auth.al.apply_changes([{"op": "add", "entry": expired, "origin": "a", "origin_seq": 1}])
+    ala_auth.al.apply_changes([{"op": "expire", "entry": expired, "origin": "a", "origin_seq": 2}])
+    ala_auth.al.reset()
+
+    peer_entries = [expired, before_reset, new]
+    puller = replication.Puller(ala_auth.al, {"peers": [], "token": "t", "interval": 1, "anti_entropy_interval": 1})
+    monkeypatch.setattr(
+        puller, "_get", lambda *_: {"seq": 1, "hash": replication.entries_hash(peer_entries), "entries": peer_entries}
+    )
+    puller.compare("http://peer")
+    assert [item["ip"] for item in ala_auth.al.allowlist if item["username"] == "user"] == ["10.0.0.3"]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_node(instance_path, port: int, peers: list[int], get_test_config) -> subprocess.Popen:
+    os.makedirs(instance_path)
+    node_config = get_test_config("valid_replication.toml")
+    node_config["replication"]["peers"] = [f"http://127.0.0.1:{peer}" for peer in peers]
+    node_config["replication"]["interval"] = 0.1
+    node_config["flask"]["TESTING"] = False
+    node_config["app"]["allowed_subnets"] = []  # Or every request from the test would be let in
+    with open(os.path.join(instance_path, "config.toml"), "w") as f:
+        tomlkit.dump(node_config, f)
+
+    process = subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(instance_path), str(port)])  # noqa: S603
+    for _ in range(100):
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return process
+        time.sleep(0.1)
+    process.terminate()
+    pytest.fail("Node didn't start")
+
+
+def _wait_for(port: int, ip: str, attempts: int = 100) -> bool:
+    for _ in range(attempts):
+        response = requests.get(f"http://127.0.0.1:{port}/check_auth/", headers={"X-Forwarded-For": ip}, timeout=5)
+        if response.status_code == 200:  # noqa: PLR2004
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def test_replication_between_nodes(tmp_path, get_test_config):
+    """TEST: A login on one node lets the user in on the others, including through a node in between."""
+    port_a, port_b, port_c = _free_port(), _free_port(), _free_port()
+    nodes = [
+        _start_node(tmp_path / "a", port_a, [port_b], get_test_config),
+        _start_node(tmp_path / "b", port_b, [port_a], get_test_config),
+        _start_node(tmp_path / "c", port_c, [port_b], get_test_config),  # Only knows b
+    ]
+    try:
+        assert not _wait_for(port_c, "10.0.0.1", attempts=1)
+
+        response = requests.post(
+            f"http://127.0.0.1:{port_a}/authenticate/",
+            data={"username": "user", "password": "hunter2"},
+            headers={"X-Forwarded-For": "10.0.0.1"},
+            timeout=10,
+        )
+        assert response.status_code == 200  # noqa: PLR2004
+
+        assert _wait_for(port_b, "10.0.0.1")
+        assert _wait_for(port_c, "10.0.0.1")
+
+        # TEST: Logins on b make it to a, and on to c
+        requests.post(
+            f"http://127.0.0.1:{port_b}/authenticate/",
+            data={"username": "user", "password": "hunter2"},
+            headers={"X-Forwarded-For": "10.0.0.2"},
+            timeout=10,
+        )
+        assert _wait_for(port_a, "10.0.0.2")
+        assert _wait_for(port_c, "10.0.0.2")
+    finally:
+        for node in nodes:
+            node.terminate()
+            node.wait()
@@ -0,0 +1,68 @@
+"""Test the waitress entry point."""
+
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import tomlkit
+
+from allowlistapp import config, serve
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str) -> None:
+        super().__init__("localhost")
+        self.unix_path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+
+def test_waitress_options():
+    """TEST: The unix socket replaces the host and port, everything else is passed through."""
+    waitress_conf = config.DEFAULT_CONFIG["waitress"] | {"asyncore_use_poll": True}
+    options = serve.waitress_options(waitress_conf)
+    assert options["host"] == "127.0.0.1"
+    assert "unix_socket" not in options
+    assert options["asyncore_use_poll"]
+
+    options = serve.waitress_options(waitress_conf | {"unix_socket": "/run/allowlistapp.sock"})
+    assert options["unix_socket"] == "/run/allowlistapp.sock"
+    assert "host" not in options
+    assert "port" not in options
+
+
+def test_serve_unix_socket(tmp_path, get_test_config):
+    """TEST: The app is served on a unix socket, and X-Forwarded-For from the proxy is used."""
+    socket_path = os.path.join(tmp_path, "app.sock")
+    test_config = get_test_config("valid_testing_true.toml")
+    test_config["app"]["allowed_subnets"] = ["10.9.9.0/24"]
+    test_config["waitress"] = {"unix_socket": socket_path, "threads": 2}
+    with open(os.path.join(tmp_path, "config.toml"), "w") as config_file:
+        tomlkit.dump(test_config, config_file)
+
+    command = [sys.executable, "-m", "allowlistapp.serve", "--instance-path", str(tmp_path)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)  # noqa: S603
+    try:
+        for _ in range(200):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+
+        def _check(headers: dict) -> bytes:
+            connection = _UnixHTTPConnection(socket_path)
+            connection.request("GET", "/check_auth/", headers=headers)
+            body = connection.getresponse().read()
+            connection.close()
+            return body
+
+        assert _check({"X-Forwarded-For": "10.9.9.9"}) == b"yep"
+        assert _check({"X-Forwarded-For": "10.9.8.9"}) == b"nope"
+        assert _check({}) == b"nope"
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
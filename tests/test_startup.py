@@ -0,0 +1,42 @@
+"""Test startup, the startup report and that unused dependencies aren't imported."""
+
+import logging
+import subprocess
+import sys
+
+import pytest
+
+from allowlistapp import create_app
+
+LAZY_IMPORT_CODE = """
+import sys
+import tomlkit
+from allowlistapp import create_app
+
+with open({config_path!r}) as f:
+    create_app(tomlkit.load(f), instance_path={instance_path!r})
+print(" ".join(module for module in ["requests", "argon2"] if module in sys.modules))
+"""
+
+
+@pytest.mark.parametrize(
+    ("config_name", "expected_modules"),
+    [
+        ("valid_testing_static_auth.toml", "argon2"),
+        ("valid_url_auth_url.toml", "requests"),
+    ],
+)
+def test_lazy_imports(tmp_path, config_name, expected_modules):
+    """TEST: Only the dependencies for the configured auth type get imported."""
+    code = LAZY_IMPORT_CODE.format(config_path=f"tests/configs/{config_name}", instance_path=str(tmp_path))
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)  # noqa: S603
+
+    assert result.stdout.strip() == expected_modules
+
+
+def test_startup_report(tmp_path, get_test_config, caplog: pytest.LogCaptureFixture):
+    """TEST: The startup report is logged."""
+    with caplog.at_level(logging.INFO):
+        create_app(get_test_config("valid_testing_true.toml"), instance_path=tmp_path)
+        assert "Startup took" in caplog.text
+        assert "allowlist:" in caplog.text
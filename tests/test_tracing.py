@@ -0,0 +1,69 @@
+"""Test the request tracing."""
+
+import os
+
+import pytest
+
+from allowlistapp import create_app, tracing
+
+
+def test_tracing_disabled(tmp_path, client):
+    """TEST: Nothing is traced unless enabled, and spans outside a trace do nothing."""
+    client.post("/authenticate/", data={"username": "", "password": "hunter2"})
+    assert not os.path.exists(os.path.join(tmp_path, "traces.jsonl"))
+
+    with tracing.span("nothing") as span:
+        assert span is None
+
+
+def test_tracing_login(tmp_path, get_test_config):
+    """TEST: A login is traced as a tree of spans in OTLP JSON, and the CLI prints it."""
+    app = create_app(get_test_config("valid_tracing.toml"), instance_path=tmp_path)
+    client = app.test_client()
+    client.get("/check_auth/")  # Not traced
+    client.post("/authenticate/", data={"username": "", "password": "hunter2"}, headers={"X-Forwarded-For": "10.0.0.1"})
+    client.post("/authenticate/", data={"username": "", "password": "wrong"})
+
+    traces = list(tracing.read_traces(os.path.join(tmp_path, "traces.jsonl")))
+    assert len(traces) == 2  # noqa: PLR2004 The logins
+
+    spans = {span["name"]: span for span in traces[0]}
+    assert list(spans) == [
+        "POST /authenticate/",
+        "auth check",
+        "argon2 verify",
+        "add_to_allowlist",
+        "db write",
+        "db commit wait",
+    ]
+    root = spans["POST /authenticate/"]
+    assert "parentSpanId" not in root
+    assert {"key": "http.response.status_code", "value": {"intValue": "200"}} in root["attributes"]
+    assert spans["auth check"]["parentSpanId"] == root["spanId"]
+    assert spans["argon2 verify"]["parentSpanId"] == spans["auth check"]["spanId"]
+    assert spans["db write"]["parentSpanId"] == spans["add_to_allowlist"]["spanId"]
+    assert {span["traceId"] for span in traces[0]} == {root["traceId"]}
+    assert int(root["startTimeUnixNano"]) <= int(spans["auth check"]["startTimeUnixNano"])
+    assert int(root["endTimeUnixNano"]) >= int(spans["db write"]["endTimeUnixNano"])
+
+    assert [span["name"] for span in traces[1]] == ["POST /authenticate/", "auth check", "argon2 verify"]
+
+    result = app.test_cli_runner().invoke(args=["traces", "slowest", "--limit", "1"])
+    lines = result.output.splitlines()
+    assert lines[0].startswith("trace ")
+    assert lines[1].startswith("  POST /authenticate/: ")
+    assert lines[2].startswith("    auth check: ")
+    assert lines[3].startswith("      argon2 verify: ")
+
+
+def test_span_error():
+    """TEST: A span records the exception that ended it."""
+    root = tracing.Span("root")
+    token = tracing._current.set(root)
+    try:
+        with pytest.raises(ValueError, match="nope"), tracing.span("child"):
+            raise ValueError("nope")  # noqa: EM101 It's a test
+    finally:
+        tracing._current.reset(token)
+
+    assert root.finished[0].to_otlp()["status"] == {"code": 2, "message": "ValueError"}